@@ -0,0 +1,157 @@
+"""
+    A local stand-in for Hexagon's streaming services, for benchmarking. It answers the OAuth token endpoint, tiles (with
+    configurable latency, size and a rate of 429s), and WMTSCapabilities.xml, and counts what it was asked for at /_stats.
+
+    It's a bare ASGI app (serve it with lifespan="off") rather than a FastAPI one so that as little time as possible
+    goes into the fake itself.
+"""
+
+import asyncio
+import json
+import random
+import threading
+import time
+
+import httpx
+from azure.core import exceptions as azure_exceptions
+
+from hexprox import hexagon
+
+CAPABILITIES_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<Capabilities xmlns="http://www.opengis.net/wmts/1.0" xmlns:ows="http://www.opengis.net/ows/1.1" version="1.0.0">
+  <Contents>
+    <Layer>
+      <ows:Identifier>HxGN_Imagery</ows:Identifier>
+      <Format>image/jpeg</Format>
+      <TileMatrixSetLink><TileMatrixSet>WebMercator</TileMatrixSet></TileMatrixSetLink>
+      <ResourceURL format="image/jpeg" resourceType="tile" template="{url}1.0.0/HxGN_Imagery/default/WebMercator/{{TileMatrix}}/{{TileRow}}/{{TileCol}}.jpg"/>
+      <ResourceURL format="image/png" resourceType="tile" template="{url}1.0.0/HxGN_Imagery/default/WebMercator/{{TileMatrix}}/{{TileRow}}/{{TileCol}}.png"/>
+    </Layer>
+  </Contents>
+  <ServiceMetadataURL xlink:href="{url}1.0.0/WMTSCapabilities.xml" xmlns:xlink="http://www.w3.org/1999/xlink"/>
+</Capabilities>
+"""
+
+
+class FakeHexagon():
+    """
+        ASGI app imitating Hexagon. Latencies are in seconds; throttle_rate is the fraction of tile requests answered
+        with a 429 (and a Retry-After of retry_after seconds).
+    """
+    def __init__(self, tile_latency=0.0, tile_size=20000, throttle_rate=0.0, retry_after=1, token_latency=0.0,
+                 capabilities_latency=0.0, seed=None):
+        self.tile_latency = tile_latency
+        self.tile_size = tile_size
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.token_latency = token_latency
+        self.capabilities_latency = capabilities_latency
+
+        self._random = random.Random(seed)
+        self._tile = b"\xff\xd8\xff\xe0" + self._random.randbytes(max(tile_size - 4, 0))  # random, so compression upstream or in between can't flatter the numbers
+        self._capabilities = CAPABILITIES_TEMPLATE.format(url=hexagon.STREAMING_WMTS_URL).encode("utf-8")
+
+        self.token_requests = 0
+        self.tile_requests = 0
+        self.throttled = 0
+        self.capabilities_requests = 0
+
+    async def __call__(self, scope, receive, send):
+        path = scope["path"]
+        query = scope["query_string"].decode("latin-1")
+        if path.endswith("/oauth/token"):
+            await self._token(send)
+        elif path == "/_stats":
+            await self._respond(send, 200, "application/json", json.dumps(self.stats()).encode("utf-8"))
+        elif "WMTSCapabilities.xml" in query:
+            await self._capabilities_response(send)
+        elif "/WebMercator/" in query:
+            await self._tile_response(send, query)
+        else:
+            await self._respond(send, 404, "text/plain", b"Not found")
+
+    @staticmethod
+    async def _respond(send, status, media_type, body, headers=()):
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(b"content-type", media_type.encode("latin-1")), (b"content-length", str(len(body)).encode("latin-1")), *headers]})
+        await send({"type": "http.response.body", "body": body})
+
+    async def _token(self, send):
+        self.token_requests += 1
+        if self.token_latency:
+            await asyncio.sleep(self.token_latency)
+        body = json.dumps({"access_token": f"bench-token-{self.token_requests}", "expires_in": 3600, "token_type": "Bearer"})
+        await self._respond(send, 200, "application/json", body.encode("utf-8"))
+
+    async def _capabilities_response(self, send):
+        self.capabilities_requests += 1
+        if self.capabilities_latency:
+            await asyncio.sleep(self.capabilities_latency)
+        await self._respond(send, 200, "application/xml", self._capabilities, headers=[(b"etag", b'"bench-capabilities"')])
+
+    async def _tile_response(self, send, query):
+        self.tile_requests += 1
+        if self.tile_latency:
+            await asyncio.sleep(self.tile_latency)
+        if self.throttle_rate and self._random.random() < self.throttle_rate:
+            self.throttled += 1
+            await self._respond(send, 429, "text/plain", b"Too many requests", headers=[(b"retry-after", str(self.retry_after).encode("latin-1"))])
+            return
+        media_type = "image/png" if query.split("&", 1)[0].endswith(".png") else "image/jpeg"
+        await self._respond(send, 200, media_type, self._tile)
+
+    def stats(self):
+        return {
+            "token_requests": self.token_requests,
+            "tile_requests": self.tile_requests,
+            "throttled": self.throttled,
+            "capabilities_requests": self.capabilities_requests,
+        }
+
+
+class LocalHexagonTransport(httpx.AsyncBaseTransport):
+    """
+        Sends requests meant for Hexagon to the fake on localhost instead, over a normal pooled transport, so the proxy
+        code under test runs unchanged with its real URLs
+    """
+    def __init__(self, port, **transport_options):
+        self.port = port
+        self._transport = httpx.AsyncHTTPTransport(**transport_options)
+
+    async def handle_async_request(self, request):
+        request.url = request.url.copy_with(scheme="http", host="127.0.0.1", port=self.port)
+        return await self._transport.handle_async_request(request)
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+class FakeSecret():
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeSecretClient():
+    """
+        Blocking stand-in for azure.keyvault.secrets.SecretClient, holding a credential set for each of the API keys
+        bench-0 .. bench-{api_keys - 1}. latency is how long each get_secret call blocks for.
+    """
+    def __init__(self, api_keys=10, sets_per_key=3, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+        self.secrets = {}
+        for key_number in range(api_keys):
+            sets = [{"client_id": f"bench-id-{key_number}-{set_number}", "client_secret": f"bench-secret-{key_number}-{set_number}"}
+                    for set_number in range(sets_per_key)]
+            self.secrets[f"credential-set-bench-{key_number}"] = json.dumps({"count": sets_per_key, "sets": sets, "org": f"Bench Org {key_number % 3}"})
+
+    def get_secret(self, name):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)  # runs in a worker thread, like the real client
+        if name not in self.secrets:
+            raise azure_exceptions.ResourceNotFoundError("Secret not found")
+        return FakeSecret(self.secrets[name])
+
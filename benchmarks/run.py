@@ -0,0 +1,254 @@
+"""
+    Load tests HexProx against a local fake Hexagon and reports throughput, latency percentiles and memory per scenario.
+
+        python -m benchmarks.run
+        python -m benchmarks.run --scenarios proxy --concurrency 200 --requests 5000 --tile-latency 0.1 --json results.json
+
+    Scenarios:
+        redirect      - desktop tile requests, answered with a redirect to Hexagon
+        proxy         - browser tile requests (with an Origin header), where the tile data goes through the proxy
+        capabilities  - WMTSCapabilities.xml requests, rewritten to point back at the proxy
+        v2            - v2 tile requests, which look up the API key's credentials in (a fake) Key Vault first
+
+    Each scenario gets a fresh proxy process (the real FastAPI app under uvicorn, with Key Vault replaced by
+    FakeSecretClient and Hexagon by FakeHexagon in its own process), so scenarios don't share warm caches and the memory
+    figures are the proxy's alone. Requests are spread over a pool of distinct tiles and API keys chosen with a fixed seed,
+    so runs with the same arguments send the same requests.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import math
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import time
+from collections import Counter
+
+import httpx
+
+SCENARIOS = ("redirect", "proxy", "capabilities", "v2")
+BROWSER_ORIGIN = "https://gis.conservation.ca.gov"
+CLIENT_ID = base64.b64encode(b"bench-client-id").decode()
+CLIENT_SECRET = base64.b64encode(b"bench-client-secret").decode()
+TILE_PATH = "1.0.0/HxGN_Imagery/default/WebMercator"
+BENCH_ZOOM = 15
+
+
+def _listening_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    return sock
+
+
+def _serve(app, sock, lifespan):
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(app, log_level="warning", access_log=False, lifespan=lifespan))
+    server.run(sockets=[sock])
+
+
+def serve_fake_hexagon(port_queue, options):
+    from benchmarks.fake_hexagon import FakeHexagon
+
+    fake = FakeHexagon(tile_latency=options["tile_latency"], tile_size=options["tile_size"], throttle_rate=options["throttle_rate"],
+                       token_latency=options["token_latency"], capabilities_latency=options["capabilities_latency"], seed=options["seed"])
+    sock = _listening_socket()
+    port_queue.put(sock.getsockname()[1])
+    _serve(fake, sock, lifespan="off")
+
+
+def serve_proxy(port_queue, hexagon_port, options):
+    # main connects to Key Vault at import unless these are set - the SecretClient it builds is replaced below before it's used
+    os.environ.setdefault("KEY_VAULT_NAME", "hexprox-benchmark")
+    os.environ.setdefault("MANAGED_IDENTITY_CLIENT_ID", "hexprox-benchmark")
+
+    import main
+    from benchmarks.fake_hexagon import FakeSecretClient, LocalHexagonTransport
+    from hexprox import config, hexagon
+
+    config.WARMUP_API_KEYS = options.get("warmup_api_keys", [])  # preloaded when the app starts up
+    main.KEY_VAULT_CLIENT = FakeSecretClient(api_keys=options["api_keys"], latency=options["key_vault_latency"])
+    limits = httpx.Limits(max_connections=config.UPSTREAM_MAX_CONNECTIONS,
+                          max_keepalive_connections=config.UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+                          keepalive_expiry=config.UPSTREAM_KEEPALIVE_EXPIRY_SECONDS)
+    hexagon._ASYNC_HTTP_CLIENT = httpx.AsyncClient(transport=LocalHexagonTransport(hexagon_port, limits=limits),
+                                                   timeout=httpx.Timeout(config.UPSTREAM_TIMEOUT_SECONDS), follow_redirects=True)
+    sock = _listening_socket()
+    port_queue.put(sock.getsockname()[1])
+    _serve(main.app, sock, lifespan="on")
+
+
+def make_requests(scenario, count, options, rng):
+    """
+        Returns a list of (path, headers) for the scenario
+    """
+    side = math.isqrt(max(options["distinct_tiles"] - 1, 0)) + 1  # lay the tiles out in a roughly square block
+    requests = []
+    for _ in range(count):
+        index = rng.randrange(options["distinct_tiles"])
+        row, col = 12600 + index // side, 5200 + index % side
+        tile = f"{TILE_PATH}/{BENCH_ZOOM}/{row}/{col}.jpg"
+        if scenario == "redirect":
+            requests.append((f"/v1/wmts/bench/{CLIENT_ID}/{CLIENT_SECRET}/{tile}", {}))
+        elif scenario == "proxy":
+            requests.append((f"/v1/wmts/bench/{CLIENT_ID}/{CLIENT_SECRET}/{tile}", {"Origin": BROWSER_ORIGIN}))
+        elif scenario == "capabilities":
+            requests.append((f"/v1/wmts/bench/{CLIENT_ID}/{CLIENT_SECRET}/1.0.0/WMTSCapabilities.xml?service=WMTS&request=GetCapabilities", {}))
+        elif scenario == "v2":
+            requests.append((f"/v2/wmts/bench-{rng.randrange(options['api_keys'])}/{tile}", {}))
+        else:
+            raise ValueError(f"Unknown scenario {scenario}")
+    return requests
+
+
+def memory_mb(pid):
+    """
+        Returns (current, peak) resident memory of the process in MB, or (None, None) where /proc isn't available
+    """
+    try:
+        with open(f"/proc/{pid}/status", "r") as status_file:
+            fields = dict(line.split(":", 1) for line in status_file if ":" in line)
+    except OSError:
+        return None, None
+    return int(fields["VmRSS"].split()[0]) / 1024, int(fields["VmHWM"].split()[0]) / 1024
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))]
+
+
+async def wait_until_up(base_url, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while True:
+            try:
+                await client.get("/")
+                return
+            except httpx.TransportError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.05)
+
+
+async def drive(base_url, requests, concurrency):
+    """
+        Sends the requests with concurrency workers. Returns the latency (seconds) and status of each - None for
+        requests that failed outright - and how long the whole lot took.
+    """
+    results = []
+    remaining = iter(requests)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120, follow_redirects=False) as client:
+        async def worker():
+            for path, headers in remaining:  # shared iterator, so each request is sent once
+                start = time.perf_counter()
+                try:
+                    response = await client.get(path, headers=headers)
+                    await response.aread()
+                    status = response.status_code
+                except httpx.HTTPError:
+                    status = None
+                results.append((time.perf_counter() - start, status))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return results, time.perf_counter() - start
+
+
+def run_scenario(scenario, options):
+    context = multiprocessing.get_context("spawn")
+    port_queue = context.Queue()
+    hexagon_process = context.Process(target=serve_fake_hexagon, args=(port_queue, options), daemon=True)
+    hexagon_process.start()
+    hexagon_port = port_queue.get(timeout=60)
+    proxy_process = context.Process(target=serve_proxy, args=(port_queue, hexagon_port, options), daemon=True)
+    proxy_process.start()
+    proxy_port = port_queue.get(timeout=60)
+
+    try:
+        base_url = f"http://127.0.0.1:{proxy_port}"
+        rng = random.Random(f"{options['seed']}-{scenario}")
+        asyncio.run(wait_until_up(base_url))
+        rss_start, _ = memory_mb(proxy_process.pid)
+        if options["warmup"]:
+            asyncio.run(drive(base_url, make_requests(scenario, options["warmup"], options, rng), options["concurrency"]))
+        results, seconds = asyncio.run(drive(base_url, make_requests(scenario, options["requests"], options, rng), options["concurrency"]))
+        rss_end, rss_peak = memory_mb(proxy_process.pid)
+        upstream = httpx.get(f"http://127.0.0.1:{hexagon_port}/_stats").json()
+    finally:
+        proxy_process.terminate()
+        hexagon_process.terminate()
+        proxy_process.join()
+        hexagon_process.join()
+
+    latencies = sorted(latency for latency, status in results if status is not None)
+    statuses = Counter(str(status) if status is not None else "error" for latency, status in results)
+    to_ms = lambda value: round(value * 1000, 2) if value is not None else None
+    return {
+        "scenario": scenario,
+        "requests": len(results),
+        "concurrency": options["concurrency"],
+        "seconds": round(seconds, 3),
+        "requests_per_second": round(len(results) / seconds, 1) if seconds else None,
+        "p50_ms": to_ms(percentile(latencies, 0.50)),
+        "p95_ms": to_ms(percentile(latencies, 0.95)),
+        "p99_ms": to_ms(percentile(latencies, 0.99)),
+        "max_ms": to_ms(latencies[-1] if latencies else None),
+        "statuses": dict(statuses),
+        "rss_start_mb": round(rss_start, 1) if rss_start is not None else None,
+        "rss_end_mb": round(rss_end, 1) if rss_end is not None else None,
+        "rss_peak_mb": round(rss_peak, 1) if rss_peak is not None else None,
+        "upstream": upstream,
+    }
+
+
+def format_table(results):
+    columns = ("scenario", "requests", "requests_per_second", "p50_ms", "p95_ms", "p99_ms", "max_ms", "rss_end_mb", "rss_peak_mb")
+    rows = [columns] + [tuple("" if result[column] is None else str(result[column]) for column in columns) for result in results]
+    widths = [max(len(row[index]) for row in rows) for index in range(len(columns))]
+    lines = ["  ".join(value.rjust(width) for value, width in zip(row, widths)) for row in rows]
+    for result in results:
+        lines.append(f"{result['scenario']}: statuses {result['statuses']}, upstream {result['upstream']}")
+    return "\n".join(lines)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run", description="Benchmark HexProx against a local fake Hexagon")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=2000, help="measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=100, help="requests sent before measuring, to fill pools and caches")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--distinct-tiles", type=int, default=1000, help="how many different tiles requests are spread over - fewer means more cache hits")
+    parser.add_argument("--api-keys", type=int, default=10, help="how many different API keys v2 requests are spread over")
+    parser.add_argument("--tile-latency", type=float, default=0.05, help="seconds the fake Hexagon takes to return a tile")
+    parser.add_argument("--tile-size", type=int, default=20000, help="bytes per tile")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of tile requests the fake Hexagon answers with a 429")
+    parser.add_argument("--token-latency", type=float, default=0.05)
+    parser.add_argument("--capabilities-latency", type=float, default=0.05)
+    parser.add_argument("--key-vault-latency", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", default=None, help="also write the results to this file")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    parsed = parse_args(args)
+    options = vars(parsed)
+    results = [run_scenario(scenario, options) for scenario in parsed.scenarios]
+    print(format_table(results))
+    if parsed.json:
+        with open(parsed.json, "w") as output:
+            json.dump({"options": options, "python": sys.version, "results": results}, output, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
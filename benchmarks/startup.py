@@ -0,0 +1,135 @@
+"""
+    Measures HexProx's cold start: how long importing main takes (and which imports dominate it), how long a new
+    instance takes to start accepting requests, and the latency of its first v2 tile request compared to steady state -
+    once cold and once with the warm-up routine preloading the API key.
+
+        python -m benchmarks.startup
+        python -m benchmarks.startup --key-vault-latency 0.2 --token-latency 0.3 --json startup.json
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+from benchmarks.run import serve_fake_hexagon, serve_proxy, wait_until_up, TILE_PATH, BENCH_ZOOM
+
+WARMUP_API_KEY = "bench-0"
+
+
+def import_profile(top=10):
+    """
+        Imports main in a fresh interpreter with -X importtime. Returns the total import time in seconds and main's
+        slowest direct imports as (module, seconds), slowest first.
+    """
+    env = {**os.environ, "KEY_VAULT_NAME": "hexprox-benchmark", "MANAGED_IDENTITY_CLIENT_ID": "hexprox-benchmark"}
+    env.pop("PYTEST_VERSION", None)
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], capture_output=True, text=True, env=env,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), check=True)
+
+    imported_by_main = []
+    total = 0
+    pending = []  # importtime lists an import's children before it, so collect depth-1 lines until we see their parent
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 1:
+            pending.append((name.strip(), int(cumulative) / 1e6))
+        elif depth == 0:
+            if name.strip() == "main":
+                total = int(cumulative) / 1e6
+                imported_by_main = pending
+            pending = []
+    return total, sorted(imported_by_main, key=lambda entry: entry[1], reverse=True)[:top]
+
+
+async def first_requests(base_url, count):
+    latencies = []
+    async with httpx.AsyncClient(base_url=base_url, follow_redirects=False) as client:
+        await client.get("/")  # so the first timed request doesn't include this side's own first-request costs (imports, connecting)
+        for request_number in range(count):
+            start = time.perf_counter()
+            response = await client.get(f"/v2/wmts/{WARMUP_API_KEY}/{TILE_PATH}/{BENCH_ZOOM}/12600/{5200 + request_number}.jpg")
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 307:
+                raise RuntimeError(f"Expected a redirect, got status code {response.status_code}")
+    return latencies
+
+
+def measure_start(options, warm):
+    """
+        Starts a fresh proxy and returns how long it took to accept requests, the first v2 tile's latency, and the
+        median latency of the requests after it
+    """
+    context = multiprocessing.get_context("spawn")
+    port_queue = context.Queue()
+    hexagon_process = context.Process(target=serve_fake_hexagon, args=(port_queue, options), daemon=True)
+    hexagon_process.start()
+    hexagon_port = port_queue.get(timeout=60)
+
+    proxy_options = {**options, "warmup_api_keys": [WARMUP_API_KEY] if warm else []}
+    start = time.perf_counter()
+    proxy_process = context.Process(target=serve_proxy, args=(port_queue, hexagon_port, proxy_options), daemon=True)
+    proxy_process.start()
+    try:
+        base_url = f"http://127.0.0.1:{port_queue.get(timeout=60)}"
+        asyncio.run(wait_until_up(base_url))
+        ready_seconds = time.perf_counter() - start
+        latencies = asyncio.run(first_requests(base_url, options["requests"] + 1))
+    finally:
+        proxy_process.terminate()
+        hexagon_process.terminate()
+        proxy_process.join()
+        hexagon_process.join()
+
+    return {
+        "warm_up": warm,
+        "ready_seconds": round(ready_seconds, 3),
+        "first_request_ms": round(latencies[0] * 1000, 2),
+        "steady_state_p50_ms": round(statistics.median(latencies[1:]) * 1000, 2),
+    }
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.startup", description="Measure HexProx's cold start")
+    parser.add_argument("--requests", type=int, default=20, help="requests after the first, for the steady-state latency")
+    parser.add_argument("--key-vault-latency", type=float, default=0.1)
+    parser.add_argument("--token-latency", type=float, default=0.2)
+    parser.add_argument("--top", type=int, default=10, help="how many of the slowest imports to list")
+    parser.add_argument("--json", default=None, help="also write the results to this file")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    parsed = parse_args(args)
+    options = {"tile_latency": 0.0, "tile_size": 20000, "throttle_rate": 0.0, "capabilities_latency": 0.0, "seed": 1,
+               "api_keys": 1, "token_latency": parsed.token_latency, "key_vault_latency": parsed.key_vault_latency, "requests": parsed.requests}
+
+    import_seconds, slowest_imports = import_profile(parsed.top)
+    starts = [measure_start(options, warm=False), measure_start(options, warm=True)]
+
+    print(f"import main: {import_seconds * 1000:.0f} ms")
+    for module, seconds in slowest_imports:
+        print(f"  {module:40} {seconds * 1000:8.1f} ms")
+    for result in starts:
+        print(f"{'warm-up' if result['warm_up'] else 'cold':8} ready after {result['ready_seconds'] * 1000:.0f} ms, "
+              f"first v2 tile {result['first_request_ms']} ms, then p50 {result['steady_state_p50_ms']} ms")
+
+    results = {"import_seconds": import_seconds, "slowest_imports": slowest_imports, "starts": starts}
+    if parsed.json:
+        with open(parsed.json, "w") as output:
+            json.dump(results, output, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
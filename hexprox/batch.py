@@ -0,0 +1,84 @@
+"""
+    Batch tile requests - many tiles in one request and one response, so the routing, credential lookup and token check
+    are paid once per batch rather than once per tile. See main.get_wmts_batch_v2.
+
+    A batch names its tiles either as a list of matrix/row/col triples or as a bbox and zoom:
+
+        /v2/wmts/{api_key}/batch?tiles=15/12600/5200,15/12600/5201&ext=jpg
+        /v2/wmts/{api_key}/batch?bbox=-122.45,37.75,-122.40,37.80&zoom=15&ext=png
+
+    The response is multipart/mixed, with one part per tile in the order they finish. Each part carries the tile's path
+    in Content-Location and its own status in X-Tile-Status - tiles that failed have a short plain text body instead.
+"""
+
+import itertools
+
+from hexprox import config
+from hexprox.seeding import tiles_for_bbox
+
+BATCH_EXTENSIONS = ("jpg", "png")
+
+
+class BatchRequestError(ValueError):
+    pass
+
+
+def _ints(value, count, name):
+    try:
+        numbers = [int(part) for part in value]
+    except ValueError:
+        raise BatchRequestError(f"{name} must be whole numbers")
+    if len(numbers) != count:
+        raise BatchRequestError(f"{name} needs {count} values")
+    return numbers
+
+
+def parse_batch_params(params, max_tiles=config.BATCH_MAX_TILES):
+    """
+        Returns the batch's ([(matrix, row, col), ...], extension) from the query parameters, without duplicates.
+        Raises BatchRequestError for malformed or oversized batches.
+    """
+    extension = params.get("ext", "jpg").lower()
+    if extension not in BATCH_EXTENSIONS:
+        raise BatchRequestError(f"ext must be one of {', '.join(BATCH_EXTENSIONS)}")
+
+    tile_lists = params.getlist("tiles") if hasattr(params, "getlist") else [params["tiles"]] if "tiles" in params else []
+    if tile_lists:
+        tiles = (tuple(_ints(tile.strip().split("/"), 3, "Each tile")) for tile_list in tile_lists for tile in tile_list.split(",") if tile.strip())
+    elif "bbox" in params and "zoom" in params:
+        try:
+            bbox = [float(value) for value in params["bbox"].split(",")]
+        except ValueError:
+            raise BatchRequestError("bbox must be min_lon,min_lat,max_lon,max_lat")
+        if len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+            raise BatchRequestError("bbox must be min_lon,min_lat,max_lon,max_lat")
+        zoom = _ints([params["zoom"]], 1, "zoom")[0]
+        if not 0 <= zoom <= config.BATCH_MAX_ZOOM:
+            raise BatchRequestError(f"zoom must be between 0 and {config.BATCH_MAX_ZOOM}")
+        tiles = tiles_for_bbox(bbox, [zoom])
+    else:
+        raise BatchRequestError("Give either tiles (matrix/row/col, comma separated) or bbox and zoom")
+
+    unique_tiles = list(dict.fromkeys(itertools.islice(tiles, max_tiles * 2 + 1)))  # enough to tell if there are too many, even with some repeats, without expanding a huge bbox
+    if len(unique_tiles) > max_tiles:
+        raise BatchRequestError(f"A batch can have at most {max_tiles} tiles")
+    if not unique_tiles:
+        raise BatchRequestError("The batch has no tiles")
+    for matrix, row, col in unique_tiles:
+        if not (0 <= matrix <= config.BATCH_MAX_ZOOM and 0 <= row < 2 ** matrix and 0 <= col < 2 ** matrix):
+            raise BatchRequestError(f"Tile {matrix}/{row}/{col} is outside the tile matrix")
+    return unique_tiles, extension
+
+
+def multipart_part(boundary, tile, extension, status_code, media_type, content):
+    matrix, row, col = tile
+    headers = (f"--{boundary}\r\n"
+               f"Content-Type: {media_type}\r\n"
+               f"Content-Location: {matrix}/{row}/{col}.{extension}\r\n"
+               f"X-Tile-Status: {status_code}\r\n"
+               f"Content-Length: {len(content)}\r\n\r\n")
+    return b"".join((headers.encode("latin-1"), content, b"\r\n"))
+
+
+def multipart_end(boundary):
+    return f"--{boundary}--\r\n".encode("latin-1")
@@ -0,0 +1,261 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from hexprox import config
+from hexprox.hexagon import STREAMING_WMTS_URL
+from hexprox.http_cache import entity_tag
+from hexprox.url_rewriter import StreamingSplitter, needs_rewriting
+
+
+class CachedDocument():
+    """
+        An upstream service document, stored pre-split on the Hexagon base URL so that rewriting it to point at the proxy
+        is a single join rather than a search of the whole document. Documents that can't contain URLs (binary
+        responses) are a single segment, the upstream body as it was.
+    """
+    __slots__ = ("segments", "status_code", "media_type", "etag", "last_modified", "fetched_at", "digest")
+
+    def __init__(self, segments, status_code, media_type, etag=None, last_modified=None, fetched_at=None, digest=None):
+        self.segments = segments
+        self.status_code = status_code
+        self.media_type = media_type
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at if fetched_at is not None else time.monotonic()
+        self.digest = digest if digest is not None else hashlib.blake2b(b"\0".join(segments), digest_size=12).digest()
+
+    def render(self, base_url):
+        """
+            Returns the document bytes with every Hexagon base URL replaced by base_url
+        """
+        return _as_bytes(base_url).join(self.segments)
+
+    async def aiter_render(self, base_url):
+        """
+            Yields the rendered document as the stored segments with base_url between them, so it can be sent without
+            being joined into a new copy
+        """
+        base_url = _as_bytes(base_url)
+        for index, segment in enumerate(self.segments):
+            if index:
+                yield base_url
+            if segment:
+                yield segment
+
+    def rendered_length(self, base_url):
+        return sum(len(segment) for segment in self.segments) + len(_as_bytes(base_url)) * (len(self.segments) - 1)
+
+    def entity_tag(self, base_url):
+        """
+            ETag for the document rendered with base_url - the rendered document differs per key and base URL, so the
+            tag has to as well - worked out without rendering it
+        """
+        return entity_tag(self.digest + _as_bytes(base_url))
+
+
+class UncachedResponse():
+    """
+        An upstream response to a service document request that is sent on as it arrives rather than cached: binary
+        bodies, passed through untouched, and documents too large to cache (by Content-Length), rewritten as they
+        stream. Only the request that fetched it can send it. release, if set, is called once it has been sent.
+    """
+    __slots__ = ("response", "rewrite", "release")
+
+    def __init__(self, response, rewrite, release=None):
+        self.response = response
+        self.rewrite = rewrite
+        self.release = release
+
+
+def _as_bytes(base_url):
+    return base_url.encode("utf-8") if isinstance(base_url, str) else base_url
+
+
+class DocumentBuilder():
+    """
+        Collects a document's segments and digest as its body arrives, splitting on the Hexagon base URL only if the
+        media type can contain it
+    """
+    def __init__(self, rewrite_url, media_type):
+        self._splitter = StreamingSplitter(rewrite_url) if needs_rewriting(media_type) else None
+        self.rewritten = self._splitter is not None
+        self.size = 0
+        self._digest = hashlib.blake2b(digest_size=12)
+        self._segments = []
+        self._current = []  # pieces of the segment in progress
+
+    def feed(self, chunk):
+        self.size += len(chunk)
+        self._digest.update(chunk)
+        if self._splitter is None:
+            self._current.append(chunk)
+            return
+        for piece in self._splitter.feed(chunk):
+            if piece is None:
+                self._segments.append(b"".join(self._current))
+                self._current = []
+            else:
+                self._current.append(piece)
+
+    def finish(self):
+        """
+            Returns (segments, digest). A segment that arrived as one piece is kept as that same bytes object.
+        """
+        if self._splitter is not None:
+            self._current.extend(self._splitter.close())
+        self._segments.append(b"".join(self._current))
+        return self._segments, self._digest.digest()
+
+
+class CapabilitiesCache():
+    """
+        Caches GetCapabilities and other WMTS service documents, keyed by path and normalized query parameters. Documents
+        are stored once for all API keys and credential sets and rewritten per request from their pre-split template.
+        Once a document is older than ttl_seconds, it should be revalidated against upstream with the headers from
+        revalidation_headers - a 304 only needs to mark the stored copy fresh again.
+
+        Only documents that get rewritten (XML, JSON and other text) of up to max_document_bytes are kept. Callers
+        should check is_cacheable before storing a response and send the others on as UncachedResponses. A document
+        that turns out to be too large without saying so up front is built for the requests waiting on it, but isn't kept.
+    """
+    def __init__(self, ttl_seconds=config.CAPABILITIES_CACHE_TTL_SECONDS, max_documents=config.CAPABILITIES_CACHE_MAX_DOCUMENTS,
+                 max_document_bytes=config.CAPABILITIES_CACHE_MAX_DOCUMENT_BYTES, rewrite_url=STREAMING_WMTS_URL):
+        self.ttl_seconds = ttl_seconds
+        self.max_documents = max_documents
+        self.max_document_bytes = max_document_bytes
+        self.rewrite_url = rewrite_url.encode("utf-8")
+
+        self._documents = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.uncached = 0
+
+    @staticmethod
+    def key(path, params=None):
+        """
+            WMTS KVP parameter names are case-insensitive and unordered, so normalize them to get one entry per document
+        """
+        if params is None:
+            items = ()
+        elif hasattr(params, "multi_items"):
+            items = params.multi_items()
+        else:
+            items = params.items()
+        return path, tuple(sorted((name.lower(), value) for name, value in items if name.lower() != "access_token"))
+
+    def get(self, key):
+        """
+            Returns the cached document for the key, whether or not it's fresh, or None
+        """
+        with self._lock:
+            document = self._documents.get(key)
+            if document is not None:
+                self._documents.move_to_end(key)
+        return document
+
+    def is_fresh(self, document):
+        return document.fetched_at + self.ttl_seconds > time.monotonic()
+
+    def get_fresh(self, key):
+        document = self.get(key)
+        if document is not None and self.is_fresh(document):
+            self.hits += 1
+            return document
+        self.misses += 1
+        return None
+
+    def is_cacheable(self, response):
+        """
+            Whether an upstream response, judged by its headers, is one we'd keep - see UncachedResponse for the others
+        """
+        if not needs_rewriting(response.headers.get("content-type")):
+            return False
+        try:
+            return int(response.headers.get("content-length", 0)) <= self.max_document_bytes
+        except ValueError:
+            return True  # find out as it arrives
+
+    @staticmethod
+    def revalidation_headers(document):
+        headers = {}
+        if document is not None:
+            if document.etag:
+                headers["If-None-Match"] = document.etag
+            if document.last_modified:
+                headers["If-Modified-Since"] = document.last_modified
+        return headers
+
+    def revalidated(self, key, document):
+        """
+            Marks a stored document as fresh again after upstream confirmed it hasn't changed (a 304)
+        """
+        self.revalidations += 1
+        refreshed = CachedDocument(document.segments, document.status_code, document.media_type,
+                                   etag=document.etag, last_modified=document.last_modified, digest=document.digest)
+        self._put(key, refreshed)
+        return refreshed
+
+    def store(self, key, response):
+        """
+            Builds a document from an upstream response, caching it if it was successful and is one we keep. Non-200
+            responses are returned without being cached.
+        """
+        builder = DocumentBuilder(self.rewrite_url, response.headers.get("content-type"))
+        builder.feed(response.content)
+        return self._store(key, response, builder)
+
+    async def store_streamed(self, key, response):
+        """
+            As store, for a response whose body hasn't been read yet (sent with stream=True). The body is split on the
+            Hexagon base URL chunk by chunk as it arrives, and the response is closed.
+        """
+        builder = DocumentBuilder(self.rewrite_url, response.headers.get("content-type"))
+        try:
+            async for chunk in response.aiter_bytes():
+                builder.feed(chunk)
+        finally:
+            await response.aclose()
+        return self._store(key, response, builder)
+
+    def _store(self, key, response, builder):
+        segments, digest = builder.finish()
+        document = CachedDocument(segments,
+                                  response.status_code,
+                                  response.headers.get("content-type"),
+                                  etag=response.headers.get("etag"),
+                                  last_modified=response.headers.get("last-modified"),
+                                  digest=digest)
+        if response.status_code == 200:
+            if builder.rewritten and builder.size <= self.max_document_bytes:
+                self._put(key, document)
+            else:
+                self.uncached += 1
+        return document
+
+    def _put(self, key, document):
+        with self._lock:
+            self._documents[key] = document
+            self._documents.move_to_end(key)
+            while len(self._documents) > self.max_documents:
+                self._documents.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._documents.clear()
+
+    def __len__(self):
+        return len(self._documents)
+
+    def stats(self):
+        return {
+            "documents": len(self._documents),
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidations": self.revalidations,
+            "uncached": self.uncached,
+        }
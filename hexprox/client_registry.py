@@ -0,0 +1,105 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from hexprox import config
+
+
+class ClientRegistry():
+    """
+        Holds one Hexagon client per credential hash, replacing an unbounded dict. Holds at most max_clients, dropping
+        the least recently used client when full, and drops clients that haven't been used for idle_seconds. Dropped
+        clients are closed so their sessions, background token refreshes and temp folders don't leak. Idle clients are
+        dropped on lookups and by remove_idle(), which should also be called periodically so a quiet instance doesn't
+        keep renewing tokens for clients nobody is using.
+
+        Lookups and creation happen under a lock, so concurrent requests for new credentials get the same client
+        instead of racing to create their own.
+    """
+    def __init__(self, max_clients=config.CLIENT_REGISTRY_MAX_CLIENTS, idle_seconds=config.CLIENT_REGISTRY_IDLE_SECONDS):
+        self.max_clients = max_clients
+        self.idle_seconds = idle_seconds
+
+        self._clients = OrderedDict()  # client_hash: (client, last_used), least recently used first
+        self._lock = threading.Lock()
+
+        self.created = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get_or_create(self, client_hash, create_client):
+        """
+            Returns the client for the hash, calling create_client() to make one if we don't have it. Exceptions from
+            create_client propagate and nothing is stored.
+        """
+        now = time.monotonic()
+        to_close = []
+        with self._lock:
+            to_close.extend(self._remove_idle(now))
+            entry = self._clients.get(client_hash)
+            if entry is not None:
+                client = entry[0]
+                self._clients[client_hash] = (client, now)
+                self._clients.move_to_end(client_hash)
+            else:
+                client = create_client()
+                self._clients[client_hash] = (client, now)
+                self.created += 1
+                while len(self._clients) > self.max_clients:
+                    to_close.append(self._clients.popitem(last=False)[1][0])
+                    self.evictions += 1
+
+        for old_client in to_close:  # close outside the lock - it can touch the filesystem
+            self._close(old_client)
+        return client
+
+    def remove_idle(self):
+        """
+            Drops and closes the clients that haven't been used for idle_seconds. Returns how many were dropped.
+        """
+        with self._lock:
+            idle = self._remove_idle(time.monotonic())
+        for client in idle:
+            self._close(client)
+        return len(idle)
+
+    def _remove_idle(self, now):
+        idle = []
+        while self._clients:
+            oldest_hash, (client, last_used) = next(iter(self._clients.items()))
+            if last_used + self.idle_seconds > now:
+                break  # everything after this was used more recently
+            del self._clients[oldest_hash]
+            idle.append(client)
+            self.expirations += 1
+        return idle
+
+    @staticmethod
+    def _close(client):
+        try:
+            client.close()
+        except Exception:
+            logging.warning("Failed to close evicted Hexagon client", exc_info=True)
+
+    def clear(self):
+        with self._lock:
+            clients = [client for client, last_used in self._clients.values()]
+            self._clients.clear()
+        for client in clients:
+            self._close(client)
+
+    def __contains__(self, client_hash):
+        return client_hash in self._clients
+
+    def __len__(self):
+        return len(self._clients)
+
+    def stats(self):
+        return {
+            "clients": len(self._clients),
+            "max_clients": self.max_clients,
+            "created": self.created,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
@@ -0,0 +1,95 @@
+import asyncio
+
+
+class FetchAbandoned(Exception):
+    """
+        Raised to callers waiting on a coalesced fetch when the caller doing the fetch went away before finishing
+        (for example, its client disconnected mid-stream). Waiters should make their own request.
+    """
+    pass
+
+
+class RequestCoalescer():
+    """
+        Lets concurrent requests for the same key share one upstream fetch. The first caller for a key becomes the
+        leader and does the work; everyone arriving while it's in flight waits for the leader's result instead of
+        making their own request.
+
+        For whole-body fetches, use run(). When the leader needs to stream its response to its own client as it arrives,
+        use lead() and resolve the returned future with finish()/fail() once the body is complete, while other callers
+        use join() to wait on it. finish() and fail() take the leader's future so that a leader that finishes late can't
+        resolve (or drop) a newer leader's fetch for the same key.
+    """
+    def __init__(self):
+        self._in_flight = {}
+
+        self.upstream_calls = 0
+        self.coalesced_calls = 0  # requests that were answered by another request's upstream call
+
+    def join(self, key):
+        """
+            Returns the in-flight future for the key, counting this caller as coalesced, or None if there isn't one
+        """
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.coalesced_calls += 1
+        return future
+
+    def lead(self, key):
+        """
+            Registers a new in-flight fetch for the key and returns its future. The caller must resolve it with finish() or fail().
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        self.upstream_calls += 1
+        return future
+
+    def _release(self, key, future):
+        if self._in_flight.get(key) is future:
+            del self._in_flight[key]
+
+    def finish(self, key, future, result):
+        self._release(key, future)
+        if not future.done():
+            future.set_result(result)
+
+    def fail(self, key, future, exception=None):
+        """
+            Fails the leader's fetch for the key. With no exception, waiters get FetchAbandoned and should fetch for themselves.
+        """
+        self._release(key, future)
+        if not future.done():
+            future.set_exception(exception if exception is not None else FetchAbandoned(key))
+            future.exception()  # mark it retrieved so asyncio doesn't warn when nobody was waiting on it
+
+    async def run(self, key, fetch):
+        """
+            Awaits fetch() for the key, or the result of the identical fetch already in flight
+        """
+        while True:
+            future = self.join(key)
+            if future is None:
+                break
+            try:
+                return await asyncio.shield(future)
+            except FetchAbandoned:
+                continue
+
+        future = self.lead(key)
+        try:
+            result = await fetch()
+        except BaseException as e:
+            self.fail(key, future, e if isinstance(e, Exception) else None)
+            raise
+        self.finish(key, future, result)
+        return result
+
+    def __len__(self):
+        return len(self._in_flight)
+
+    def stats(self):
+        return {
+            "in_flight": len(self._in_flight),
+            "upstream_calls": self.upstream_calls,
+            "coalesced_calls": self.coalesced_calls,
+        }
@@ -21,4 +21,143 @@ ORIGINS = [
     "https://cw-gis-stg.waterboards.ca.gov"
 ]
 
-ORIGINS_REGEX = "https://.*\.ca\.gov"
\ No newline at end of file
+ORIGINS_REGEX = "https://.*\.ca\.gov"
+
+# Settings for the shared, pooled async HTTP client used to talk to Hexagon. One pool is shared by every credential set
+# so that a single instance can keep connections warm and serve many concurrent proxied tiles.
+UPSTREAM_HTTP2 = True  # falls back to HTTP/1.1 if the h2 package isn't installed
+UPSTREAM_MAX_CONNECTIONS = 100
+UPSTREAM_MAX_KEEPALIVE_CONNECTIONS = 20
+UPSTREAM_KEEPALIVE_EXPIRY_SECONDS = 30
+UPSTREAM_TIMEOUT_SECONDS = 30
+
+# In-memory tile cache for the full-proxy (browser) path. Shared across credential sets since the imagery is the same.
+TILE_CACHE_MAX_BYTES = 128 * 1024 * 1024  # set to 0 to disable
+TILE_CACHE_TTL_SECONDS = 6 * 60 * 60
+
+# Persistent on-disk tile store (a single MBTiles-style SQLite file). Read before going upstream on the proxy and download
+# paths. Set TILE_STORE_PATH (or the HEXPROX_TILE_STORE_PATH environment variable) to a file path to enable it. Worker
+# processes that point at the same file share their tiles - see SHARED_STATE_SYNC_SECONDS.
+TILE_STORE_PATH = os.environ.get("HEXPROX_TILE_STORE_PATH") or None
+TILE_STORE_TTL_SECONDS = 30 * 24 * 60 * 60
+TILE_STORE_MAX_BYTES = 4 * 1024 * 1024 * 1024
+
+# Blank tiles (oceans, no coverage) are all the same small payload. Once the same payload under EMPTY_TILE_MAX_BYTES
+# has come back for EMPTY_TILE_MIN_REPEATS different tiles, it's treated as the blank tile and the coordinates that
+# return it are answered locally. The index is cleared every EMPTY_TILE_TTL_SECONDS. Set EMPTY_TILE_MAX_BYTES to 0 to disable.
+EMPTY_TILE_MAX_BYTES = 1000
+EMPTY_TILE_MIN_REPEATS = 3
+EMPTY_TILE_TTL_SECONDS = 24 * 60 * 60
+
+# Tile requests outside the tile matrix limits and coverage of this layer (read from the WMTS capabilities) get a 404
+# without going upstream. The limits are rebuilt from a fresh capabilities document every TILE_BOUNDS_REFRESH_SECONDS
+# (0 to only rebuild them when capabilities requests come in), or TILE_BOUNDS_RETRY_SECONDS after a failure.
+TILE_BOUNDS_LAYER = "HxGN_Imagery"
+TILE_BOUNDS_TILE_MATRIX_SET = "WebMercator"
+TILE_BOUNDS_CAPABILITIES_PATH = "1.0.0/WMTSCapabilities.xml"
+TILE_BOUNDS_REFRESH_SECONDS = 6 * 60 * 60
+TILE_BOUNDS_RETRY_SECONDS = 5 * 60
+
+# Standalone multi-worker mode (python -m hexprox.standalone). Workers share Hexagon tokens and Key Vault credential
+# sets through a SQLite file at SHARED_STATE_PATH - put it on a RAM disk like /dev/shm - so each is fetched once for all
+# of them. Set through the HEXPROX_SHARED_STATE_PATH environment variable; unset means every process keeps its own.
+SHARED_STATE_PATH = os.environ.get("HEXPROX_SHARED_STATE_PATH") or None
+SHARED_STATE_LEASE_SECONDS = 30  # how long a worker can hold the right to fetch a shared value before others may take over
+SHARED_STATE_WAIT_SECONDS = 10  # how long workers wait on another worker's fetch before doing it themselves
+SHARED_STATE_POLL_SECONDS = 0.05
+SHARED_STATE_SYNC_SECONDS = 2  # how often workers pick up tiles other workers added to the shared tile store
+
+# Tokens are renewed in the background once this fraction of their lifetime (expires_in) has passed, so requests don't
+# wait on the OAuth server in steady state. Set to None to only refresh on demand once a token expires.
+TOKEN_REFRESH_FRACTION = 0.8
+
+# Cache for GetCapabilities and other service documents. Documents older than the TTL are revalidated with Hexagon
+# using ETag/Last-Modified when available. Only documents that can contain URLs to rewrite are cached, and only up to
+# CAPABILITIES_CACHE_MAX_DOCUMENT_BYTES each - binary responses from the general path and oversized documents aren't kept.
+CAPABILITIES_CACHE_TTL_SECONDS = 15 * 60
+CAPABILITIES_CACHE_MAX_DOCUMENTS = 256
+CAPABILITIES_CACHE_MAX_DOCUMENT_BYTES = 4 * 1024 * 1024
+
+# API keys that Key Vault doesn't have a credential set for are remembered for this long, so repeated requests with
+# invalid or probing keys don't each cost a Key Vault call. Bounded so made-up keys can't grow it without limit.
+INVALID_API_KEY_CACHE_SECONDS = 5 * 60
+INVALID_API_KEY_CACHE_MAX_KEYS = 10000
+
+# Limits for the per-credential-set Hexagon clients main.py keeps. v1 URLs carry arbitrary credentials, so this must be bounded.
+CLIENT_REGISTRY_MAX_CLIENTS = 1000
+CLIENT_REGISTRY_IDLE_SECONDS = 2 * 60 * 60
+CLIENT_REGISTRY_SWEEP_SECONDS = 5 * 60  # how often idle clients are dropped even when no requests come in, so their tokens stop renewing
+
+# Bulk tile seeding (hexprox.seeding). Concurrency halves whenever Hexagon returns a 429 and recovers gradually.
+SEED_MAX_WORKERS = 16
+SEED_MAX_ATTEMPTS = 5
+SEED_INCREASE_AFTER_SUCCESSES = 20
+SEED_DEFAULT_RETRY_AFTER_SECONDS = 5  # pause after a 429 that doesn't include a Retry-After
+SEED_CHECKPOINT_EVERY = 100
+
+# Credential set scheduling in APIKeyManager. Throttled sets sit out for Retry-After (or the default below), sets whose
+# token request failed sit out longer, and recent 429s count against a set's load with the given weight, decaying over time.
+CREDENTIAL_THROTTLE_BENCH_SECONDS = 30
+CREDENTIAL_TOKEN_FAILURE_BENCH_SECONDS = 60
+CREDENTIAL_THROTTLE_DECAY_SECONDS = 60
+CREDENTIAL_THROTTLE_WEIGHT = 5
+
+# Per-API-key and per-org limits on v2 requests that use upstream capacity (not redirects, or tiles and service documents
+# answered locally), so one heavy consumer can't starve everyone else - see hexprox/fair_limiter.py. Each key and org has
+# a cap on requests in flight and a token bucket (requests per second, plus a burst allowance), and the instance has a
+# cap on requests in flight overall. Requests over a limit wait in a queue that hands freed capacity to each org and key
+# in turn, for up to RATE_LIMIT_MAX_WAIT_SECONDS before getting a 429.
+# Set any limit to None to turn it off.
+KEY_MAX_CONCURRENCY = 32
+ORG_MAX_CONCURRENCY = 64
+INSTANCE_MAX_CONCURRENCY = 128
+KEY_RATE_PER_SECOND = 100
+KEY_RATE_BURST = 200
+ORG_RATE_PER_SECOND = 200
+ORG_RATE_BURST = 400
+RATE_LIMIT_MAX_WAIT_SECONDS = 2
+
+# Upstream resilience. Retryable responses and connection errors are retried with jittered exponential backoff (or
+# Hexagon's Retry-After, unless it's longer than UPSTREAM_MAX_RETRY_AFTER_SECONDS). After CIRCUIT_BREAKER_FAILURE_THRESHOLD
+# consecutive server errors an upstream is considered down and requests to it fail fast for CIRCUIT_BREAKER_RESET_SECONDS.
+UPSTREAM_RETRY_ATTEMPTS = 3
+UPSTREAM_RETRY_BASE_DELAY_SECONDS = 0.2
+UPSTREAM_RETRY_MAX_DELAY_SECONDS = 5
+UPSTREAM_MAX_RETRY_AFTER_SECONDS = 10
+UPSTREAM_RETRY_STATUSES = (429, 500, 502, 503, 504)
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = 5
+CIRCUIT_BREAKER_RESET_SECONDS = 30
+SERVE_STALE_ON_ERROR = True  # serve an expired cached tile or service document when Hexagon errors rather than failing
+
+# Metrics, in the Prometheus text format at /metrics. Recording is cheap enough to leave on in production.
+METRICS_ENABLED = True
+
+# HTTP caching headers for browsers and edge caches. Conditional requests (If-None-Match/If-Modified-Since) for tiles we
+# hold locally, and for cached capabilities documents, are answered with a 304 without going to Hexagon.
+TILE_CACHE_CONTROL = "public, max-age=86400"
+STALE_TILE_CACHE_CONTROL = "public, max-age=60"  # for tiles served stale because Hexagon is failing - check back soon
+CAPABILITIES_CACHE_CONTROL = "public, max-age=3600"
+# Redirects carry an access token in their Location, so only the client may cache them, never a shared cache. A max-age is
+# added, capped by REDIRECT_MAX_AGE_SECONDS and by the remaining lifetime of the token in the redirect URL.
+REDIRECT_CACHE_CONTROL = "private"
+REDIRECT_MAX_AGE_SECONDS = 3600
+REDIRECT_TOKEN_MARGIN_SECONDS = 60  # cached redirects expire at least this long before their token does
+
+# Warm-up for new (cold) instances - see main.warm_up. Runs on startup and at /warmup, and loads these API keys' credential
+# sets and Hexagon tokens ahead of their first requests. Set WARMUP_API_KEYS to a comma-separated list of keys.
+WARMUP_API_KEYS = [key.strip() for key in os.environ.get("WARMUP_API_KEYS", "").split(",") if key.strip()]
+WARMUP_ON_STARTUP = True
+WARMUP_TIMEOUT_SECONDS = 20
+
+# WMS GetMap, served by mosaicking WMTS tiles - see hexprox/wms.py
+WMS_MAX_SIZE = 2048  # largest WIDTH or HEIGHT we'll render, in pixels
+WMS_MAX_TILES = 64  # if covering the bbox at full detail needs more tiles than this, lower-zoom tiles are used instead
+WMS_MAX_ZOOM = 20
+WMS_TILE_CONCURRENCY = 16  # tiles fetched at once for a single GetMap
+WMS_JPEG_QUALITY = 85
+WMS_PNG_COMPRESS_LEVEL = 3  # PNG encoding time grows quickly with the level for little size benefit on imagery
+
+# Batch tile requests (/v2/wmts/{api_key}/batch) - many tiles streamed back in one multipart response. See hexprox/batch.py
+BATCH_MAX_TILES = 256
+BATCH_MAX_ZOOM = 22
+BATCH_TILE_CONCURRENCY = 16  # tiles fetched at once for a single batch
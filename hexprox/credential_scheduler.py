@@ -0,0 +1,132 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from hexprox import config
+from hexprox.hexagon import HexagonStatusError
+
+
+class CredentialSetHealth():
+    """
+        What we know about one credential set's recent traffic - how many requests are using it right now, how often
+        it's been throttled lately (a score that decays over time), and whether it's benched.
+    """
+    __slots__ = ("in_flight", "throttle_score", "throttle_updated", "benched_until", "throttles", "token_failures", "requests")
+
+    def __init__(self):
+        self.in_flight = 0
+        self.throttle_score = 0.0
+        self.throttle_updated = 0.0
+        self.benched_until = 0.0
+        self.throttles = 0
+        self.token_failures = 0
+        self.requests = 0
+
+    def recent_throttles(self, now):
+        return self.throttle_score * math.exp(-(now - self.throttle_updated) / config.CREDENTIAL_THROTTLE_DECAY_SECONDS)
+
+    def load(self, now):
+        return self.in_flight + config.CREDENTIAL_THROTTLE_WEIGHT * self.recent_throttles(now)
+
+
+class CredentialScheduler():
+    """
+        Picks which of an API key's credential sets serves each request. Sets that were recently throttled (429) or
+        failed to get a token are benched for a while. Among the rest, the one with the lowest load - requests in
+        flight plus a penalty for recent throttling - wins, with ties spread round-robin. If every set is benched, the
+        one that comes off the bench soonest is used.
+
+        Requests should be wrapped in track() so the scheduler hears about load and outcomes.
+    """
+    def __init__(self):
+        self._health = {}  # client_id: CredentialSetHealth
+        self._lock = threading.Lock()
+        self._rotation = 0
+
+    def health(self, credentials):
+        client_id = credentials["client_id"]
+        health = self._health.get(client_id)
+        if health is None:
+            health = self._health.setdefault(client_id, CredentialSetHealth())
+        return health
+
+    def choose(self, sets, count=None):
+        """
+            Returns the index of the credential set in sets to use next
+        """
+        count = len(sets) if count is None else count
+        if count <= 1:
+            return 0
+
+        now = time.monotonic()
+        with self._lock:
+            start = self._rotation % count
+            self._rotation += 1
+        best_index, best_score = 0, None
+        for offset in range(count):
+            index = (start + offset) % count
+            health = self.health(sets[index])
+            if health.benched_until > now:
+                score = (1, health.benched_until)
+            else:
+                score = (0, health.load(now))
+            if best_score is None or score < best_score:
+                best_index, best_score = index, score
+        return best_index
+
+    def throttled(self, credentials, retry_after=None):
+        now = time.monotonic()
+        health = self.health(credentials)
+        with self._lock:
+            health.throttle_score = health.recent_throttles(now) + 1
+            health.throttle_updated = now
+            health.throttles += 1
+            bench_seconds = retry_after if retry_after is not None else config.CREDENTIAL_THROTTLE_BENCH_SECONDS
+            health.benched_until = max(health.benched_until, now + bench_seconds)
+
+    def token_failed(self, credentials):
+        health = self.health(credentials)
+        with self._lock:
+            health.token_failures += 1
+            health.benched_until = max(health.benched_until, time.monotonic() + config.CREDENTIAL_TOKEN_FAILURE_BENCH_SECONDS)
+
+    @contextmanager
+    def track(self, credentials):
+        """
+            Counts the request as in flight on the credential set while the block runs, and records throttling or token
+            failures from either an exception or the status code (and Retry-After, in seconds) given to the yielded callable.
+        """
+        health = self.health(credentials)
+        with self._lock:
+            health.in_flight += 1
+            health.requests += 1
+
+        def record_status(status_code, retry_after=None):
+            if status_code == 429:
+                self.throttled(credentials, retry_after)
+            elif status_code == 403:
+                self.token_failed(credentials)
+
+        try:
+            yield record_status
+        except HexagonStatusError as e:
+            if e.status_code == 429:
+                self.throttled(credentials, e.retry_after)
+            raise
+        except PermissionError:
+            self.token_failed(credentials)
+            raise
+        finally:
+            with self._lock:
+                health.in_flight -= 1
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            "credential_sets": len(self._health),
+            "in_flight": sum(health.in_flight for health in self._health.values()),
+            "benched": sum(1 for health in self._health.values() if health.benched_until > now),
+            "throttles": sum(health.throttles for health in self._health.values()),
+            "token_failures": sum(health.token_failures for health in self._health.values()),
+        }
@@ -0,0 +1,142 @@
+"""
+    Tracks the coordinates where Hexagon only has a blank tile (oceans, areas without coverage) so that requests for
+    them can be answered locally, from one shared copy of the blank tile, without a token or an upstream call.
+
+    Hexagon returns the same small payload for every blank tile of a format. A small payload becomes the known blank
+    tile for its format once it has come back for EMPTY_TILE_MIN_REPEATS different coordinates. From then on every
+    coordinate that returns it is added to the index.
+"""
+
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+
+from hexprox import config
+from hexprox.tile_cache import CachedTile
+from hexprox.tile_store import SQLiteTileStore
+
+MAX_CANDIDATES = 64  # small payloads we're counting repeats of, before they're confirmed as blank tiles
+
+
+class RangeSet():
+    """
+        A set of integers kept as sorted, non-overlapping [start, end) ranges. Blank areas are contiguous, so a row of
+        thousands of blank columns is usually a handful of ranges.
+    """
+    def __init__(self):
+        self._starts = []
+        self._ends = []
+
+    def __contains__(self, value):
+        index = bisect_right(self._starts, value) - 1
+        return index >= 0 and value < self._ends[index]
+
+    def add(self, value):
+        index = bisect_right(self._starts, value) - 1
+        if index >= 0 and value < self._ends[index]:
+            return
+        joins_left = index >= 0 and self._ends[index] == value
+        joins_right = index + 1 < len(self._starts) and self._starts[index + 1] == value + 1
+        if joins_left and joins_right:  # fills the gap between two ranges
+            self._ends[index] = self._ends.pop(index + 1)
+            del self._starts[index + 1]
+        elif joins_left:
+            self._ends[index] = value + 1
+        elif joins_right:
+            self._starts[index + 1] = value
+        else:
+            self._starts.insert(index + 1, value)
+            self._ends.insert(index + 1, value + 1)
+
+    def __len__(self):
+        return sum(end - start for start, end in zip(self._starts, self._ends))
+
+    @property
+    def range_count(self):
+        return len(self._starts)
+
+
+class EmptyTileIndex():
+    """
+        Per zoom level, the rows and columns known to be blank, and the blank tile for each format. Whether a coordinate
+        is blank doesn't depend on the format, so a coordinate learned from a jpg tile also answers png requests once
+        the png blank tile is known. The index is rebuilt from scratch every ttl_seconds, so new coverage shows up.
+    """
+    def __init__(self, max_bytes=config.EMPTY_TILE_MAX_BYTES, min_repeats=config.EMPTY_TILE_MIN_REPEATS, ttl_seconds=config.EMPTY_TILE_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.min_repeats = min_repeats
+        self.ttl_seconds = ttl_seconds
+
+        self._zooms = {}  # zoom: {row: RangeSet of columns}
+        self._blank_tiles = {}  # ext: (tile_id, CachedTile)
+        self._candidates = OrderedDict()  # (ext, tile_id): set of (zoom, row, col) it came back for
+        self._reset_at = time.monotonic() + ttl_seconds
+
+        self.hits = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _expire(self):
+        if time.monotonic() >= self._reset_at:
+            self._zooms.clear()
+            self._blank_tiles.clear()
+            self._candidates.clear()
+            self._reset_at = time.monotonic() + self.ttl_seconds
+
+    def get(self, key):
+        """
+            Returns the shared blank CachedTile if the (matrix, row, col, ext) key is known to be blank, otherwise None
+        """
+        if not self.enabled:
+            return None
+        self._expire()
+        matrix, row, col, ext = key
+        blank = self._blank_tiles.get(ext)
+        columns = self._zooms.get(matrix, {}).get(row)
+        if blank is None or columns is None or col not in columns:
+            return None
+        self.hits += 1
+        return blank[1]
+
+    def observe(self, key, content, media_type):
+        """
+            Records a tile fetched from Hexagon, adding its coordinate to the index if it's the blank tile
+        """
+        if not self.enabled or len(content) >= self.max_bytes:
+            return
+        self._expire()
+        matrix, row, col, ext = key
+        tile_id = SQLiteTileStore.tile_id(content)
+        blank = self._blank_tiles.get(ext)
+        if blank is not None:
+            if blank[0] == tile_id:
+                self._add(matrix, row, col)
+            return
+
+        coordinates = self._candidates.pop((ext, tile_id), set())
+        coordinates.add((matrix, row, col))
+        if len(coordinates) < self.min_repeats:
+            self._candidates[(ext, tile_id)] = coordinates  # most recent at the end
+            while len(self._candidates) > MAX_CANDIDATES:
+                self._candidates.popitem(last=False)
+            return
+
+        self._blank_tiles[ext] = (tile_id, CachedTile(content, media_type, float("inf")))
+        for coordinate in coordinates:
+            self._add(*coordinate)
+        for candidate in [candidate for candidate in self._candidates if candidate[0] == ext]:  # any other small payloads for this format weren't the blank tile
+            del self._candidates[candidate]
+
+    def _add(self, matrix, row, col):
+        self._zooms.setdefault(matrix, {}).setdefault(row, RangeSet()).add(col)
+
+    def stats(self):
+        rows = [columns for zoom in self._zooms.values() for columns in zoom.values()]
+        return {
+            "blank_formats": len(self._blank_tiles),
+            "empty_tiles": sum(len(columns) for columns in rows),
+            "ranges": sum(columns.range_count for columns in rows),
+            "hits": self.hits,
+        }
@@ -0,0 +1,248 @@
+"""
+    Admission control for v2 requests, so that one heavy consumer - an org seeding tiles through its API key, say -
+    can't take all of an instance's upstream connections and Hexagon quota from everyone else.
+
+    Each API key and each org has a limit on requests in flight and a token bucket limiting its request rate, and the
+    instance has a limit on requests in flight overall. A request over any limit isn't turned away straight away -
+    it waits in its key's queue, and whenever capacity frees up the queues are served round-robin, first across orgs and
+    then across each org's keys. A burst from one org therefore queues behind its own earlier requests while other orgs'
+    requests go straight through. Requests still waiting after max_wait_seconds get a RateLimited.
+"""
+
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from hexprox import config
+
+
+class RateLimited(Exception):
+    """
+        Raised when a request waited as long as it's allowed to without being admitted. scope is what held it up -
+        "key", "org" or "instance".
+    """
+    def __init__(self, scope, retry_after):
+        super().__init__(f"Request limit reached for this {scope}")
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+class TokenBucket():
+    """
+        Allows rate requests per second on average, and bursts of up to burst requests
+    """
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def wait_seconds(self, cost, now):
+        """
+            How long until the bucket holds cost tokens (capped at the burst size, so large requests can still get in)
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        cost = min(cost, self.burst)
+        return 0 if self.tokens >= cost else (cost - self.tokens) / self.rate
+
+    def take(self, cost):
+        self.tokens -= min(cost, self.burst)
+
+
+class Usage():
+    """
+        One key's or org's requests in flight and token bucket
+    """
+    __slots__ = ("in_flight", "max_in_flight", "bucket")
+
+    def __init__(self, max_in_flight, rate, burst):
+        self.in_flight = 0
+        self.max_in_flight = max_in_flight
+        self.bucket = TokenBucket(rate, burst) if rate is not None else None
+
+    def wait_seconds(self, cost, now):
+        if self.max_in_flight is not None and self.in_flight >= self.max_in_flight:
+            return math.inf  # until one of its requests finishes
+        return self.bucket.wait_seconds(cost, now) if self.bucket is not None else 0
+
+
+class Waiter():
+    __slots__ = ("api_key", "org", "cost", "future")
+
+    def __init__(self, api_key, org, cost, future):
+        self.api_key = api_key
+        self.org = org
+        self.cost = cost
+        self.future = future
+
+
+class FairLimiter():
+    """
+        Limits requests in flight and request rates per API key, per org, and (in flight only) per instance, queueing
+        requests over the limits and admitting them fairly as capacity frees up. Use slot() around the work, or
+        acquire() and release() when the work outlives the block (streamed responses).
+    """
+    def __init__(self, key_concurrency=config.KEY_MAX_CONCURRENCY, org_concurrency=config.ORG_MAX_CONCURRENCY,
+                 instance_concurrency=config.INSTANCE_MAX_CONCURRENCY,
+                 key_rate=config.KEY_RATE_PER_SECOND, key_burst=config.KEY_RATE_BURST,
+                 org_rate=config.ORG_RATE_PER_SECOND, org_burst=config.ORG_RATE_BURST,
+                 max_wait_seconds=config.RATE_LIMIT_MAX_WAIT_SECONDS):
+        self.key_limits = (key_concurrency, key_rate, key_burst)
+        self.org_limits = (org_concurrency, org_rate, org_burst)
+        self.instance_concurrency = instance_concurrency
+        self.max_wait_seconds = max_wait_seconds
+
+        self._keys = {}  # api_key: Usage
+        self._orgs = {}  # org: Usage
+        self._queues = OrderedDict()  # org: OrderedDict(api_key: deque of Waiters), in the order they'll next be served
+        self._timer = None  # wakes the queue when the first request waiting only on tokens can go
+        self.in_flight = 0
+
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.queue_seconds_total = 0.0
+
+    def _usage(self, table, name, limits):
+        usage = table.get(name)
+        if usage is None:
+            usage = table[name] = Usage(*limits)
+        return usage
+
+    def _wait_seconds(self, api_key, org, cost, now):
+        """
+            Returns (seconds, scope) - how long until a request could be admitted, and what it's waiting on. seconds is
+            0 if it can go now and infinite if it's waiting for requests in flight to finish.
+        """
+        if self.instance_concurrency is not None and self.in_flight >= self.instance_concurrency:
+            return math.inf, "instance"
+        org_wait = self._usage(self._orgs, org, self.org_limits).wait_seconds(cost, now)
+        key_wait = self._usage(self._keys, api_key, self.key_limits).wait_seconds(cost, now)
+        return (key_wait, "key") if key_wait >= org_wait and key_wait > 0 else (org_wait, "org")
+
+    def _admit(self, api_key, org, cost):
+        for usage in (self._keys[api_key], self._orgs[org]):
+            usage.in_flight += 1
+            if usage.bucket is not None:
+                usage.bucket.take(cost)
+        self.in_flight += 1
+        self.admitted += 1
+        return api_key, org
+
+    async def acquire(self, api_key, org, cost=1):
+        """
+            Waits for the request to be admitted and returns a ticket to give to release() once it's done. cost is how
+            many requests' worth of rate it uses (a batch of tiles, for example). Raises RateLimited if it isn't admitted
+            within max_wait_seconds.
+        """
+        now = time.monotonic()
+        seconds, scope = self._wait_seconds(api_key, org, cost, now)
+        if seconds == 0 and org not in self._queues:  # nothing from this org is waiting ahead of it
+            return self._admit(api_key, org, cost)
+
+        waiter = Waiter(api_key, org, cost, asyncio.get_running_loop().create_future())
+        self._queues.setdefault(org, OrderedDict()).setdefault(api_key, deque()).append(waiter)
+        self.queued += 1
+        self._dispatch()
+        try:
+            await asyncio.wait_for(waiter.future, timeout=self.max_wait_seconds)
+        except asyncio.TimeoutError:
+            self._remove(waiter)
+            self.rejected += 1
+            seconds, scope = self._wait_seconds(api_key, org, cost, time.monotonic())
+            raise RateLimited(scope, max(1, math.ceil(seconds)) if math.isfinite(seconds) else 1)
+        except asyncio.CancelledError:  # the client went away while waiting
+            if waiter.future.done() and not waiter.future.cancelled():  # admitted just as it was cancelled
+                self.release(waiter.future.result())
+            else:
+                self._remove(waiter)
+            raise
+        finally:
+            self.queue_seconds_total += time.monotonic() - now
+        return waiter.future.result()
+
+    def release(self, ticket):
+        api_key, org = ticket
+        self._keys[api_key].in_flight -= 1
+        self._orgs[org].in_flight -= 1
+        self.in_flight -= 1
+        if self._queues:
+            self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, api_key, org, cost=1):
+        ticket = await self.acquire(api_key, org, cost)
+        try:
+            yield
+        finally:
+            self.release(ticket)
+
+    def _remove(self, waiter):
+        keys = self._queues.get(waiter.org)
+        queue = keys.get(waiter.api_key) if keys is not None else None
+        if queue is None or waiter not in queue:
+            return
+        queue.remove(waiter)
+        if not queue:
+            del keys[waiter.api_key]
+        if not keys:
+            del self._queues[waiter.org]
+        self._dispatch()  # it may have been holding up the requests behind it
+
+    def _dispatch(self):
+        """
+            Admits waiting requests that can now go, one per org per pass so freed capacity goes round the orgs (and
+            round the keys within each org), then sets a timer for the soonest request waiting only for tokens
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        now = time.monotonic()
+        while True:
+            admitted = False
+            next_seconds = math.inf
+            for org in list(self._queues):
+                keys = self._queues[org]
+                org_admitted = False
+                for api_key in list(keys):
+                    queue = keys[api_key]
+                    while queue and queue[0].future.done():  # timed out or cancelled, and about to be removed
+                        queue.popleft()
+                    if not queue:
+                        del keys[api_key]
+                        continue
+                    seconds, _ = self._wait_seconds(api_key, org, queue[0].cost, now)
+                    if seconds > 0:
+                        next_seconds = min(next_seconds, seconds)
+                        continue
+                    waiter = queue.popleft()
+                    waiter.future.set_result(self._admit(api_key, org, waiter.cost))
+                    if queue:
+                        keys.move_to_end(api_key)
+                    else:
+                        del keys[api_key]
+                    admitted = org_admitted = True
+                    break
+                if not keys:
+                    del self._queues[org]
+                elif org_admitted:
+                    self._queues.move_to_end(org)
+            if not admitted or not self._queues:
+                break
+        if self._queues and math.isfinite(next_seconds):
+            self._timer = asyncio.get_running_loop().call_later(next_seconds, self._dispatch)
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "waiting": sum(len(queue) for keys in self._queues.values() for queue in keys.values()),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "queue_seconds_total": self.queue_seconds_total,
+        }
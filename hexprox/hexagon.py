@@ -1,8 +1,20 @@
+import asyncio
+import hashlib
+import logging
 import os
+import shutil
 import tempfile
+import time
 
-import requests
+import httpx
 from datetime import datetime, UTC
+from urllib.parse import urlencode
+
+from hexprox import config, metrics
+from hexprox.resilience import RetryPolicy, parse_retry_after, send_with_resilience
+from hexprox.shared_state import shared_fetch
+from hexprox.tile_cache import TileCache
+from hexprox.token_manager import TokenManager
 
 TOKEN_URL = "https://services.hxgncontent.com/streaming/oauth/token?grant_type=client_credentials"
 
@@ -15,8 +27,52 @@ PARAMS = "1.0.0/HxGN_Imagery/default/WebMercator/"
 HEXAGON_TILE_EXTENSIONS = ["jpg", "png", "xxx", "txt", "html", "gml"]
 # ZOOMS = {10: (list(range()))
 
-class HexagonManager():
-    def __init__(self, client_id, client_secret, wmts_url=BATCH_WMTS_URL, url_params=PARAMS, token_url=TOKEN_URL):
+_ASYNC_HTTP_CLIENT = None
+
+
+class HexagonStatusError(RuntimeError):
+    """
+        Hexagon answered with something other than a 200. Keeps the status code and any Retry-After (in seconds) so
+        callers can tell throttling (429) apart from other failures.
+    """
+    def __init__(self, status_code, content, headers=None):
+        self.status_code = status_code
+        self.retry_after = parse_retry_after(headers.get("retry-after") if headers is not None else None)
+        super().__init__(f"Server returned alternative status code: {status_code}. Included body '{content}'")
+
+
+def get_async_http_client():
+    """
+        Returns the process-wide pooled async HTTP client, creating it if needed. Every AsyncHexagonManager shares this
+        client by default so that keep-alive connections (and HTTP/2 multiplexing) to Hexagon are reused across credential sets.
+    """
+    global _ASYNC_HTTP_CLIENT
+    if _ASYNC_HTTP_CLIENT is None or _ASYNC_HTTP_CLIENT.is_closed:
+        limits = httpx.Limits(max_connections=config.UPSTREAM_MAX_CONNECTIONS,
+                              max_keepalive_connections=config.UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+                              keepalive_expiry=config.UPSTREAM_KEEPALIVE_EXPIRY_SECONDS)
+        timeout = httpx.Timeout(config.UPSTREAM_TIMEOUT_SECONDS)
+        try:
+            _ASYNC_HTTP_CLIENT = httpx.AsyncClient(http2=config.UPSTREAM_HTTP2, limits=limits, timeout=timeout, follow_redirects=True)
+        except ImportError:  # HTTP/2 support needs the h2 package - HTTP/1.1 with keep-alive is still far better than a connection per request
+            logging.warning("h2 package not available, upstream client falling back to HTTP/1.1")
+            _ASYNC_HTTP_CLIENT = httpx.AsyncClient(http2=False, limits=limits, timeout=timeout, follow_redirects=True)
+    return _ASYNC_HTTP_CLIENT
+
+
+async def close_async_http_client():
+    global _ASYNC_HTTP_CLIENT
+    if _ASYNC_HTTP_CLIENT is not None:
+        await _ASYNC_HTTP_CLIENT.aclose()
+        _ASYNC_HTTP_CLIENT = None
+
+
+class BaseHexagonManager():
+    """
+        Shared credential checks, token bookkeeping, and URL composition for the sync and async managers. Subclasses
+        provide the actual HTTP calls.
+    """
+    def __init__(self, client_id, client_secret, wmts_url=BATCH_WMTS_URL, url_params=PARAMS, token_url=TOKEN_URL, tile_store=None):
         self._token_info = None
         self._reauthorize_after = datetime.now(tz=UTC)
         self.token_url = token_url
@@ -32,22 +88,38 @@ class HexagonManager():
         self.wmts_url = wmts_url
         self.url_params = url_params
 
-        self.session = requests.Session()
+        self.tile_store = tile_store  # optional SQLiteTileStore - checked before downloading a tile and filled after
+        self._default_folder = None
 
-        self.default_folder = tempfile.mkdtemp(prefix="hexagon_")  # where to save tiles
+    @property
+    def default_folder(self):  # where to save tiles - only created once we actually download one
+        if self._default_folder is None:
+            self._default_folder = tempfile.mkdtemp(prefix="hexagon_")
+        return self._default_folder
 
-    def _get_token(self):
-        """Internal method - sends the request to a token URL to get the auth token to use, calculates its valid period
+    def close(self):
+        """
+            Releases anything this client holds - subclasses extend this. Removes the temp folder if we made one.
+        """
+        if self._default_folder is not None:
+            shutil.rmtree(self._default_folder, ignore_errors=True)
+            self._default_folder = None
+
+    @property
+    def _full_token_url(self):
+        return f"{self.token_url}&client_id={self.client_id}&client_secret={self.client_secret}"  # not safe for untrusted inputs. Fine if we know our values
+
+    @staticmethod
+    def _parse_token_response(status_code, body, content):
+        """
+            Checks the token server's response and calculates when we'll need to reauthorize
         Raises:
-            RuntimeError: _description_
+            PermissionError: if the token server didn't give us a token
         Returns:
-            _type_: _description_
+            dict: the token server's response body, with an added reauthorize_after datetime
         """
-        full_url = f"{self.token_url}&client_id={self.client_id}&client_secret={self.client_secret}"  # not safe for untrusted inputs. Fine if we know our values
-        response = requests.get(full_url)
-
-        if response.status_code == 200:
-            body = response.json()  # this has an access token and an expiration
+        if status_code == 200:
+            body = body()  # this has an access token and an expiration
             reauthorize_after_seconds = datetime.now(tz=UTC).timestamp() + body[
                 "expires_in"] - 5  # add the expiration amount to the timestamp, then subtract 5 seconds to make sure we have a buffer
             reauthorize_dt = datetime.fromtimestamp(reauthorize_after_seconds,
@@ -55,23 +127,98 @@ class HexagonManager():
             body["reauthorize_after"] = reauthorize_dt
             return body
         else:
-            raise PermissionError(f"Couldn't get access token, server returned status code {response.status_code} and message {response.content}")
+            raise PermissionError(f"Couldn't get access token, server returned status code {status_code} and message {content}")
+
+    def _store_token_info(self, token_info):
+        self._token_info = token_info
+        self._reauthorize_after = token_info["reauthorize_after"]  # keep track of when we should reauthorize again in the future.
+
+    @property
+    def _token_expired(self):
+        return datetime.now(UTC) > self._reauthorize_after  # if our existing token is no longer valid, or we don't have one at all
+
+    @property
+    def token_seconds_remaining(self):
+        """
+            Seconds until the current token should no longer be used - 0 if we don't have one
+        """
+        return max(0.0, (self._reauthorize_after - datetime.now(UTC)).total_seconds())
+
+    @staticmethod
+    def _tile_filename(matrix, row, col, extension):
+        return os.path.join(str(matrix), str(row), f"{col}.{extension}")
+
+    def _tile_url(self, matrix, row, col, extension, token):
+        file_url = f"{matrix}/{row}/{col}.{extension}"
+        return self.wmts_url + self.url_params + f"{file_url}&access_token={token}"
+
+    def _write_tile(self, content, matrix, row, col, extension, path=None):
+        if len(content) < config.EMPTY_TILE_MAX_BYTES:
+            print("Likely empty tile")
+        if path is None:
+            path = os.path.join(self.default_folder, self._tile_filename(matrix, row, col, extension))
+
+        os.makedirs(os.path.split(path)[0], exist_ok=True)  # make all the directories needed
+        with open(path, 'wb') as output:
+            output.write(content)  # this isn't really a good way to do this for large files, but is likely fine enough for small ones
+        return path
+
+    def _write_stored_tile(self, matrix, row, col, extension, path=None):
+        """
+            If the tile store has a current copy of the tile, writes it out and returns the path. Otherwise returns None.
+        """
+        key = TileCache.key(matrix, row, col, extension)
+        if self.tile_store is None or not self.tile_store.contains(key):
+            return None
+        stored_tile = self.tile_store.get(key)
+        if stored_tile is None:
+            return None
+        return self._write_tile(stored_tile.content, matrix, row, col, extension, path=path)
+
+    def _store_tile(self, content, media_type, matrix, row, col, extension):
+        if self.tile_store is not None:
+            self.tile_store.put(TileCache.key(matrix, row, col, extension), content, media_type)
+
+
+class HexagonManager(BaseHexagonManager):
+    """
+        Blocking client for Hexagon's services using requests. Fine for scripts and bulk downloads. The web service
+        should use AsyncHexagonManager so it doesn't block the event loop.
+    """
+    def __init__(self, client_id, client_secret, wmts_url=BATCH_WMTS_URL, url_params=PARAMS, token_url=TOKEN_URL, tile_store=None):
+        super().__init__(client_id, client_secret, wmts_url=wmts_url, url_params=url_params, token_url=token_url, tile_store=tile_store)
+        import requests  # only the blocking client needs requests, and it's slow to import - keep it out of the web service's startup
+
+        self.session = requests.Session()
+
+    def _get_token(self):
+        """Internal method - sends the request to a token URL to get the auth token to use, calculates its valid period
+        Raises:
+            PermissionError: if the token server didn't give us a token
+        Returns:
+            dict: the token server's response body, with an added reauthorize_after datetime
+        """
+        import requests
+
+        response = requests.get(self._full_token_url)
+        return self._parse_token_response(response.status_code, response.json, response.content)
 
     @property
     def token(self):
-        if datetime.now(
-                UTC) > self._reauthorize_after:  # if our existing token is no longer valid, or we don't have one at all
-            self._token_info = self._get_token()  # authenticate for a token
-            self._reauthorize_after = self._token_info[
-                "reauthorize_after"]  # keep track of when we should reauthorize again in the future.
+        if self._token_expired:
+            self._store_token_info(self._get_token())  # authenticate for a token
         return self._token_info["access_token"]
 
+    def close(self):
+        self.session.close()
+        super().close()
+
     def get_general_response(self, path, params=None):
         if params is None:
             params = {}
         url = f"{self.wmts_url}{path}"
         merged_params = {"access_token": self.token, **params}  # even if the url has params already in it, these will get attached properly by requests
-        return requests.get(url, params=merged_params)
+        return self.session.get(url, params=merged_params)
 
     def get_tile(self, matrix, row, col, path=None, stream=False, url_only=False, extension="png"):
         """
@@ -84,32 +231,168 @@ class HexagonManager():
             col (_type_): The WMTS column within the tile matrix (ie, x)
             path (str or None): The full output path for the downloaded tile, including tile extension. If None, then a path in Temp will be generated.
         """
-        filename = os.path.join(str(matrix), str(row), f"{col}.{extension}")
-        file_url = f"{matrix}/{row}/{col}.{extension}"
-        url = self.wmts_url + self.url_params + f"{file_url}&access_token={self.token}"
-        print(f"Tile URL, with token: {url}")
+        if not url_only and not stream:  # downloads are served from the tile store when we have them - no token or upstream call needed
+            stored_path = self._write_stored_tile(matrix, row, col, extension, path=path)
+            if stored_path is not None:
+                return stored_path
 
+        url = self._tile_url(matrix, row, col, extension, self.token)
         if url_only:  # this is for when we proxy via redirect
-            print("Returning redirect")
             return url
 
-        response = self.session.get(url) #, stream=stream)
+        response = self.session.get(url, stream=stream)
 
         if response.status_code == 200:
             if stream:  # for when we proxy the whole body
                 response.raise_for_status()
                 return response  # return the whole response when they want to stream it because we'll want to get the response headers
             else:  # for when you want to download tiles only
-                if len(response.content) < 1000:
-                    print("Likely empty tile")
-                if path is None:
-                    path = os.path.join(self.default_folder, filename)
-
-                os.makedirs(os.path.split(path)[0], exist_ok=True)  # make all the directories needed
-                with open(path, 'wb') as output:
-                    output.write(
-                        response.content)  # this isn't really a good way to do this for large files, but is likely fine enough for small ones
-                return path
+                self._store_tile(response.content, response.headers.get("content-type"), matrix, row, col, extension)
+                return self._write_tile(response.content, matrix, row, col, extension, path=path)
         else:
-            raise RuntimeError(
-                f"Server returned alternative status code: {response.status_code}. Included body '{response.content}'")
\ No newline at end of file
+            raise HexagonStatusError(response.status_code, response.content, response.headers)
+
+
+class AsyncHexagonManager(BaseHexagonManager):
+    """
+        Non-blocking client for Hexagon's services. All instances share one pooled httpx client (see get_async_http_client)
+        unless one is passed in, so connections to Hexagon stay warm across credential sets and concurrent requests.
+
+        With a shared_state (a SharedStateStore), tokens are shared with the other processes using the same credentials.
+    """
+    def __init__(self, client_id, client_secret, wmts_url=BATCH_WMTS_URL, url_params=PARAMS, token_url=TOKEN_URL, tile_store=None, http_client=None,
+                 retry_policy=None, shared_state=None):
+        super().__init__(client_id, client_secret, wmts_url=wmts_url, url_params=url_params, token_url=token_url, tile_store=tile_store)
+        self._http_client = http_client
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.token_manager = TokenManager(self._refresh_token)
+        self.shared_state = shared_state
+        if shared_state is not None:  # the same in every process, unlike main's salted hash
+            self._shared_token_name = hashlib.sha256(f"{client_id}:{client_secret}".encode("utf-8")).hexdigest()
+
+    @property
+    def http_client(self):
+        if self._http_client is not None:
+            return self._http_client
+        return get_async_http_client()
+
+    @staticmethod
+    def _append_params(url, params):
+        """
+            httpx replaces a URL's whole query string when given params, but Hexagon's paths live in the query string
+            (after "?/"), so append the params the way requests does instead
+        """
+        if not params:
+            return url
+        return f"{url}{'&' if '?' in url else '?'}{urlencode(params, doseq=True)}"
+
+    async def _send(self, url, headers=None, stream=False, kind="tile"):
+        """
+            Sends a GET upstream with retries and the upstream's circuit breaker - see resilience.send_with_resilience.
+            The time taken (including any retries) is recorded in metrics.UPSTREAM_SECONDS under kind.
+        """
+        start = time.perf_counter()
+        try:
+            response = await send_with_resilience(self.http_client, url, headers=headers, stream=stream, retry_policy=self.retry_policy)
+        except Exception:
+            metrics.UPSTREAM_FAILURES.inc(kind)
+            raise
+        metrics.UPSTREAM_SECONDS.observe(time.perf_counter() - start, kind)
+        return response
+
+    async def _get_token(self):
+        """Internal method - sends the request to a token URL to get the auth token to use, calculates its valid period
+        Raises:
+            PermissionError: if the token server didn't give us a token
+        Returns:
+            dict: the token server's response body, with an added reauthorize_after datetime
+        """
+        response = await self._send(self._full_token_url, kind="token")
+        return self._parse_token_response(response.status_code, response.json, response.content)
+
+    async def _refresh_token(self):
+        if self.shared_state is not None:
+            token_info = await self._get_shared_token()
+        else:
+            token_info = await self._get_token()
+        self._store_token_info(token_info)
+        return token_info
+
+    async def _get_shared_token(self):
+        """
+            Gets a token from another process using these credentials, or requests one and shares it. A shared token is
+            only taken if it lasts longer than the one we have, so renewing doesn't just hand us back our own token.
+        """
+        current_until = self._reauthorize_after.timestamp() if self._token_info is not None else 0
+
+        async def fetch():
+            token_info = await self._get_token()
+            return {"access_token": token_info["access_token"], "reauthorize_after": token_info["reauthorize_after"].timestamp()}
+
+        shared_token = await shared_fetch(self.shared_state, "token", self._shared_token_name, fetch,
+                                          ttl_seconds=lambda token: token["reauthorize_after"] - time.time(),
+                                          accept=lambda token: token["reauthorize_after"] > max(current_until, time.time()))
+        return {"access_token": shared_token["access_token"],
+                "expires_in": max(shared_token["reauthorize_after"] - time.time(), 0),  # what's left of it, so background renewal is scheduled from now
+                "reauthorize_after": datetime.fromtimestamp(shared_token["reauthorize_after"], tz=UTC)}
+
+    async def get_token(self):
+        return await self.token_manager.get_token()  # shares in-flight refreshes and renews in the background before expiry
+
+    def close(self):
+        self.token_manager.close()  # the pooled http client is shared, so it stays open
+        super().close()
+
+    async def get_general_response(self, path, params=None, headers=None, stream=False):
+        """
+            Sends any other WMTS request upstream. As with get_tile, a response requested with stream set hasn't had its
+            body read - read it with response.aiter_bytes() and call response.aclose() when done.
+        """
+        if params is None:
+            params = {}
+        url = f"{self.wmts_url}{path}"
+        merged_params = {"access_token": await self.get_token(), **params}
+        return await self._send(self._append_params(url, merged_params), headers=headers, stream=stream, kind="capabilities")
+
+    async def get_tile(self, matrix, row, col, path=None, stream=False, url_only=False, extension="png"):
+        """
+            Async equivalent of HexagonManager.get_tile - returns the tile URL when url_only is set, the upstream response
+            when stream is set, and otherwise the path the tile was written to.
+
+            When stream is set, the returned response's body has *not* been read yet - iterate it with
+            response.aiter_bytes() and call response.aclose() when done so the connection goes back to the pool.
+        """
+        if not url_only and not stream:  # downloads are served from the tile store when we have them - no token or upstream call needed
+            stored_path = await asyncio.to_thread(self._write_stored_tile, matrix, row, col, extension, path)
+            if stored_path is not None:
+                return stored_path
+
+        url = self._tile_url(matrix, row, col, extension, await self.get_token())
+        if url_only:  # this is for when we proxy via redirect
+            return url
+
+        response = await self._send(url, stream=stream)
+
+        if response.status_code == 200:
+            if stream:  # for when we proxy the whole body
+                return response  # return the whole response when they want to stream it because we'll want to get the response headers
+            else:  # for when you want to download tiles only
+                await asyncio.to_thread(self._store_tile, response.content, response.headers.get("content-type"), matrix, row, col, extension)
+                return await asyncio.to_thread(self._write_tile, response.content, matrix, row, col, extension, path)
+        else:
+            if stream:  # error bodies are small - read it so we can report it, then release the connection
+                await response.aread()
+                await response.aclose()
+            raise HexagonStatusError(response.status_code, response.content, response.headers)
+
+    async def get_tile_content(self, matrix, row, col, extension="png"):
+        """
+            Fetches the tile into memory and returns a (content, media_type) tuple, without writing it anywhere.
+        Raises:
+            HexagonStatusError: if Hexagon doesn't return the tile
+        """
+        url = self._tile_url(matrix, row, col, extension, await self.get_token())
+        response = await self._send(url)
+        if response.status_code != 200:
+            raise HexagonStatusError(response.status_code, response.content, response.headers)
+        return response.content, response.headers.get("content-type")
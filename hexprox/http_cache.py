@@ -0,0 +1,76 @@
+"""
+    HTTP caching headers and conditional request handling, so that browsers and edge caches can absorb repeated requests
+    for the same tiles and documents instead of sending every one of them back to us.
+"""
+
+import hashlib
+from email.utils import formatdate, parsedate_to_datetime
+
+from hexprox import config
+
+
+def entity_tag(content):
+    """
+        Strong ETag for a response body - a short hash of the content, so identical bytes always get the same tag
+    """
+    return f'"{hashlib.blake2b(content, digest_size=12).hexdigest()}"'
+
+
+def http_date(timestamp):
+    return formatdate(timestamp, usegmt=True)
+
+
+def parse_http_date(value):
+    """
+        Returns the HTTP date as a unix timestamp, or None if it's missing or malformed
+    """
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _etag_matches(if_none_match, etag):
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")  # If-None-Match uses weak comparison
+    return any(candidate.strip().removeprefix("W/") == opaque for candidate in if_none_match.split(","))
+
+
+def is_not_modified(request_headers, etag=None, last_modified=None):
+    """
+        Whether a conditional GET can be answered with a 304, given the current ETag and Last-Modified (a unix
+        timestamp) of what we'd send. If-None-Match takes precedence over If-Modified-Since when both are present.
+    """
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag is not None and _etag_matches(if_none_match, etag)
+
+    if_modified_since = request_headers.get("if-modified-since")
+    if if_modified_since is not None and last_modified is not None:
+        since = parse_http_date(if_modified_since)
+        return since is not None and int(last_modified) <= since  # HTTP dates only have whole seconds
+    return False
+
+
+def validator_headers(cache_control, etag=None, last_modified=None):
+    """
+        Returns the Cache-Control, ETag and Last-Modified headers for a response - also what a 304 for it should carry
+    """
+    headers = {"Cache-Control": cache_control}
+    if etag is not None:
+        headers["ETag"] = etag
+    if last_modified is not None:
+        headers["Last-Modified"] = http_date(last_modified)
+    return headers
+
+
+def redirect_cache_control(token_seconds_remaining):
+    """
+        Cache-Control for a redirect to a URL carrying an access token. It must not be cached beyond the token's
+        lifetime, or clients would follow a cached redirect to a URL that no longer works.
+    """
+    max_age = int(min(config.REDIRECT_MAX_AGE_SECONDS, token_seconds_remaining - config.REDIRECT_TOKEN_MARGIN_SECONDS))
+    if max_age <= 0:
+        return "no-store"
+    return f"{config.REDIRECT_CACHE_CONTROL}, max-age={max_age}"
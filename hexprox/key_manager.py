@@ -1,39 +1,196 @@
+import asyncio
 import datetime
+import hashlib
+import inspect
 import json
-import logging
-import random
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING
 
 from fastapi import BackgroundTasks, HTTPException
 from fastapi import Request
 
-try:
-    from azure.core import exceptions as azure_exceptions
+from hexprox import config, metrics
+from hexprox.coalescer import RequestCoalescer
+from hexprox.credential_scheduler import CredentialScheduler
+from hexprox.shared_state import shared_fetch
+
+if TYPE_CHECKING:  # the Azure SDK is slow to import, so it's only loaded once Key Vault is actually used - see LazySecretClient
     from azure.keyvault.secrets import SecretClient
-except:
-    logging.error("Can't import Azure library in key_manager")
-    raise
 
-from hexprox import config
+
+def _is_secret_not_found(error):
+    """
+        Whether the error is Key Vault saying the secret doesn't exist. Checked without importing azure.core - if the
+        error came from the Azure SDK, it's already loaded.
+    """
+    azure_exceptions = sys.modules.get("azure.core.exceptions")
+    return azure_exceptions is not None and isinstance(error, azure_exceptions.ResourceNotFoundError)
+
+
+class LazySecretClient():
+    """
+        Stands in for azure.keyvault.secrets.SecretClient, putting off importing the Azure SDK and building the
+        credential and client until the first secret is requested. APIKeyManager calls get_secret from a worker
+        thread, so that work happens off the event loop. Call load() to do it ahead of time.
+    """
+    def __init__(self, vault_url, managed_identity_client_id):
+        self.vault_url = vault_url
+        self.managed_identity_client_id = managed_identity_client_id
+        self._client = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from azure.identity import ManagedIdentityCredential
+                    from azure.keyvault.secrets import SecretClient
+
+                    credential = ManagedIdentityCredential(client_id=self.managed_identity_client_id)
+                    self._client = SecretClient(vault_url=self.vault_url, credential=credential)
+        return self._client
+
+    def get_secret(self, name):
+        return self.load().get_secret(name)
 
 
 class APIKeyManager:
 
-    def __init__(self):
+    def __init__(self, invalid_key_seconds=config.INVALID_API_KEY_CACHE_SECONDS, invalid_key_max=config.INVALID_API_KEY_CACHE_MAX_KEYS, shared_state=None):
         self.api_keys = {}
+        self.shared_state = shared_state  # optional SharedStateStore - credential sets fetched by one process are reused by the others
 
-    async def refresh_credentials(self, api_key: str, key_vault_client: SecretClient):
-        refresh_time = datetime.datetime.now(tz=datetime.UTC)
-        if refresh_time > self.api_keys[api_key]['last_refreshed'] + datetime.timedelta(minutes=config.REFRESH_CREDENTIAL_INTERVAL_MINUTES):
-            await self._retrieve_credentials(api_key, key_vault_client=key_vault_client)
+        self.invalid_key_seconds = invalid_key_seconds
+        self.invalid_key_max = invalid_key_max
+        self._invalid_keys = OrderedDict()  # api_key: when to stop treating it as invalid, oldest first
+
+        self._key_vault_fetches = RequestCoalescer()  # concurrent lookups of the same key share one Key Vault call
+        self.scheduler = CredentialScheduler()  # decides which credential set serves each request
+
+        self.key_vault_calls = 0
+        self.key_vault_errors = 0
+        self.key_vault_seconds_total = 0.0
+        self.key_vault_seconds_max = 0.0
+        self.cached_lookups = 0
+        self.invalid_key_cache_hits = 0
 
-    async def force_refresh_credentials(self, api_key: str, key_vault_client: SecretClient):
+    async def refresh_credentials(self, api_key: str, key_vault_client: "SecretClient"):
+        refresh_time = datetime.datetime.now(tz=datetime.UTC)
+        credential_set = self.api_keys.get(api_key)
+        if credential_set is not None and refresh_time > credential_set['last_refreshed'] + datetime.timedelta(minutes=config.REFRESH_CREDENTIAL_INTERVAL_MINUTES):
+            try:
+                await self._retrieve_credentials(api_key, key_vault_client=key_vault_client)
+            except Exception as e:
+                if not _is_secret_not_found(e):  # otherwise the key was removed - _fetch_credentials already dropped it
+                    raise
+
+    async def force_refresh_credentials(self, api_key: str, key_vault_client: "SecretClient"):
+        self._invalid_keys.pop(api_key, None)
+        if self.shared_state is not None:  # go to Key Vault, not another process's copy
+            await asyncio.to_thread(self.shared_state.delete, "credentials", self._shared_name(api_key))
         await self._retrieve_credentials(api_key, key_vault_client=key_vault_client)
 
-    async def _retrieve_credentials(self, api_key: str, key_vault_client: SecretClient):
-        self.api_keys[api_key] = json.loads(key_vault_client.get_secret(f"credential-set-{api_key}").value)
+    async def preload(self, api_key: str, key_vault_client: "SecretClient"):
+        """
+            Loads the API key's credential set ahead of its first request. Returns it, or None if Key Vault doesn't
+            have the key.
+        """
+        if api_key not in self.api_keys:
+            try:
+                await self._retrieve_credentials(api_key, key_vault_client=key_vault_client)
+            except Exception as e:
+                if not _is_secret_not_found(e):
+                    raise
+        return self.api_keys.get(api_key)
+
+    async def _retrieve_credentials(self, api_key: str, key_vault_client: "SecretClient"):
+        await self._key_vault_fetches.run(api_key, lambda: self._fetch_credentials(api_key, key_vault_client))
+
+    async def _fetch_credentials(self, api_key: str, key_vault_client: "SecretClient"):
+        try:
+            if self.shared_state is None:
+                secret_value = await self._get_secret_value(api_key, key_vault_client)
+            else:
+                secret_value = await shared_fetch(self.shared_state, "credentials", self._shared_name(api_key),
+                                                  lambda: self._get_secret_value(api_key, key_vault_client),
+                                                  ttl_seconds=config.REFRESH_CREDENTIAL_INTERVAL_MINUTES * 60)
+        except Exception as e:
+            if _is_secret_not_found(e):
+                self.api_keys.pop(api_key, None)
+                self._remember_invalid_key(api_key)
+            raise
+
+        self.api_keys[api_key] = json.loads(secret_value)
         self.api_keys[api_key]['last_refreshed'] = datetime.datetime.now(tz=datetime.UTC)  # mark when we last retrieved these
 
-    async def get_credentials_for_api_key(self, api_key: str, key_vault_client: SecretClient, background_tasks: BackgroundTasks, request: Request) -> dict:
+    async def _get_secret_value(self, api_key: str, key_vault_client: "SecretClient"):
+        self.key_vault_calls += 1
+        start = time.perf_counter()
+        try:
+            secret = await self._get_secret(key_vault_client, f"credential-set-{api_key}")
+        except Exception as e:
+            if not _is_secret_not_found(e):
+                self.key_vault_errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self.key_vault_seconds_total += elapsed
+            self.key_vault_seconds_max = max(self.key_vault_seconds_max, elapsed)
+        return secret.value
+
+    @staticmethod
+    def _shared_name(api_key: str):
+        return hashlib.sha256(api_key.encode("utf-8")).hexdigest()  # keeps the keys themselves out of the shared file
+
+    @staticmethod
+    async def _get_secret(key_vault_client, name):
+        """
+            Uses the async Key Vault client if that's what we were given, otherwise runs the blocking call in a worker
+            thread so it doesn't hold up the event loop
+        """
+        if inspect.iscoroutinefunction(key_vault_client.get_secret):
+            return await key_vault_client.get_secret(name)
+        return await asyncio.to_thread(key_vault_client.get_secret, name)
+
+    def _remember_invalid_key(self, api_key: str):
+        self._invalid_keys[api_key] = time.monotonic() + self.invalid_key_seconds
+        self._invalid_keys.move_to_end(api_key)
+        while len(self._invalid_keys) > self.invalid_key_max:
+            self._invalid_keys.popitem(last=False)
+
+    def _is_known_invalid(self, api_key: str) -> bool:
+        expires_at = self._invalid_keys.get(api_key)
+        if expires_at is None:
+            return False
+        if expires_at < time.monotonic():
+            del self._invalid_keys[api_key]
+            return False
+        return True
+
+    def org_for_api_key(self, api_key: str) -> str:
+        """
+            The org a loaded API key belongs to, from its credential set - "unknown" if the set doesn't say
+        """
+        credential_set = self.api_keys.get(api_key)
+        return credential_set.get("org", "unknown") if type(credential_set) is dict else "unknown"
+
+    def stats(self) -> dict:
+        coalesced = self._key_vault_fetches.coalesced_calls
+        return {
+            "key_vault_calls": self.key_vault_calls,
+            "key_vault_errors": self.key_vault_errors,
+            "key_vault_seconds_total": self.key_vault_seconds_total,
+            "key_vault_seconds_max": self.key_vault_seconds_max,
+            "cached_lookups": self.cached_lookups,
+            "invalid_key_cache_hits": self.invalid_key_cache_hits,
+            "coalesced_lookups": coalesced,
+            "key_vault_calls_avoided": self.cached_lookups + self.invalid_key_cache_hits + coalesced,
+        }
+
+    async def get_credentials_for_api_key(self, api_key: str, key_vault_client: "SecretClient", background_tasks: BackgroundTasks, request: Request) -> dict:
         """
             Credential sets should have the structure of the form:
             {
@@ -47,41 +204,38 @@ class APIKeyManager:
                 "contact": "Contact name"
             }
 
-            This rotates between these sets in a random manner
+            This picks the healthiest, least loaded of these sets for each request - see CredentialScheduler. Wrap the
+            work done with the returned set in self.scheduler.track(credentials) so the scheduler sees its load and outcome
         :param api_key:
         :return:
         """
         try:
             if api_key not in self.api_keys:  # if we haven't already cached the credentials for this API key locally, then do it now
+                if self._is_known_invalid(api_key):  # Key Vault recently told us it doesn't have this key - don't ask again yet
+                    self.invalid_key_cache_hits += 1
+                    raise HTTPException(status_code=403, detail="Invalid API key or API key lacks permissions for this resource")
                 print("retrieving credentials for api key from key vault")
                 await self._retrieve_credentials(api_key, key_vault_client=key_vault_client)
             else:  # if it's already there, schedule a refresh for after the request is complete - it'll only actually refresh at specific intervals.
+                self.cached_lookups += 1
                 background_tasks.add_task(self.refresh_credentials, api_key, key_vault_client)
 
             if api_key not in self.api_keys:  # if it's *still* not there, then the credentials were invalid
                 raise HTTPException(status_code=403, detail="Invalid API key or API key lacks permissions for this resource")
 
             credential_set = self.api_keys[api_key]
-        except azure_exceptions.ResourceNotFoundError:
-            raise HTTPException(status_code=403, detail="Invalid API key, malformed secret data, or API key lacks permissions for this resource")
+        except Exception as e:
+            if _is_secret_not_found(e):
+                raise HTTPException(status_code=403, detail="Invalid API key, malformed secret data, or API key lacks permissions for this resource")
+            raise
 
         if type(credential_set) is not dict or "count" not in credential_set:
             raise HTTPException(status_code=403, detail="Invalid API key, malformed secret data, or API key lacks permissions for this resource")
 
         num_sets = credential_set['count']   # we may store multiple credentials - rather than running a length operation each time, just pull the stored value
-        if num_sets > 1:
-            random.seed() # uses the time by default - this doesn't need to be secure, just trying to distribute credential requests
-            index = random.randint(0, num_sets-1)  # get which set to use - this is inclusive of both ends of the range, but we're going to index a list, so need to drop 1
-        else:
-            index = 0
-
-        # these custom dimensions don't seem to be showing up in the Azure logs with this message.
-        properties = {'custom_dimensions': {'organization_from_key': 'unknown'}}
-        if "org" in credential_set:
-            properties['custom_dimensions']['organization_from_key'] = credential_set['org']
-
-        logging.info(f'Request org {credential_set["org"]}', extra=properties)
+        index = self.scheduler.choose(credential_set['sets'], num_sets)
 
+        metrics.ORG_REQUESTS.inc(credential_set.get("org", "unknown"))  # per-org request counts, in place of the per-request log line whose custom dimensions never showed up in Azure
 
         #logging.debug(f"credential index: {index} of {num_sets} sets")
         return credential_set['sets'][index]
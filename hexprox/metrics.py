@@ -0,0 +1,207 @@
+"""
+    Lightweight in-process metrics, rendered in the Prometheus text exposition format at /metrics.
+
+    Recording is meant to be cheap enough to leave on for every request - a dict lookup, an add, and (for histograms) a
+    bisect into a short list of bucket bounds, under a lock that's effectively never contended. Anything that already
+    keeps its own counters (caches, coalescers, the key manager) isn't instrumented again - register a collector that
+    turns its stats() into samples at scrape time instead.
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+from hexprox import config
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter():
+    """
+        A count that only goes up, optionally split by labels - inc("tile") for a counter with labels=("kind",)
+    """
+    type_name = "counter"
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in values:
+            yield self.name, _format_labels(self.label_names, label_values), value
+
+
+class Histogram():
+    """
+        Distribution of observed values (seconds, by convention) in cumulative buckets, optionally split by labels.
+        Use observe(value, *label_values), or wrap the code to time in time(*label_values).
+    """
+    type_name = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # label values: [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def count(self, *label_values):
+        series = self._series.get(label_values)
+        return 0 if series is None else sum(series[:-1])
+
+    def samples(self):
+        with self._lock:
+            all_series = [(label_values, list(series)) for label_values, series in self._series.items()]
+        for label_values, series in all_series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += count
+                yield f"{self.name}_bucket", _format_labels(self.label_names, label_values, ("le", _format_value(float(bound)))), cumulative
+            yield f"{self.name}_sum", _format_labels(self.label_names, label_values), series[-1]
+            yield f"{self.name}_count", _format_labels(self.label_names, label_values), cumulative
+
+
+class StatsCollector():
+    """
+        Exposes a component's stats() dict as gauges at scrape time, as {prefix}_{stat}. Stats named "hits" and
+        "misses" also get a {prefix}_hit_ratio. Non-numeric stats are skipped.
+    """
+    type_name = "gauge"
+
+    def __init__(self, prefix, stats, description=""):
+        self.name = prefix
+        self.description = description
+        self.stats = stats
+
+    def samples(self):
+        stats = self.stats()
+        for stat, value in stats.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            yield f"{self.name}_{stat}", "", value
+        if "hits" in stats and "misses" in stats:
+            lookups = stats["hits"] + stats["misses"]
+            yield f"{self.name}_hit_ratio", "", stats["hits"] / lookups if lookups else 0.0
+
+
+class MetricsRegistry():
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric  # re-registering a name replaces it, so reloads and tests don't pile up duplicates
+        return metric
+
+    def counter(self, name, description, labels=()):
+        return self.register(Counter(name, description, labels))
+
+    def histogram(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def collect_stats(self, prefix, stats, description=""):
+        return self.register(StatsCollector(prefix, stats, description))
+
+    def render(self):
+        """
+            Returns every metric in the Prometheus text exposition format
+        """
+        lines = []
+        for metric in list(self._metrics.values()):
+            samples = list(metric.samples())
+            if isinstance(metric, StatsCollector):  # each stat is its own gauge
+                for name, labels, value in samples:
+                    lines.append(f"# TYPE {name} gauge")
+                    lines.append(f"{name}{labels} {_format_value(value)}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in samples)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+REQUEST_SECONDS = REGISTRY.histogram("hexprox_request_seconds", "Time to handle a request, through the end of the response body", ("route", "method", "status"))
+UPSTREAM_SECONDS = REGISTRY.histogram("hexprox_upstream_seconds", "Time for Hexagon to respond to a request, up to the response headers", ("kind",))
+UPSTREAM_FAILURES = REGISTRY.counter("hexprox_upstream_failures_total", "Upstream requests that failed without a response", ("kind",))
+TILE_RESPONSES = REGISTRY.counter("hexprox_tile_responses_total", "Tiles served, by how they were served", ("mode",))
+ORG_REQUESTS = REGISTRY.counter("hexprox_org_requests_total", "Requests made with each organization's API keys", ("org",))
+
+
+class MetricsMiddleware():
+    """
+        ASGI middleware recording REQUEST_SECONDS for every HTTP request, labelled with the route's path template (so
+        that API keys, credentials and tile coordinates never end up in label values) rather than the requested path.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not config.METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            REQUEST_SECONDS.observe(time.perf_counter() - start, getattr(route, "path", "unmatched"), scope["method"], str(status))
@@ -0,0 +1,201 @@
+import asyncio
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import httpx
+
+from hexprox import config
+
+
+class CircuitOpenError(RuntimeError):
+    """
+        Raised instead of calling an upstream whose circuit breaker is open because it has been failing
+    """
+    def __init__(self, name, retry_after):
+        self.retry_after = retry_after
+        super().__init__(f"Upstream {name} is failing - not sending requests for another {retry_after:.0f} seconds")
+
+
+def parse_retry_after(value):
+    """
+        Returns the Retry-After header value as seconds, or None if it's missing or not a number of seconds (we don't
+        bother with the HTTP-date form)
+    """
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy():
+    """
+        How many times to try an upstream request and how long to wait in between - exponential backoff with full
+        jitter, or Hexagon's Retry-After if it sent one. If Retry-After asks for longer than max_retry_after, we don't
+        hold the request that long and return the response as-is instead.
+    """
+    def __init__(self, max_attempts=config.UPSTREAM_RETRY_ATTEMPTS, base_delay=config.UPSTREAM_RETRY_BASE_DELAY_SECONDS,
+                 max_delay=config.UPSTREAM_RETRY_MAX_DELAY_SECONDS, max_retry_after=config.UPSTREAM_MAX_RETRY_AFTER_SECONDS,
+                 retry_statuses=config.UPSTREAM_RETRY_STATUSES):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.retry_statuses = retry_statuses
+
+    def delay(self, attempt, retry_after=None):
+        """
+            Seconds to wait before retrying after the given (zero-based) attempt failed
+        """
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        if retry_after is not None:
+            return max(retry_after, backoff)
+        return backoff
+
+    def should_retry(self, attempt, retry_after=None):
+        return attempt + 1 < self.max_attempts and (retry_after is None or retry_after <= self.max_retry_after)
+
+
+NO_RETRIES = RetryPolicy(max_attempts=1)
+
+
+class CircuitBreaker():
+    """
+        Stops sending requests to an upstream that keeps failing. After failure_threshold consecutive failures (server
+        errors or connection problems - not 429s or 4xx) the breaker opens and requests fail immediately with
+        CircuitOpenError. Once reset_seconds have passed, one trial request is let through - if it succeeds the
+        breaker closes again, otherwise it stays open for another reset_seconds. A trial that never finishes (cancelled,
+        or failed with something other than a connection error) doesn't hold the breaker half open - the next request
+        after it, or after another reset_seconds if it's somehow still outstanding, becomes the trial instead.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold=config.CIRCUIT_BREAKER_FAILURE_THRESHOLD, reset_seconds=config.CIRCUIT_BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_started = 0.0
+        self._lock = threading.Lock()
+
+        self.times_opened = 0
+        self.rejected = 0
+
+    def before_request(self):
+        """
+            Raises CircuitOpenError if the request shouldn't be sent
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            now = time.monotonic()
+            if self.state == self.HALF_OPEN:
+                remaining = self._trial_started + self.reset_seconds - now
+            else:
+                remaining = self._opened_at + self.reset_seconds - now
+            if remaining <= 0:
+                self.state = self.HALF_OPEN  # let this one request through as a trial
+                self._trial_started = now
+                return
+            self.rejected += 1
+            raise CircuitOpenError(self.name, max(remaining, 1))
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self.state = self.CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.times_opened += 1
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def abandon_trial(self):
+        """
+            For a request that ended without telling us anything about the upstream. If it was the trial, the next
+            request gets to be the trial instead.
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN  # _opened_at is already past the reset period
+
+
+_BREAKERS = {}
+
+
+def breaker_for(url):
+    """
+        Returns the circuit breaker for the upstream the URL belongs to - the host plus path, ignoring the query string,
+        so the token server and the WMTS service trip separately
+    """
+    parts = urlsplit(url)
+    name = f"{parts.netloc}{parts.path}"
+    breaker = _BREAKERS.get(name)
+    if breaker is None:
+        breaker = _BREAKERS.setdefault(name, CircuitBreaker(name))
+    return breaker
+
+
+def breaker_stats():
+    """
+        Totals across every upstream's circuit breaker, for the metrics endpoint
+    """
+    breakers = list(_BREAKERS.values())
+    return {
+        "breakers": len(breakers),
+        "open": sum(1 for breaker in breakers if breaker.state == CircuitBreaker.OPEN),
+        "half_open": sum(1 for breaker in breakers if breaker.state == CircuitBreaker.HALF_OPEN),
+        "times_opened": sum(breaker.times_opened for breaker in breakers),
+        "rejected": sum(breaker.rejected for breaker in breakers),
+    }
+
+
+async def send_with_resilience(http_client, url, headers=None, stream=False, retry_policy=None, breaker=None):
+    """
+        Sends a GET upstream, retrying connection errors and retryable statuses according to the retry policy, and
+        failing fast with CircuitOpenError while the upstream's circuit breaker is open. Returns the last response
+        whatever its status - callers decide what a non-200 means.
+    """
+    retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+    breaker = breaker if breaker is not None else breaker_for(url)
+
+    attempt = 0
+    while True:
+        breaker.before_request()
+        try:
+            response = await http_client.send(http_client.build_request("GET", url, headers=headers), stream=stream)
+        except httpx.TransportError:
+            breaker.record_failure()
+            if not retry_policy.should_retry(attempt):
+                raise
+            await asyncio.sleep(retry_policy.delay(attempt))
+            attempt += 1
+            continue
+        except BaseException:  # cancelled, or failed before reaching the upstream
+            breaker.abandon_trial()
+            raise
+
+        if response.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+
+        if response.status_code in retry_policy.retry_statuses:
+            retry_after = parse_retry_after(response.headers.get("retry-after"))
+            if retry_policy.should_retry(attempt, retry_after):
+                if stream:
+                    await response.aclose()
+                await asyncio.sleep(retry_policy.delay(attempt, retry_after))
+                attempt += 1
+                continue
+        return response
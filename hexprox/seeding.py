@@ -0,0 +1,274 @@
+"""
+    Bulk tile seeding - downloads every tile in an area and zoom range into a tile store so that caches can be warmed
+    before they're needed (for example, ahead of an emergency response surge).
+
+    Library use:
+        client = AsyncHexagonManager(client_id, client_secret)
+        store = SQLiteTileStore(path="tiles.mbtiles")
+        seeder = TileSeeder(client, store, checkpoint_path="tiles.checkpoint.json")
+        stats = await seeder.seed(tiles_for_bbox((-122.6, 37.6, -122.3, 37.9), range(10, 16)))
+
+    Command line:
+        python -m hexprox.seeding --bbox -122.6 37.6 -122.3 37.9 --zooms 10 15 --store tiles.mbtiles
+
+    Credentials come from --client-id/--client-secret or the HEXAGON_CLIENT_ID/HEXAGON_CLIENT_SECRET environment variables.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import os
+import time
+
+from hexprox import config, hexagon
+from hexprox.hexagon import AsyncHexagonManager, HexagonStatusError, BATCH_WMTS_URL, STREAMING_WMTS_URL
+from hexprox.resilience import NO_RETRIES
+from hexprox.tile_cache import TileCache
+from hexprox.tile_store import SQLiteTileStore
+
+MAX_LATITUDE = 85.0511287798  # WebMercator's limit
+
+
+def lonlat_to_tile(lon, lat, zoom):
+    """
+        Returns the (row, col) of the WebMercator tile containing the point at the zoom level
+    """
+    lat = min(max(lat, -MAX_LATITUDE), MAX_LATITUDE)
+    n = 2 ** zoom
+    col = int((lon + 180.0) / 360.0 * n)
+    row = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(row, 0), n - 1), min(max(col, 0), n - 1)
+
+
+def tiles_for_bbox(bbox, zooms):
+    """
+        Yields (matrix, row, col) for every tile covering the bbox (min_lon, min_lat, max_lon, max_lat) at each zoom, in
+        a stable order so that checkpoints can refer to positions in it.
+    """
+    min_lon, min_lat, max_lon, max_lat = bbox
+    for zoom in zooms:
+        min_row, min_col = lonlat_to_tile(min_lon, max_lat, zoom)  # rows count down from the north
+        max_row, max_col = lonlat_to_tile(max_lon, min_lat, zoom)
+        for row in range(min_row, max_row + 1):
+            for col in range(min_col, max_col + 1):
+                yield zoom, row, col
+
+
+class AdaptiveConcurrency():
+    """
+        Limits how many fetches run at once, backing off when Hexagon throttles us. The limit halves on every 429 (and
+        all new fetches pause for the Retry-After period), then creeps back up by one after each increase_after
+        consecutive successes, so we settle just under whatever rate Hexagon will accept.
+    """
+    def __init__(self, max_limit, min_limit=1, increase_after=config.SEED_INCREASE_AFTER_SUCCESSES):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.increase_after = increase_after
+
+        self.limit = max_limit
+        self.in_flight = 0
+        self._successes = 0
+        self._paused_until = 0.0
+        self._condition = asyncio.Condition()
+
+        self.throttled = 0
+
+    async def __aenter__(self):
+        while True:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            async with self._condition:
+                if self.in_flight < self.limit:
+                    self.in_flight += 1
+                    return self
+                await self._condition.wait()  # then check the pause again, since a throttle may have happened while we waited
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def succeeded(self):
+        self._successes += 1
+        if self._successes >= self.increase_after and self.limit < self.max_limit:
+            self.limit += 1
+            self._successes = 0
+
+    def throttle(self, retry_after=None):
+        self.throttled += 1
+        self._successes = 0
+        self.limit = max(self.min_limit, self.limit // 2)
+        pause = retry_after if retry_after is not None else config.SEED_DEFAULT_RETRY_AFTER_SECONDS
+        self._paused_until = max(self._paused_until, time.monotonic() + pause)
+
+
+class TileSeeder():
+    """
+        Fetches tiles concurrently into a tile store.
+
+        Tiles already in the store are skipped. If checkpoint_path is set, progress through the tile list is saved there
+        as the position before which every tile is done, along with the tiles that failed. An interrupted job can be
+        rerun with the same arguments to retry the failures and pick up where it left off.
+    """
+    def __init__(self, client, store, extension="jpg", max_workers=config.SEED_MAX_WORKERS, max_attempts=config.SEED_MAX_ATTEMPTS,
+                 checkpoint_path=None, checkpoint_every=config.SEED_CHECKPOINT_EVERY, job=None):
+        self.client = client
+        self.store = store
+        self.extension = extension
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.job = job  # description of the job, saved in the checkpoint so we only resume the same job
+
+        self.concurrency = AdaptiveConcurrency(max_workers)
+        self.fetched = 0
+        self.skipped = 0
+        self.failed = []  # tiles that have failed and not been fetched since, including a resumed job's earlier failures
+
+        self._completed_through = 0  # every tile before this position in the list is done
+        self._done_ahead = set()  # positions past _completed_through that are done
+        self._since_checkpoint = 0
+
+    def _load_checkpoint(self):
+        """
+            Returns the position to resume from and the tiles that failed last time
+        """
+        if self.checkpoint_path is None or not os.path.exists(self.checkpoint_path):
+            return 0, []
+        with open(self.checkpoint_path, "r") as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        if checkpoint.get("job") != self.job or checkpoint.get("extension") != self.extension:
+            logging.warning(f"Checkpoint at {self.checkpoint_path} is for a different job - starting from the beginning")
+            return 0, []
+        return checkpoint["completed_through"], checkpoint.get("failed", [])
+
+    def _save_checkpoint(self):
+        if self.checkpoint_path is None:
+            return
+        temp_path = f"{self.checkpoint_path}.tmp"
+        with open(temp_path, "w") as checkpoint_file:
+            json.dump({"job": self.job, "extension": self.extension, "completed_through": self._completed_through,
+                       "fetched": self.fetched, "skipped": self.skipped, "failed": self.failed}, checkpoint_file)
+        os.replace(temp_path, self.checkpoint_path)  # so an interruption mid-write can't corrupt the checkpoint
+        self._since_checkpoint = 0
+
+    def _mark_done(self, position):
+        if position is None:  # a retry of a previous run's failure - it isn't part of this run's list
+            return
+        self._done_ahead.add(position)
+        while self._completed_through in self._done_ahead:
+            self._done_ahead.remove(self._completed_through)
+            self._completed_through += 1
+        self._since_checkpoint += 1
+        if self._since_checkpoint >= self.checkpoint_every:
+            self._save_checkpoint()
+
+    async def _fetch(self, matrix, row, col):
+        key = TileCache.key(matrix, row, col, self.extension)
+        if self.store.contains(key):
+            self.skipped += 1
+            return
+
+        for attempt in range(1, self.max_attempts + 1):
+            async with self.concurrency:
+                try:
+                    content, media_type = await self.client.get_tile_content(matrix, row, col, extension=self.extension)
+                except HexagonStatusError as e:
+                    if e.status_code == 429 and attempt < self.max_attempts:
+                        self.concurrency.throttle(e.retry_after)
+                        continue
+                    raise
+            self.concurrency.succeeded()
+            await asyncio.to_thread(self.store.put, key, content, media_type)
+            self.fetched += 1
+            return
+
+    async def _worker(self, tiles):
+        for position, (matrix, row, col) in tiles:
+            try:
+                await self._fetch(matrix, row, col)
+            except Exception as e:  # record it and move on - one bad tile shouldn't stop the job
+                logging.warning(f"Failed to seed tile {matrix}/{row}/{col}: {e}")
+                if position is not None:  # retries are already listed
+                    self.failed.append([matrix, row, col])
+            else:
+                if position is None:
+                    self.failed.remove([matrix, row, col])
+            self._mark_done(position)
+
+    async def seed(self, tiles):
+        """
+            Fetches every (matrix, row, col) in tiles into the store. Returns a summary of what was done.
+        """
+        start_position, previous_failures = self._load_checkpoint()
+        self._completed_through = start_position
+        self.failed = [list(tile) for tile in previous_failures]  # kept until they succeed, so an interruption before they're retried doesn't lose them
+        retries = ((None, tuple(tile)) for tile in previous_failures)
+        remaining = itertools.chain(retries, itertools.islice(enumerate(tiles), start_position, None))  # shared by the workers, so each tile is taken once
+
+        workers = [asyncio.create_task(self._worker(remaining)) for _ in range(self.max_workers)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            self._save_checkpoint()
+        return self.stats(resumed_from=start_position)
+
+    def stats(self, resumed_from=0):
+        return {
+            "resumed_from": resumed_from,
+            "completed_through": self._completed_through,
+            "fetched": self.fetched,
+            "skipped": self.skipped,
+            "failed": len(self.failed),
+            "throttled": self.concurrency.throttled,
+            "concurrency": self.concurrency.limit,
+        }
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(prog="python -m hexprox.seeding", description="Download Hexagon tiles for an area and zoom range into a local tile store")
+    parser.add_argument("--bbox", nargs=4, type=float, required=True, metavar=("MIN_LON", "MIN_LAT", "MAX_LON", "MAX_LAT"))
+    parser.add_argument("--zooms", nargs=2, type=int, required=True, metavar=("MIN_ZOOM", "MAX_ZOOM"), help="inclusive zoom range")
+    parser.add_argument("--store", required=True, help="path to the SQLite tile store to fill")
+    parser.add_argument("--extension", default="jpg", choices=["jpg", "png"])
+    parser.add_argument("--workers", type=int, default=config.SEED_MAX_WORKERS, help="maximum concurrent downloads")
+    parser.add_argument("--checkpoint", default=None, help="checkpoint file - defaults to the store path plus .checkpoint.json")
+    parser.add_argument("--streaming", action="store_true", help="use the streaming WMTS service rather than the batch (orders) service")
+    parser.add_argument("--client-id", default=os.environ.get("HEXAGON_CLIENT_ID"))
+    parser.add_argument("--client-secret", default=os.environ.get("HEXAGON_CLIENT_SECRET"))
+    parsed = parser.parse_args(args)
+    if not parsed.client_id or not parsed.client_secret:
+        parser.error("Hexagon credentials are required - pass --client-id/--client-secret or set HEXAGON_CLIENT_ID/HEXAGON_CLIENT_SECRET")
+    return parsed
+
+
+async def run(args):
+    client = AsyncHexagonManager(args.client_id, args.client_secret, wmts_url=STREAMING_WMTS_URL if args.streaming else BATCH_WMTS_URL,
+                                 retry_policy=NO_RETRIES)  # the seeder does its own 429 handling, and needs to see every one to adapt
+    store = SQLiteTileStore(path=args.store, ttl_seconds=config.TILE_STORE_TTL_SECONDS, max_bytes=config.TILE_STORE_MAX_BYTES)
+    job = {"bbox": args.bbox, "zooms": args.zooms}
+    seeder = TileSeeder(client, store, extension=args.extension, max_workers=args.workers,
+                        checkpoint_path=args.checkpoint or f"{args.store}.checkpoint.json", job=job)
+    try:
+        return await seeder.seed(tiles_for_bbox(args.bbox, range(args.zooms[0], args.zooms[1] + 1)))
+    finally:
+        client.close()
+        store.close()
+        await hexagon.close_async_http_client()
+
+
+def main(args=None):
+    stats = asyncio.run(run(parse_args(args)))
+    print(json.dumps(stats, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+    State shared between the worker processes of a standalone deployment (see hexprox/standalone.py), so that each
+    Hexagon token and Key Vault credential set is fetched by one worker and reused by the rest instead of once per worker.
+
+    The backend is a small SQLite database in WAL mode - put it on a RAM-backed filesystem like /dev/shm, where its
+    pages are shared memory between the workers. Values are JSON with an expiry. Leases let one worker fetch a value
+    while the others wait for it (see shared_fetch).
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from hexprox import config
+
+
+class SharedStateStore():
+    """
+        Expiring JSON values in namespaces, plus leases, in a SQLite file that any number of processes can open. The
+        file holds tokens and client credentials, so it's created readable by its owner only.
+    """
+    def __init__(self, path=config.SHARED_STATE_PATH):
+        self.path = path
+        self.holder = uuid.uuid4().hex  # identifies this process's leases
+
+        folder = os.path.dirname(os.path.abspath(path))
+        os.makedirs(folder, exist_ok=True)
+        if not os.path.exists(path):
+            os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o600))
+
+        self._local = threading.local()
+
+        self.hits = 0
+        self.misses = 0
+        self.lease_waits = 0
+
+        connection = self._connection
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("""CREATE TABLE IF NOT EXISTS shared_values (
+                                namespace TEXT NOT NULL,
+                                name TEXT NOT NULL,
+                                value TEXT NOT NULL,
+                                expires_at REAL NOT NULL,
+                                PRIMARY KEY (namespace, name))""")
+        connection.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL NOT NULL)")
+        connection.commit()
+
+    @property
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)  # autocommit - each statement stands alone
+            connection.execute("PRAGMA synchronous=NORMAL")  # the contents can all be fetched again, so durability doesn't matter
+            self._local.connection = connection
+        return connection
+
+    def get(self, namespace, name):
+        """
+            Returns the value, or None if there isn't one or it has expired
+        """
+        result = self._connection.execute("SELECT value FROM shared_values WHERE namespace=? AND name=? AND expires_at>?",
+                                          (namespace, name, time.time())).fetchone()
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(result[0])
+
+    def put(self, namespace, name, value, ttl_seconds):
+        self._connection.execute("INSERT OR REPLACE INTO shared_values (namespace, name, value, expires_at) VALUES (?, ?, ?, ?)",
+                                 (namespace, name, json.dumps(value), time.time() + ttl_seconds))
+
+    def delete(self, namespace, name):
+        self._connection.execute("DELETE FROM shared_values WHERE namespace=? AND name=?", (namespace, name))
+
+    def acquire_lease(self, name, seconds=config.SHARED_STATE_LEASE_SECONDS):
+        """
+            Takes the named lease for this process if nobody holds it (or their lease ran out). Returns whether we got it.
+        """
+        now = time.time()
+        cursor = self._connection.execute("""INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?)
+                                             ON CONFLICT (name) DO UPDATE SET holder=excluded.holder, expires_at=excluded.expires_at
+                                             WHERE leases.expires_at<=? OR leases.holder=excluded.holder""",
+                                          (name, self.holder, now + seconds, now))
+        return cursor.rowcount == 1
+
+    def release_lease(self, name):
+        self._connection.execute("DELETE FROM leases WHERE name=? AND holder=?", (name, self.holder))
+
+    def purge_expired(self):
+        now = time.time()
+        removed = self._connection.execute("DELETE FROM shared_values WHERE expires_at<=?", (now,)).rowcount
+        self._connection.execute("DELETE FROM leases WHERE expires_at<=?", (now,))
+        return removed
+
+    def close(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "lease_waits": self.lease_waits,
+        }
+
+
+async def shared_fetch(store, namespace, name, fetch, ttl_seconds, accept=None):
+    """
+        Returns the value another worker stored under namespace/name if there is one (and accept(value) allows it),
+        otherwise awaits fetch() and stores its result for the others for ttl_seconds (or ttl_seconds(value), if
+        callable). Only the worker holding the name's lease fetches; the rest poll for its result for up to
+        SHARED_STATE_WAIT_SECONDS, then fetch for themselves.
+    """
+    async def stored_value():
+        value = await asyncio.to_thread(store.get, namespace, name)
+        return value if value is not None and (accept is None or accept(value)) else None
+
+    value = await stored_value()
+    if value is not None:
+        return value
+
+    lease = f"{namespace}:{name}"
+    deadline = time.monotonic() + config.SHARED_STATE_WAIT_SECONDS
+    leased = await asyncio.to_thread(store.acquire_lease, lease)
+    while not leased and time.monotonic() < deadline:  # another worker is fetching it - wait for its result
+        store.lease_waits += 1
+        await asyncio.sleep(config.SHARED_STATE_POLL_SECONDS)
+        value = await stored_value()
+        if value is not None:
+            return value
+        leased = await asyncio.to_thread(store.acquire_lease, lease)
+
+    try:
+        if leased:
+            value = await stored_value()  # the previous holder may have stored it just before releasing
+            if value is not None:
+                return value
+        value = await fetch()
+        await asyncio.to_thread(store.put, namespace, name, value, ttl_seconds(value) if callable(ttl_seconds) else ttl_seconds)
+        return value
+    finally:
+        if leased:
+            await asyncio.to_thread(store.release_lease, lease)
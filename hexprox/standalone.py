@@ -0,0 +1,66 @@
+"""
+    Runs HexProx outside Azure Functions, as several uvicorn worker processes behind one port:
+
+        python -m hexprox.standalone --workers 4 --port 8000
+
+    The workers share Hexagon tokens and Key Vault credential sets through a shared state file (see
+    hexprox/shared_state.py) and tiles through one tile store, so adding workers adds throughput without adding token
+    or Key Vault calls. KEY_VAULT_NAME and MANAGED_IDENTITY_CLIENT_ID need to be set as for the Azure deployment.
+
+    Under gunicorn, set the environment variables this sets yourself:
+
+        HEXPROX_SHARED_STATE_PATH=/dev/shm/hexprox/shared-state.db HEXPROX_TILE_STORE_PATH=/var/cache/hexprox/tiles.mbtiles \\
+            gunicorn -k uvicorn.workers.UvicornWorker -w 4 -b 0.0.0.0:8000 main:app
+"""
+
+import argparse
+import os
+import tempfile
+
+from hexprox.shared_state import SharedStateStore
+from hexprox.tile_store import SQLiteTileStore
+
+
+def default_shared_state_path():
+    folder = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()  # RAM backed where we can
+    return os.path.join(folder, "hexprox", "shared-state.db")
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(prog="python -m hexprox.standalone", description="Run HexProx with several worker processes sharing tokens, credentials and tiles")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--shared-state", default=os.environ.get("HEXPROX_SHARED_STATE_PATH") or default_shared_state_path(),
+                        help="file the workers share tokens and credential sets through")
+    parser.add_argument("--tile-store", default=os.environ.get("HEXPROX_TILE_STORE_PATH") or os.path.join(tempfile.gettempdir(), "hexprox", "tiles.mbtiles"),
+                        help="tile store the workers share")
+    parser.add_argument("--no-tile-store", action="store_true", help="don't keep tiles beyond each worker's memory cache")
+    parser.add_argument("--log-level", default="info")
+    return parser.parse_args(args)
+
+
+def prepare_environment(options):
+    """
+        Creates the shared files before the workers start, so they don't race to create the tables, and points the
+        workers at them. Returns the environment variables set.
+    """
+    SharedStateStore(path=options.shared_state).close()
+    environment = {"HEXPROX_SHARED_STATE_PATH": options.shared_state}
+    if not options.no_tile_store:
+        SQLiteTileStore(path=options.tile_store).close()
+        environment["HEXPROX_TILE_STORE_PATH"] = options.tile_store
+    os.environ.update(environment)  # the workers read these when they import hexprox.config
+    return environment
+
+
+def main(args=None):
+    import uvicorn
+
+    options = parse_args(args)
+    prepare_environment(options)
+    uvicorn.run("main:app", host=options.host, port=options.port, workers=options.workers, log_level=options.log_level)
+
+
+if __name__ == "__main__":
+    main()
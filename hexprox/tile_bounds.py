@@ -0,0 +1,152 @@
+"""
+    Which tiles exist, per zoom level, as read from the WMTS capabilities document - so that requests for tiles outside
+    the tile matrix (or outside the layer's coverage) can be turned away without a token or an upstream call.
+"""
+
+import math
+import time
+import xml.etree.ElementTree as ElementTree
+
+from hexprox import config
+
+WMTS_NAMESPACE = "{http://www.opengis.net/wmts/1.0}"
+OWS_NAMESPACE = "{http://www.opengis.net/ows/1.1}"
+
+
+def _zoom(identifier):
+    """
+        TileMatrix identifiers are usually the zoom level itself, but some servers prefix it ("EPSG:3857:5")
+    """
+    try:
+        return int(identifier.rsplit(":", 1)[-1])
+    except ValueError:
+        return None
+
+
+def _tile_col(lon, zoom):
+    return math.floor((lon + 180) / 360 * 2 ** zoom)
+
+
+def _tile_row(lat, zoom):
+    lat = math.radians(max(min(lat, 85.0511287798), -85.0511287798))
+    return math.floor((1 - math.log(math.tan(lat) + 1 / math.cos(lat)) / math.pi) / 2 * 2 ** zoom)
+
+
+def parse_tile_limits(content, layer=config.TILE_BOUNDS_LAYER, tile_matrix_set=config.TILE_BOUNDS_TILE_MATRIX_SET):
+    """
+        Returns {zoom: (min_row, max_row, min_col, max_col)} for the layer in the tile matrix set, from a WMTS capabilities
+        document. Each zoom's range is the matrix's size, narrowed by the layer's TileMatrixSetLimits and its
+        WGS84BoundingBox where the document has them. Returns an empty dict if the document doesn't describe the layer.
+    """
+    root = ElementTree.fromstring(content)
+    contents = root.find(f"{WMTS_NAMESPACE}Contents")
+    if contents is None:
+        return {}
+
+    limits = {}
+    for matrix_set in contents.iter(f"{WMTS_NAMESPACE}TileMatrixSet"):
+        if matrix_set.findtext(f"{OWS_NAMESPACE}Identifier") != tile_matrix_set:
+            continue
+        for matrix in matrix_set.iter(f"{WMTS_NAMESPACE}TileMatrix"):
+            zoom = _zoom(matrix.findtext(f"{OWS_NAMESPACE}Identifier", ""))
+            if zoom is not None:
+                limits[zoom] = (0, int(matrix.findtext(f"{WMTS_NAMESPACE}MatrixHeight")) - 1, 0, int(matrix.findtext(f"{WMTS_NAMESPACE}MatrixWidth")) - 1)
+
+    layer_element = next((element for element in contents.iter(f"{WMTS_NAMESPACE}Layer") if element.findtext(f"{OWS_NAMESPACE}Identifier") == layer), None)
+    if layer_element is None or not limits:
+        return {}
+
+    for link in layer_element.iter(f"{WMTS_NAMESPACE}TileMatrixSetLink"):
+        if link.findtext(f"{WMTS_NAMESPACE}TileMatrixSet") != tile_matrix_set:
+            continue
+        for matrix_limits in link.iter(f"{WMTS_NAMESPACE}TileMatrixLimits"):
+            zoom = _zoom(matrix_limits.findtext(f"{WMTS_NAMESPACE}TileMatrix", ""))
+            if zoom in limits:
+                limits[zoom] = _intersect(limits[zoom], tuple(int(matrix_limits.findtext(f"{WMTS_NAMESPACE}{name}"))
+                                                              for name in ("MinTileRow", "MaxTileRow", "MinTileCol", "MaxTileCol")))
+
+    bounding_box = layer_element.find(f"{OWS_NAMESPACE}WGS84BoundingBox")
+    if bounding_box is not None:  # coverage extent - rounded outwards, so edge tiles are always allowed
+        min_lon, min_lat = (float(value) for value in bounding_box.findtext(f"{OWS_NAMESPACE}LowerCorner").split())
+        max_lon, max_lat = (float(value) for value in bounding_box.findtext(f"{OWS_NAMESPACE}UpperCorner").split())
+        for zoom in limits:
+            limits[zoom] = _intersect(limits[zoom], (_tile_row(max_lat, zoom), _tile_row(min_lat, zoom), _tile_col(min_lon, zoom), _tile_col(max_lon, zoom)))
+    return limits
+
+
+def _intersect(first, second):
+    return max(first[0], second[0]), min(first[1], second[1]), max(first[2], second[2]), min(first[3], second[3])
+
+
+class TileBoundsIndex():
+    """
+        The valid row and column ranges per zoom level, so a tile request can be checked with a dict lookup and four
+        comparisons. Until it has been built from a capabilities document every tile is allowed.
+
+        The index is replaced whole by update, so checks never see a half-built one. start_refresh says when it should be
+        rebuilt from a fresh capabilities document - every refresh_seconds, or retry_seconds after a failed attempt.
+        A refresh_seconds of 0 turns that off, leaving update to be called whenever capabilities come in anyway.
+    """
+    def __init__(self, refresh_seconds=config.TILE_BOUNDS_REFRESH_SECONDS, retry_seconds=config.TILE_BOUNDS_RETRY_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self.retry_seconds = retry_seconds
+
+        self._limits = None
+        self._source = None  # the document the index was built from
+        self._refresh_at = time.monotonic()
+        self._refreshing = False
+
+        self.updates = 0
+        self.rejected = 0
+
+    def contains(self, matrix, row, col):
+        """
+            Whether the tile exists. None if we don't know yet.
+        """
+        limits = self._limits
+        if limits is None:
+            return None
+        zoom_limits = limits.get(matrix)
+        inside = zoom_limits is not None and zoom_limits[0] <= row <= zoom_limits[1] and zoom_limits[2] <= col <= zoom_limits[3]
+        if not inside:
+            self.rejected += 1
+        return inside
+
+    def update(self, content):
+        """
+            Rebuilds the index from a capabilities document. Documents that don't describe the layer are ignored.
+            Returns whether the index is now built from this document.
+        """
+        if content == self._source:  # unchanged since the last update - no need to parse it again
+            return True
+        try:
+            limits = parse_tile_limits(content)
+        except (ElementTree.ParseError, TypeError, ValueError, AttributeError):  # malformed document - keep what we have
+            return False
+        if not limits:
+            return False
+        self._limits = limits
+        self._source = content
+        self.updates += 1
+        return True
+
+    def start_refresh(self):
+        """
+            Returns True if a refresh is due and nothing else is refreshing - the caller should then rebuild the index
+            and call finish_refresh
+        """
+        if self.refresh_seconds <= 0 or self._refreshing or time.monotonic() < self._refresh_at:
+            return False
+        self._refreshing = True
+        return True
+
+    def finish_refresh(self, succeeded):
+        self._refreshing = False
+        self._refresh_at = time.monotonic() + (self.refresh_seconds if succeeded else self.retry_seconds)
+
+    def stats(self):
+        return {
+            "zoom_levels": len(self._limits) if self._limits is not None else 0,
+            "updates": self.updates,
+            "rejected": self.rejected,
+        }
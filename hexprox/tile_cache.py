@@ -0,0 +1,121 @@
+import threading
+import time
+from collections import OrderedDict
+
+from hexprox import config
+from hexprox.http_cache import entity_tag
+
+
+class CachedTile():
+    __slots__ = ("content", "media_type", "expires_at", "fetched_at", "_etag")
+
+    def __init__(self, content, media_type, expires_at, fetched_at=None):
+        self.content = content
+        self.media_type = media_type
+        self.expires_at = expires_at
+        self.fetched_at = fetched_at if fetched_at is not None else time.time()  # wall clock, for Last-Modified
+        self._etag = None
+
+    @property
+    def etag(self):
+        if self._etag is None:  # only hashed once a response needs it, then kept for as long as the tile is cached
+            self._etag = entity_tag(self.content)
+        return self._etag
+
+
+class TileCache():
+    """
+        In-memory LRU cache of tile bodies, bounded by the total number of bytes it holds rather than a count of tiles.
+        Keys are (matrix, row, col, ext) - the imagery is the same no matter which credential set fetched it, so a single
+        cache is shared across all clients. Entries also expire after ttl_seconds so that imagery updates eventually show up.
+    """
+    def __init__(self, max_bytes=config.TILE_CACHE_MAX_BYTES, ttl_seconds=config.TILE_CACHE_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+
+        self._tiles = OrderedDict()  # oldest used at the front, most recently used at the back
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.stale_hits = 0
+
+    @staticmethod
+    def key(matrix, row, col, ext):
+        return int(matrix), int(row), int(col), ext
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get(self, key, allow_stale=False):
+        """
+            Returns the CachedTile for the key, or None if we don't have it (or it has expired). Expired tiles stay in
+            the cache until they're replaced or evicted, so they can still be served with allow_stale when upstream is failing.
+        """
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is None:
+                self.misses += 1
+                return None
+            if tile.expires_at < time.monotonic():
+                if not allow_stale:
+                    self.expirations += 1
+                    self.misses += 1
+                    return None
+                self.stale_hits += 1
+            else:
+                self.hits += 1
+
+            self._tiles.move_to_end(key)
+            return tile
+
+    def put(self, key, content, media_type):
+        """
+            Stores the tile body, evicting the least recently used tiles until it fits. Tiles larger than the whole
+            budget are skipped.
+        """
+        size = len(content)
+        if size > self.max_bytes:
+            return False
+
+        with self._lock:
+            if key in self._tiles:
+                self._remove(key)
+            while self.current_bytes + size > self.max_bytes:
+                self._remove(next(iter(self._tiles)))
+                self.evictions += 1
+
+            self._tiles[key] = CachedTile(content, media_type, time.monotonic() + self.ttl_seconds)
+            self.current_bytes += size
+        return True
+
+    def _remove(self, key):
+        tile = self._tiles.pop(key)
+        self.current_bytes -= len(tile.content)
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self.current_bytes = 0
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def __contains__(self, key):
+        return key in self._tiles
+
+    def stats(self):
+        return {
+            "tiles": len(self._tiles),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "stale_hits": self.stale_hits,
+        }
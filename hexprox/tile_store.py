@@ -0,0 +1,344 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from hexprox import config
+from hexprox.tile_cache import CachedTile
+
+
+class SQLiteTileStore():
+    """
+        Persistent tile store in a single MBTiles-style SQLite file, so that a warm instance keeps its tiles across restarts.
+
+        Rows are stored the MBTiles (TMS) way up, flipped from the WMTS row we're given, and the tile format is part of the key
+        since we can hold both jpg and png tiles. The database runs in WAL mode so any number of readers can work alongside
+        the writer, and each thread gets its own connection.
+
+        Tile data is content addressed, using the deduplicated MBTiles layout: the map table points each tile at a row of
+        the images table by a hash of its content, so identical tiles (the blank tiles Hexagon returns across oceans and
+        areas without coverage, mostly) are stored once. A tiles view joins the two for other MBTiles readers. Stores
+        created before this layout are migrated when they're opened.
+
+        An in-memory index of every stored tile (and when it was fetched) is loaded when the store opens. Existence and
+        expiry checks are answered from it without touching the database, and it orders tiles by recency for eviction
+        once the store grows beyond max_bytes. max_bytes and current_bytes count each distinct payload once.
+
+        When several processes share the file, each calls sync periodically to add the tiles the others stored to its
+        index. The total size of the file's images and a count of deletions are kept in the store_state table, updated
+        in the same transactions as the tiles, so the budget covers every process's tiles. A process reloads its whole
+        index when another one has deleted tiles (so contains doesn't answer for tiles that are gone), and before
+        evicting when the shared total is over max_bytes (so it evicts from the real contents of the file).
+    """
+    def __init__(self, path=config.TILE_STORE_PATH, ttl_seconds=config.TILE_STORE_TTL_SECONDS, max_bytes=config.TILE_STORE_MAX_BYTES):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+
+        folder = os.path.dirname(os.path.abspath(path))
+        os.makedirs(folder, exist_ok=True)
+
+        self._local = threading.local()
+        self._lock = threading.Lock()  # serializes writes and protects the index
+        self._index = OrderedDict()  # key: (fetched_at, tile_id), least recently used first
+        self._images = {}  # tile_id: [number of tiles using it, size]
+        self.current_bytes = 0
+        self._synced_to = 0.0  # the latest fetched_at seen in the database
+        self._deletions_seen = 0  # the store_state deletion count our index reflects
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        connection = self._connection
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("""CREATE TABLE IF NOT EXISTS map (
+                                zoom_level INTEGER NOT NULL,
+                                tile_column INTEGER NOT NULL,
+                                tile_row INTEGER NOT NULL,
+                                tile_format TEXT NOT NULL,
+                                tile_id TEXT NOT NULL,
+                                fetched_at REAL NOT NULL,
+                                PRIMARY KEY (zoom_level, tile_column, tile_row, tile_format))""")
+        connection.execute("CREATE INDEX IF NOT EXISTS map_tile_id ON map (tile_id)")
+        connection.execute("CREATE INDEX IF NOT EXISTS map_fetched_at ON map (fetched_at)")  # for sync
+        connection.execute("CREATE TABLE IF NOT EXISTS images (tile_id TEXT PRIMARY KEY, tile_data BLOB NOT NULL, media_type TEXT)")
+        self._migrate_tiles_table(connection)
+        connection.execute("""CREATE VIEW IF NOT EXISTS tiles AS
+                                SELECT map.zoom_level, map.tile_column, map.tile_row, map.tile_format, images.tile_data
+                                FROM map JOIN images ON images.tile_id = map.tile_id""")
+        connection.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)")
+        connection.execute("INSERT OR IGNORE INTO metadata (name, value) VALUES ('name', 'HexProx tile store'), ('scheme', 'tms')")
+        connection.execute("CREATE TABLE IF NOT EXISTS store_state (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        connection.commit()
+        with self._lock, self._transaction() as connection:
+            connection.execute("""INSERT OR IGNORE INTO store_state (name, value)
+                                    SELECT 'bytes', COALESCE(SUM(length(tile_data)), 0) FROM images""")
+            connection.execute("INSERT OR IGNORE INTO store_state (name, value) VALUES ('deletions', 0)")
+            self._deletions_seen = self._state("deletions")
+            self._load_index()
+
+    @property
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA synchronous=NORMAL")  # safe in WAL mode - worst case on power loss is losing the latest tiles, which we can refetch
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def _tms_row(matrix, row):
+        return (2 ** matrix) - 1 - row
+
+    @staticmethod
+    def tile_id(content):
+        return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+    def _migrate_tiles_table(self, connection):
+        """
+            Moves tiles from the original single table layout (tile data inline in a tiles table) into map and images
+        """
+        result = connection.execute("SELECT type FROM sqlite_master WHERE name='tiles'").fetchone()
+        if result is None or result[0] != "table":
+            return
+        rows = connection.execute("SELECT zoom_level, tile_column, tile_row, tile_format, tile_data, media_type, fetched_at FROM tiles")
+        for zoom_level, tile_column, tile_row, tile_format, tile_data, media_type, fetched_at in rows.fetchall():
+            tile_id = self.tile_id(tile_data)
+            connection.execute("INSERT OR IGNORE INTO images (tile_id, tile_data, media_type) VALUES (?, ?, ?)", (tile_id, tile_data, media_type))
+            connection.execute("INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_format, tile_id, fetched_at) VALUES (?, ?, ?, ?, ?, ?)",
+                               (zoom_level, tile_column, tile_row, tile_format, tile_id, fetched_at))
+        connection.execute("DROP TABLE tiles")
+        connection.commit()
+        connection.execute("VACUUM")  # hand back the space the duplicates took
+
+    @contextmanager
+    def _transaction(self):
+        """
+            A write transaction, holding the database's write lock from the start so that what we read in it stays true
+            until we commit. Hold self._lock around it. If it fails, the index is reloaded to drop our uncommitted changes.
+        """
+        connection = self._connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.rollback()
+            self._reload_index()
+            raise
+        connection.commit()
+
+    def _state(self, name):
+        return self._connection.execute("SELECT value FROM store_state WHERE name=?", (name,)).fetchone()[0]
+
+    def _add_state(self, name, amount):
+        self._connection.execute("UPDATE store_state SET value = value + ? WHERE name=?", (amount, name))
+
+    def _reload_index(self):
+        """
+            Rebuilds the index from the database. Tiles we already had keep their place in our recency order, after the
+            ones only other processes have used.
+        """
+        order = list(self._index)
+        self._index.clear()
+        self._images.clear()
+        self.current_bytes = 0
+        self._deletions_seen = self._state("deletions")
+        self._load_index()
+        for key in order:
+            if key in self._index:
+                self._index.move_to_end(key)
+
+    def _load_index(self, since=None):
+        """
+            Adds the tiles fetched after since (all of them if None) to the index. Returns how many were added or updated.
+        """
+        query = """SELECT map.zoom_level, map.tile_column, map.tile_row, map.tile_format, map.fetched_at, map.tile_id, length(images.tile_data)
+                   FROM map JOIN images ON images.tile_id = map.tile_id"""
+        parameters = ()
+        if since is not None:
+            query += " WHERE map.fetched_at > ?"
+            parameters = (since,)
+        rows = self._connection.execute(query + " ORDER BY map.fetched_at", parameters).fetchall()
+
+        loaded = 0
+        for zoom_level, tile_column, tile_row, tile_format, fetched_at, tile_id, size in rows:
+            key = (zoom_level, self._tms_row(zoom_level, tile_row), tile_column, tile_format)
+            self._synced_to = max(self._synced_to, fetched_at)
+            if self._index.get(key, (None, None))[1] == tile_id and self._index[key][0] >= fetched_at:
+                continue  # our own write
+            self._reference(tile_id, size)
+            self._forget(key)
+            self._index[key] = (fetched_at, tile_id)
+            loaded += 1
+        return loaded
+
+    def sync(self):
+        """
+            Picks up tiles other processes sharing the file have stored since we last looked, or reloads the index if
+            they've deleted any. Returns how many tiles were added or updated.
+        """
+        with self._lock:
+            if self._state("deletions") != self._deletions_seen:
+                before = len(self._index)
+                self._reload_index()
+                return max(0, len(self._index) - before)
+            return self._load_index(since=self._synced_to - 1)  # a little overlap - another writer's clock or commit may lag ours
+
+    def _is_expired(self, fetched_at):
+        return fetched_at + self.ttl_seconds < time.time()
+
+    def contains(self, key):
+        """
+            Whether we have a current (unexpired) copy of the tile. Answered from the in-memory index only.
+        """
+        entry = self._index.get(key)
+        return entry is not None and not self._is_expired(entry[0])
+
+    def __contains__(self, key):
+        return self.contains(key)
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, key, allow_stale=False):
+        """
+            Returns a CachedTile for the key, or None if we don't have a current copy of it. Expired tiles are kept until
+            they're replaced, evicted or purged, so they can still be served with allow_stale when upstream is failing.
+        """
+        entry = self._index.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if self._is_expired(entry[0]) and not allow_stale:
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        matrix, row, col, ext = key
+        result = self._connection.execute("SELECT tile_data, media_type FROM images WHERE tile_id=?", (entry[1],)).fetchone()
+        if result is None:  # removed by something else sharing this file
+            with self._lock:
+                self._forget(key)
+            self.misses += 1
+            return None
+
+        with self._lock:
+            if key in self._index:
+                self._index.move_to_end(key)
+        self.hits += 1
+        return CachedTile(result[0], result[1], entry[0] + self.ttl_seconds, fetched_at=entry[0])
+
+    def put(self, key, content, media_type):
+        """
+            Stores the tile, replacing any previous copy, then evicts the least recently used tiles if the file is over
+            max_bytes. If another tile already has the same content, only the reference to it is written.
+        """
+        matrix, row, col, ext = key
+        fetched_at = time.time()
+        tile_id = self.tile_id(content)  # hashed before taking the lock - it's the slow part
+        with self._lock, self._transaction() as connection:
+            inserted = connection.execute("INSERT OR IGNORE INTO images (tile_id, tile_data, media_type) VALUES (?, ?, ?)",
+                                          (tile_id, content, media_type)).rowcount
+            if inserted:
+                self._add_state("bytes", len(content))
+            connection.execute("INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_format, tile_id, fetched_at) VALUES (?, ?, ?, ?, ?, ?)",
+                               (matrix, col, self._tms_row(matrix, row), ext, tile_id, fetched_at))
+            self._reference(tile_id, len(content))  # before forgetting the old copy, so rewriting a tile with the same content keeps its image
+            self._delete_rows([], self._forget(key))
+            self._index[key] = (fetched_at, tile_id)
+
+            if self._state("bytes") > self.max_bytes:
+                if self._state("bytes") != self.current_bytes:  # other processes' tiles count too - evict from what's really there
+                    self._reload_index()
+                evicted = []
+                orphaned = []
+                while self.current_bytes > self.max_bytes and len(self._index) > 1:
+                    oldest = next(iter(self._index))
+                    orphaned += self._forget(oldest)
+                    evicted.append(oldest)
+                self._delete_rows(evicted, orphaned)
+                self.evictions += len(evicted)
+
+    def delete(self, key):
+        with self._lock, self._transaction():
+            self._delete_rows([key], self._forget(key))
+
+    def purge_expired(self):
+        """
+            Removes every expired tile. Expired tiles are otherwise kept (to serve if upstream fails) until they're replaced or evicted.
+        """
+        with self._lock, self._transaction():
+            expired = [key for key, (fetched_at, tile_id) in self._index.items() if self._is_expired(fetched_at)]
+            orphaned = []
+            for key in expired:
+                orphaned += self._forget(key)
+            self._delete_rows(expired, orphaned)
+        self.expirations += len(expired)
+        return len(expired)
+
+    def _reference(self, tile_id, size):
+        image = self._images.get(tile_id)
+        if image is None:
+            self._images[tile_id] = [1, size]
+            self.current_bytes += size
+        else:
+            image[0] += 1
+
+    def _forget(self, key):
+        """
+            Drops the key from the index. Returns a list of the tile_ids no longer used by any tile (so at most one)
+        """
+        entry = self._index.pop(key, None)
+        if entry is None:
+            return []
+        image = self._images[entry[1]]
+        image[0] -= 1
+        if image[0] > 0:
+            return []
+        del self._images[entry[1]]
+        self.current_bytes -= image[1]
+        return [entry[1]]
+
+    def _delete_rows(self, keys, tile_ids=()):
+        """
+            Deletes the tiles and images and updates store_state to match. Call inside _transaction. Images are only
+            deleted if no tile in the file uses them - another process may have a tile with the same content.
+        """
+        connection = self._connection
+        if keys:
+            connection.executemany("DELETE FROM map WHERE zoom_level=? AND tile_column=? AND tile_row=? AND tile_format=?",
+                                   [(matrix, col, self._tms_row(matrix, row), ext) for matrix, row, col, ext in keys])
+            if self._state("deletions") == self._deletions_seen:  # otherwise another process deleted tiles we haven't reloaded yet
+                self._deletions_seen += 1
+            self._add_state("deletions", 1)
+        freed = 0
+        for tile_id in tile_ids:
+            row = connection.execute("""DELETE FROM images WHERE tile_id=? AND NOT EXISTS (SELECT 1 FROM map WHERE map.tile_id=images.tile_id)
+                                        RETURNING length(tile_data)""", (tile_id,)).fetchone()
+            if row is not None:
+                freed += row[0]
+        if freed:
+            self._add_state("bytes", -freed)
+
+    def close(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def stats(self):
+        return {
+            "tiles": len(self._index),
+            "distinct_tiles": len(self._images),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
@@ -0,0 +1,81 @@
+import asyncio
+import logging
+from datetime import datetime, UTC
+
+from hexprox import config
+
+
+class TokenManager():
+    """
+        Keeps an access token current for one credential set without making requests wait on the OAuth server.
+
+        - Concurrent callers that find the token missing or expired share a single in-flight refresh rather than each
+          sending their own token request.
+        - After each refresh, a background task renews the token once refresh_fraction of its lifetime has passed, so in
+          steady state get_token returns immediately (important for the redirect path, which otherwise does no I/O).
+
+        fetch_token is an async callable returning the token server's response body, with "access_token", "expires_in"
+        and "reauthorize_after" keys (see BaseHexagonManager._parse_token_response).
+    """
+    def __init__(self, fetch_token, refresh_fraction=config.TOKEN_REFRESH_FRACTION):
+        self._fetch_token = fetch_token
+        self.refresh_fraction = refresh_fraction
+
+        self.token_info = None
+        self._refresh_task = None  # the in-flight refresh, shared by every caller that needs it
+        self._background_task = None
+
+        self.refreshes = 0
+        self.background_refreshes = 0
+        self.shared_waits = 0  # callers that waited on another caller's refresh instead of starting their own
+
+    @property
+    def expired(self):
+        return self.token_info is None or datetime.now(UTC) > self.token_info["reauthorize_after"]
+
+    async def get_token(self):
+        if self.expired:
+            await self.refresh()
+        return self.token_info["access_token"]
+
+    async def refresh(self):
+        """
+            Gets a new token, joining the refresh already in flight if there is one. Raises whatever the token fetch raised.
+        """
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.ensure_future(self._run_refresh())
+        else:
+            self.shared_waits += 1
+        return await asyncio.shield(self._refresh_task)  # one caller giving up shouldn't cancel the refresh for everyone else
+
+    async def _run_refresh(self):
+        try:
+            self.token_info = await self._fetch_token()
+            self.refreshes += 1
+            self._schedule_background_refresh()
+            return self.token_info
+        finally:
+            self._refresh_task = None
+
+    def _schedule_background_refresh(self):
+        if self.refresh_fraction is None or self.refresh_fraction <= 0:
+            return
+        if self._background_task is not None and not self._background_task.done():  # an on-demand refresh beat the scheduled one - reschedule it
+            self._background_task.cancel()
+        delay = self.token_info["expires_in"] * self.refresh_fraction
+        self._background_task = asyncio.ensure_future(self._background_refresh(delay))
+
+    async def _background_refresh(self, delay):
+        await asyncio.sleep(delay)
+        self._background_task = None  # past the sleep, so the refresh below schedules the next renewal rather than cancelling this one
+        try:
+            await self.refresh()
+            self.background_refreshes += 1
+        except Exception:  # the current token is still good until it expires - if it does, the next request refreshes it on demand
+            logging.warning("Background token refresh failed", exc_info=True)
+
+    def close(self):
+        for task in (self._background_task, self._refresh_task):
+            if task is not None and not task.done():
+                task.cancel()
+        self._background_task = None
@@ -0,0 +1,80 @@
+"""
+    Finds the Hexagon base URL in upstream documents as their bytes arrive, so they can be rewritten to point at the
+    proxy without first being read whole, decoded to text and copied by str.replace. See CapabilitiesCache.store_streamed,
+    and aiter_rewritten for documents that are sent on as they arrive instead of being cached.
+"""
+
+REWRITTEN_MEDIA_TYPES = ("xml", "json", "html", "text/")
+
+
+def needs_rewriting(media_type):
+    """
+        Whether a response of this Content-Type can contain URLs to rewrite. Binary responses (tiles fetched through
+        the general path, for example) are passed through untouched. Unlabelled responses are searched to be safe.
+    """
+    if not media_type:
+        return True
+    media_type = media_type.lower()
+    return any(marker in media_type for marker in REWRITTEN_MEDIA_TYPES)
+
+
+class StreamingSplitter():
+    """
+        Splits a byte stream on a pattern chunk by chunk, including occurrences that straddle two chunks. feed() returns
+        the bytes it can pass on so far, with None standing in for each occurrence of the pattern. Only a possible
+        partial occurrence at the end of a chunk (shorter than the pattern) is held back for the next one.
+
+        Chunks without the pattern in them are passed on as the same bytes object, not a copy.
+    """
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self._carry = b""  # the end of the last chunk, which might be the start of an occurrence
+
+    def feed(self, chunk):
+        data = self._carry + chunk if self._carry else chunk
+        pieces = data.split(self.pattern)
+        tail = pieces.pop()
+        keep = self._partial_length(tail)
+        self._carry = tail[len(tail) - keep:] if keep else b""
+
+        output = []
+        for piece in pieces:
+            if piece:
+                output.append(piece)
+            output.append(None)
+        tail = tail[:len(tail) - keep] if keep else tail
+        if tail:
+            output.append(tail)
+        return output
+
+    def close(self):
+        """
+            Returns whatever was held back at the end of the stream - it wasn't the pattern after all
+        """
+        carry, self._carry = self._carry, b""
+        return [carry] if carry else []
+
+    def _partial_length(self, data):
+        """
+            Length of the longest end of data that is the start of the pattern (but not all of it)
+        """
+        pattern = self.pattern
+        first = pattern[:1]
+        index = data.find(first, max(0, len(data) - len(pattern) + 1))
+        while index != -1:
+            if pattern.startswith(data[index:]):
+                return len(data) - index
+            index = data.find(first, index + 1)
+        return 0
+
+
+async def aiter_rewritten(chunks, pattern, replacement):
+    """
+        Yields the byte stream with every occurrence of pattern replaced, as the chunks arrive
+    """
+    splitter = StreamingSplitter(pattern)
+    async for chunk in chunks:
+        for piece in splitter.feed(chunk):
+            yield replacement if piece is None else piece
+    for piece in splitter.close():
+        yield piece
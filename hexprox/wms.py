@@ -0,0 +1,230 @@
+"""
+    WMS GetMap on top of the WMTS tile grid. A GetMap request's bbox, size and CRS are mapped onto the WebMercator tiles
+    that cover it, and once those tiles have been fetched (by the caller - see main.get_wms_map_response) they're
+    decoded into one mosaic array, resampled to the requested grid and encoded as a single image.
+
+    Resampling is separable for both supported projections - x only depends on longitude and y only on latitude - so
+    the source position of every output column and row is computed once as a vector, and the image is built from those
+    with array indexing rather than a per-pixel loop.
+"""
+
+import io
+import math
+
+import numpy
+from PIL import Image
+
+from hexprox import config
+
+TILE_SIZE = 256
+EARTH_RADIUS = 6378137.0
+WORLD_WIDTH = 2 * math.pi * EARTH_RADIUS  # WebMercator meters
+MAX_LATITUDE = 85.0511287798
+
+WEBMERCATOR_CRS = {"EPSG:3857", "EPSG:900913", "EPSG:102100", "EPSG:102113"}
+GEOGRAPHIC_CRS = {"EPSG:4326", "CRS:84"}
+FORMATS = {"image/jpeg": "JPEG", "image/jpg": "JPEG", "image/png": "PNG"}
+
+
+class WMSError(ValueError):
+    """
+        The GetMap request can't be served - reported to the client as a WMS ServiceException
+    """
+    def __init__(self, message, code="InvalidParameterValue"):
+        self.code = code
+        super().__init__(message)
+
+
+def service_exception(error):
+    message = str(error).replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<ServiceExceptionReport version="1.3.0" xmlns="http://www.opengis.net/ogc">'
+            f'<ServiceException code="{error.code}">{message}</ServiceException>'
+            '</ServiceExceptionReport>').encode("utf-8")
+
+
+class GetMapRequest():
+    """
+        The parts of a WMS GetMap request we use. bbox is (min_x, min_y, max_x, max_y) in the CRS's x/y (lon/lat for
+        geographic CRSs), whatever the axis order of the request was.
+    """
+    def __init__(self, bbox, width, height, crs, image_format, transparent=False, background=(255, 255, 255)):
+        self.bbox = bbox
+        self.width = width
+        self.height = height
+        self.crs = crs
+        self.image_format = image_format
+        self.transparent = transparent
+        self.background = background
+
+    @property
+    def media_type(self):
+        return "image/png" if self.image_format == "PNG" else "image/jpeg"
+
+    @property
+    def tile_extension(self):
+        return "png" if self.transparent else "jpg"  # only PNG tiles carry transparency - otherwise use the JPEG tiles browser clients share the cache for
+
+    @classmethod
+    def from_params(cls, params):
+        """
+            Builds the request from query parameters, whose names are case-insensitive in WMS
+        """
+        params = {name.lower(): value for name, value in params.items()}
+        if params.get("service", "WMS").upper() != "WMS":
+            raise WMSError("SERVICE must be WMS")
+        request = params.get("request", "")
+        if request.lower() != "getmap":
+            raise WMSError(f"Request {request!r} is not supported - only GetMap is", code="OperationNotSupported")
+
+        version = params.get("version", "1.3.0")
+        crs = (params.get("crs") or params.get("srs") or "").upper()
+        if crs not in WEBMERCATOR_CRS and crs not in GEOGRAPHIC_CRS:
+            raise WMSError(f"CRS {crs!r} is not supported - use EPSG:3857 or EPSG:4326", code="InvalidCRS")
+
+        try:
+            bbox = [float(value) for value in params["bbox"].split(",")[:4]]
+            width, height = int(params["width"]), int(params["height"])
+        except (KeyError, ValueError):
+            raise WMSError("BBOX, WIDTH and HEIGHT are required, as numbers", code="MissingParameterValue")
+        if len(bbox) != 4 or bbox[0] >= bbox[2] or bbox[1] >= bbox[3]:
+            raise WMSError("BBOX must be minx,miny,maxx,maxy with min < max")
+        if crs == "EPSG:4326" and version.startswith("1.3"):  # WMS 1.3.0 uses EPSG:4326's lat/lon axis order
+            bbox = [bbox[1], bbox[0], bbox[3], bbox[2]]
+        if not 0 < width <= config.WMS_MAX_SIZE or not 0 < height <= config.WMS_MAX_SIZE:
+            raise WMSError(f"WIDTH and HEIGHT must be between 1 and {config.WMS_MAX_SIZE}")
+
+        image_format = FORMATS.get(params.get("format", "image/jpeg").lower().split(";")[0])
+        if image_format is None:
+            raise WMSError(f"FORMAT {params.get('format')!r} is not supported - use image/jpeg or image/png", code="InvalidFormat")
+        transparent = image_format == "PNG" and params.get("transparent", "FALSE").upper() == "TRUE"
+
+        background = (255, 255, 255)
+        if "bgcolor" in params:
+            try:
+                background = tuple(int(params["bgcolor"][-6:][index:index + 2], 16) for index in (0, 2, 4))
+            except ValueError:
+                raise WMSError("BGCOLOR must be a hexadecimal RGB value like 0xFFFFFF")
+        return cls(tuple(bbox), width, height, crs, image_format, transparent=transparent, background=background)
+
+
+def _mercator_x(lon):
+    return numpy.radians(lon) * EARTH_RADIUS
+
+
+def _mercator_y(lat):
+    lat = numpy.clip(lat, -MAX_LATITUDE, MAX_LATITUDE)
+    return numpy.log(numpy.tan(math.pi / 4 + numpy.radians(lat) / 2)) * EARTH_RADIUS
+
+
+class TilePlan():
+    """
+        Which tiles a GetMap request needs, and where each output column and row samples them from. pixel_x/pixel_y are
+        the positions of the output pixel centers in the mosaic of the tiles in rows x cols, in mosaic pixels.
+    """
+    def __init__(self, zoom, rows, cols, pixel_x, pixel_y):
+        self.zoom = zoom
+        self.rows = rows
+        self.cols = cols
+        self.pixel_x = pixel_x
+        self.pixel_y = pixel_y
+
+    @property
+    def tiles(self):
+        return [(self.zoom, row, col) for row in self.rows for col in self.cols]
+
+    @classmethod
+    def for_request(cls, request):
+        min_x, min_y, max_x, max_y = request.bbox
+        column_centers = min_x + (numpy.arange(request.width) + 0.5) * ((max_x - min_x) / request.width)
+        row_centers = max_y - (numpy.arange(request.height) + 0.5) * ((max_y - min_y) / request.height)  # images are north up
+        if request.crs in GEOGRAPHIC_CRS:
+            mercator_x, mercator_y = _mercator_x(column_centers), _mercator_y(row_centers)
+        else:
+            mercator_x, mercator_y = column_centers, row_centers
+
+        # the zoom whose tiles are at least as detailed as the output, so we only ever shrink them - unless that needs too many tiles
+        extent = float(_mercator_x(max_x) - _mercator_x(min_x)) if request.crs in GEOGRAPHIC_CRS else max_x - min_x
+        meters_per_pixel = extent / request.width
+        zoom = min(config.WMS_MAX_ZOOM, max(0, math.ceil(math.log2(WORLD_WIDTH / (TILE_SIZE * meters_per_pixel)) - 1e-9)))
+        while True:
+            world_pixels = TILE_SIZE * 2 ** zoom
+            global_x = (mercator_x + WORLD_WIDTH / 2) / WORLD_WIDTH * world_pixels
+            global_y = (WORLD_WIDTH / 2 - mercator_y) / WORLD_WIDTH * world_pixels
+            last_tile = 2 ** zoom - 1
+            first_col, last_col = (min(max(int(value // TILE_SIZE), 0), last_tile) for value in (global_x[0], global_x[-1]))
+            first_row, last_row = (min(max(int(value // TILE_SIZE), 0), last_tile) for value in (global_y[0], global_y[-1]))
+            tile_count = (last_col - first_col + 1) * (last_row - first_row + 1)
+            if tile_count <= config.WMS_MAX_TILES or zoom == 0:
+                break
+            zoom -= 1
+
+        return cls(zoom, range(first_row, last_row + 1), range(first_col, last_col + 1),
+                   global_x - first_col * TILE_SIZE, global_y - first_row * TILE_SIZE)
+
+
+def mosaic(plan, tiles, channels, background):
+    """
+        Decodes the tiles ({(zoom, row, col): bytes or None}) into a single array for the plan's rows and columns.
+        Missing tiles, and tiles that aren't images we can decode (an error page served with a 200, or a truncated
+        body), are left as background.
+    """
+    mosaic_array = numpy.empty((len(plan.rows) * TILE_SIZE, len(plan.cols) * TILE_SIZE, channels), dtype=numpy.uint8)
+    mosaic_array[...] = background
+    mode = "RGBA" if channels == 4 else "RGB"
+    for (zoom, row, col), content in tiles.items():
+        if content is None:
+            continue
+        try:
+            with Image.open(io.BytesIO(content)) as tile_image:
+                tile_array = numpy.asarray(tile_image.convert(mode))
+        except (OSError, SyntaxError, ValueError):  # UnidentifiedImageError is an OSError, as are truncated images
+            continue
+        top, left = (row - plan.rows.start) * TILE_SIZE, (col - plan.cols.start) * TILE_SIZE
+        mosaic_array[top:top + tile_array.shape[0], left:left + tile_array.shape[1]] = tile_array[:TILE_SIZE, :TILE_SIZE]
+    return mosaic_array
+
+
+def _bilinear_weights(positions, size):
+    """
+        For each position (in pixels, where pixel i's center is at i + 0.5), the two neighbouring pixel indexes and the
+        weight of the second one
+    """
+    positions = positions - 0.5
+    lower = numpy.floor(positions)
+    weights = (positions - lower).astype(numpy.float32)
+    lower = lower.astype(numpy.intp)
+    return numpy.clip(lower, 0, size - 1), numpy.clip(lower + 1, 0, size - 1), weights
+
+
+def resample(mosaic_array, plan):
+    """
+        Bilinearly samples the mosaic at every output pixel. Columns are interpolated first, then rows, so each step is
+        a gather plus a weighted sum over whole arrays.
+    """
+    top, bottom, row_weights = _bilinear_weights(plan.pixel_y, mosaic_array.shape[0])
+    left, right, col_weights = _bilinear_weights(plan.pixel_x, mosaic_array.shape[1])
+
+    col_weights = col_weights[None, :, None]
+    columns = mosaic_array[:, left].astype(numpy.float32) * (1 - col_weights) + mosaic_array[:, right].astype(numpy.float32) * col_weights
+    row_weights = row_weights[:, None, None]
+    output = columns[top] * (1 - row_weights) + columns[bottom] * row_weights
+    return numpy.clip(numpy.rint(output), 0, 255).astype(numpy.uint8)
+
+
+def render(request, plan, tiles):
+    """
+        Returns the encoded image for the GetMap request from the plan's tiles ({(zoom, row, col): bytes or None}).
+        CPU bound - run it in a worker thread.
+    """
+    channels = 4 if request.transparent else 3
+    background = (*request.background, 0) if request.transparent else request.background
+    image_array = resample(mosaic(plan, tiles, channels, background), plan)
+
+    output = io.BytesIO()
+    image = Image.fromarray(image_array, "RGBA" if channels == 4 else "RGB")
+    if request.image_format == "JPEG":
+        image.save(output, format="JPEG", quality=config.WMS_JPEG_QUALITY)
+    else:
+        image.save(output, format="PNG", compress_level=config.WMS_PNG_COMPRESS_LEVEL)
+    return output.getvalue()
@@ -5,41 +5,71 @@ __author__ = "Nick Santos"
 __license__ = "MIT"
 __copyright__ = "Copyright 2025 California Department of Technology"
 __status__ = "Development"
-__description__ = "A proxy service for Hexagon imagery that supports WMTS and (in the future) WMS requests."
+__description__ = "A proxy service for Hexagon imagery that supports WMTS and WMS GetMap requests."
 
+import asyncio
+import logging
+import mimetypes
 import os
+import sqlite3
+import time
 import traceback
+import uuid
 
-from fastapi import FastAPI, Request, BackgroundTasks, HTTPException
-from fastapi.responses import RedirectResponse, Response
+import httpx
+from contextlib import asynccontextmanager, ExitStack
+
+from fastapi import FastAPI, Request, BackgroundTasks
+from fastapi.responses import RedirectResponse, Response, StreamingResponse, PlainTextResponse
+from starlette.background import BackgroundTask
 from fastapi.middleware.cors import CORSMiddleware
 
 from base64 import b64decode
 from hashlib import sha256
 import datetime
 
-from hexprox import hexagon, config
-from hexprox.hexagon import HexagonManager, HEXAGON_TILE_EXTENSIONS
-from hexprox.key_manager import APIKeyManager
+from hexprox import hexagon, config, metrics, batch
+from hexprox.hexagon import AsyncHexagonManager, HexagonStatusError, HEXAGON_TILE_EXTENSIONS
+from hexprox.http_cache import entity_tag, is_not_modified, parse_http_date, redirect_cache_control, validator_headers
+from hexprox.key_manager import APIKeyManager, LazySecretClient
+from hexprox.resilience import CircuitOpenError, breaker_stats, parse_retry_after
+from hexprox.capabilities_cache import CapabilitiesCache, UncachedResponse
+from hexprox.client_registry import ClientRegistry
+from hexprox.coalescer import RequestCoalescer, FetchAbandoned
+from hexprox.empty_tiles import EmptyTileIndex
+from hexprox.fair_limiter import FairLimiter, RateLimited
+from hexprox.tile_bounds import TileBoundsIndex
+from hexprox.shared_state import SharedStateStore
+from hexprox.tile_cache import TileCache, CachedTile
+from hexprox.tile_store import SQLiteTileStore
+from hexprox.url_rewriter import aiter_rewritten, needs_rewriting
 
 from hexprox.config import DEBUG
 
-try:
-    from azure.keyvault.secrets import SecretClient
-    from azure.core import exceptions as azure_exceptions
-    from azure.identity import ManagedIdentityCredential
-except:
-    # this isn't correct - this part of the code runs on startup not in response to a request
-    raise HTTPException(status_code=500, detail="Unable to azure secrets and identity libraries")
-
-STREAM_CHUNK_SIZE = 256000 if not DEBUG else 4096  # requests package blocks for the full read - probably OK for larger in production because instances will get spun up. May want lower in dev
+STREAM_CHUNK_SIZE = 256000 if not DEBUG else 4096  # bytes per chunk when piping proxied tiles through to the client. Smaller in dev so chunking is exercised
 
 # salt will just be for in-memory - we're not storing anything, but just to help
 SALT = datetime.datetime.now(tz=datetime.UTC).strftime("%Y%m%d%H%M%S")
 
 def get_hash(client_id, client_secret, salt=SALT):
     return sha256(f"{client_id}:{client_secret}:{salt}".encode("utf-8")).hexdigest()  # hexdigest formats the hash as a string we can store
-app = FastAPI()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    sync_task = asyncio.create_task(sync_shared_state()) if SHARED_STATE is not None else None
+    sweep_task = asyncio.create_task(remove_idle_clients())
+    if config.WARMUP_ON_STARTUP:
+        await warm_up()
+    yield
+    if sync_task is not None:
+        sync_task.cancel()
+    sweep_task.cancel()
+    CLIENTS.clear()
+    await hexagon.close_async_http_client()  # release the pooled upstream connections on shutdown
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -49,23 +79,24 @@ app.add_middleware(
     allow_methods=["HEAD", "GET", "OPTIONS"],
     allow_headers=["*"],
 )
+app.add_middleware(metrics.MetricsMiddleware)  # outermost, so the timings include everything else
 
-CLIENTS = {}
+CLIENTS = ClientRegistry()
 
 try:
     KEY_VAULT_NAME = os.environ["KEY_VAULT_NAME"]
     KEY_VAULT_URI = f"https://{KEY_VAULT_NAME}.vault.azure.net"
 
     managed_identity_id = os.environ["MANAGED_IDENTITY_CLIENT_ID"]
-    AZURE_CREDENTIAL = ManagedIdentityCredential(client_id=managed_identity_id)
-    KEY_VAULT_CLIENT = SecretClient(vault_url=KEY_VAULT_URI, credential=AZURE_CREDENTIAL)
-    print("Checkpoint - key vault loaded")
+    KEY_VAULT_CLIENT = LazySecretClient(vault_url=KEY_VAULT_URI, managed_identity_client_id=managed_identity_id)  # the Azure SDK is loaded on first use (or by warm_up), not on import
+    print("Checkpoint - key vault configured")
 except Exception as e:
     if not config.TEST: ## In the testing environment we won't connect to the secrets manager. We'll mock it out
         # this isn't correct - this part of the code runs on startup not in response to a request
         raise Exception(f"Unable to load key vault: {traceback.format_exc(e)}")
     else:
         from unittest.mock import MagicMock
+        from azure.keyvault.secrets import SecretClient
         KEY_VAULT_CLIENT = MagicMock(spec=SecretClient)
 
 try:
@@ -74,30 +105,126 @@ except:
     BASE_URL = None
 
 def get_client(client_id, client_secret, api_version="v2"):
-    global CLIENTS
     if api_version == "v1":  # running the replace operation here slows things down relative to if it was post-hash in the client, but that's fine because we expect to phase out v1
         client_id = b64decode(client_id).decode("utf-8").replace(" ", "")
         client_secret = b64decode(client_secret).decode("utf-8").replace(" ", "")
 
     client_hash = get_hash(client_id, client_secret)  # makes the actual credentials be a bit deeper in the memory structure - even if they're stored on the individual objects - probably overkill
 
-    # find out if we already have a client for this user - if so, use it - we could end up racing if they hit us with a bunch of requests though
-    if client_hash in CLIENTS:
-        client = CLIENTS[client_hash]
-    else:
-        client = HexagonManager(client_id=client_id, client_secret=client_secret, wmts_url=hexagon.STREAMING_WMTS_URL)
-        CLIENTS[client_hash] = client
-
-    return client
+    # find out if we already have a client for this user - if so, use it. The registry bounds how many we keep and closes the ones it drops
+    return CLIENTS.get_or_create(client_hash, lambda: AsyncHexagonManager(client_id=client_id, client_secret=client_secret,
+                                                                          wmts_url=hexagon.STREAMING_WMTS_URL, tile_store=TILE_STORE,
+                                                                          shared_state=SHARED_STATE))
+
+
+SHARED_STATE = SharedStateStore() if config.SHARED_STATE_PATH else None  # set when running as one of several worker processes - see hexprox/standalone.py
+API_KEY_MANAGER = APIKeyManager(shared_state=SHARED_STATE)
+TILE_CACHE = TileCache()
+TILE_STORE = SQLiteTileStore() if config.TILE_STORE_PATH else None
+REQUEST_LIMITS = FairLimiter()  # per-key and per-org limits on v2 requests, with fair queuing when they're reached
+TILE_FETCHES = RequestCoalescer()  # identical concurrent tile requests share one upstream fetch
+EMPTY_TILES = EmptyTileIndex()
+TILE_BOUNDS = TileBoundsIndex()
+BACKGROUND_TASKS = set()  # asyncio only keeps weak references to tasks, so fire-and-forget ones are held here until they finish
+CAPABILITIES_CACHE = CapabilitiesCache()
+CAPABILITIES_FETCHES = RequestCoalescer()
+
+# these read the globals at scrape time, so they follow along if the objects are replaced
+metrics.REGISTRY.collect_stats("hexprox_tile_cache", lambda: TILE_CACHE.stats())
+metrics.REGISTRY.collect_stats("hexprox_tile_store", lambda: TILE_STORE.stats() if TILE_STORE is not None else {})
+metrics.REGISTRY.collect_stats("hexprox_tile_fetches", lambda: TILE_FETCHES.stats())
+metrics.REGISTRY.collect_stats("hexprox_empty_tiles", lambda: EMPTY_TILES.stats())
+metrics.REGISTRY.collect_stats("hexprox_tile_bounds", lambda: TILE_BOUNDS.stats())
+metrics.REGISTRY.collect_stats("hexprox_capabilities_cache", lambda: CAPABILITIES_CACHE.stats())
+metrics.REGISTRY.collect_stats("hexprox_capabilities_fetches", lambda: CAPABILITIES_FETCHES.stats())
+metrics.REGISTRY.collect_stats("hexprox_key_manager", lambda: API_KEY_MANAGER.stats())
+metrics.REGISTRY.collect_stats("hexprox_credential_sets", lambda: API_KEY_MANAGER.scheduler.stats())
+metrics.REGISTRY.collect_stats("hexprox_request_limits", lambda: REQUEST_LIMITS.stats())
+metrics.REGISTRY.collect_stats("hexprox_clients", lambda: CLIENTS.stats())
+metrics.REGISTRY.collect_stats("hexprox_circuit_breakers", breaker_stats)
+metrics.REGISTRY.collect_stats("hexprox_shared_state", lambda: SHARED_STATE.stats() if SHARED_STATE is not None else {})
+
+
+async def sync_shared_state():
+    """
+        Runs for the life of a worker process that shares state with others - picks up the tiles other workers have
+        added to the shared tile store, and clears out expired shared values
+    """
+    while True:
+        await asyncio.sleep(config.SHARED_STATE_SYNC_SECONDS)
+        try:
+            if TILE_STORE is not None:
+                await asyncio.to_thread(TILE_STORE.sync)
+            await asyncio.to_thread(SHARED_STATE.purge_expired)
+        except sqlite3.Error:  # most likely another worker holding the write lock for a long time - try again next round
+            logging.warning("Couldn't sync shared state", exc_info=True)
 
 
-API_KEY_MANAGER = APIKeyManager()
+async def remove_idle_clients():
+    """
+        Runs for the life of the process - closes clients that haven't been used for CLIENT_REGISTRY_IDLE_SECONDS, so
+        their tokens aren't kept renewed in the background while no requests are coming in
+    """
+    while True:
+        await asyncio.sleep(config.CLIENT_REGISTRY_SWEEP_SECONDS)
+        CLIENTS.remove_idle()
 
 
 @app.get("/")
 async def root_get():
     return {"message": f"Service is up."}
 
+@app.get("/warmup", include_in_schema=False)
+async def warmup_get():
+    return await warm_up()
+
+
+async def warm_up(api_keys=None):
+    """
+        Gets a new instance ready to serve at steady-state latency by doing, all at once, what the first requests would
+        otherwise do one after another - loading the Azure SDK and Key Vault client, each of config.WARMUP_API_KEYS'
+        credential sets, and a Hexagon token for every set (which also opens the pooled connection to Hexagon).
+
+        Safe to call again - anything already loaded is reused. Failures are counted rather than raised, since anything
+        that couldn't be warmed is loaded on its first request as usual. Returns a summary without the keys themselves.
+    """
+    api_keys = config.WARMUP_API_KEYS if api_keys is None else api_keys
+    start = time.perf_counter()
+    summary = {"api_keys": len(api_keys), "credential_sets": 0, "failures": 0}
+
+    async def warm_up_api_key(api_key):
+        credential_set = await API_KEY_MANAGER.preload(api_key, KEY_VAULT_CLIENT)
+        if credential_set is None:
+            summary["failures"] += 1
+            return
+        await asyncio.gather(*(warm_up_credentials(credentials) for credentials in credential_set["sets"]))
+
+    async def warm_up_credentials(credentials):
+        try:
+            await get_client(credentials["client_id"], credentials["client_secret"]).get_token()
+            summary["credential_sets"] += 1
+        except (PermissionError, *UPSTREAM_ERRORS):
+            API_KEY_MANAGER.scheduler.token_failed(credentials)
+            summary["failures"] += 1
+
+    warm_ups = [warm_up_api_key(api_key) for api_key in api_keys]
+    if isinstance(KEY_VAULT_CLIENT, LazySecretClient):
+        warm_ups.append(asyncio.to_thread(KEY_VAULT_CLIENT.load))
+    try:
+        results = await asyncio.wait_for(asyncio.gather(*warm_ups, return_exceptions=True), timeout=config.WARMUP_TIMEOUT_SECONDS)
+        summary["failures"] += sum(1 for result in results if isinstance(result, Exception))
+    except asyncio.TimeoutError:  # don't hold up startup - whatever didn't finish will load on demand
+        summary["timed_out"] = True
+    summary["seconds"] = round(time.perf_counter() - start, 3)
+    return summary
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics_get():
+    if not config.METRICS_ENABLED:
+        return Response(status_code=404)
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/about/{api_key}")
 async def about_page(api_key: str, request: Request, background_tasks: BackgroundTasks):
     await API_KEY_MANAGER.get_credentials_for_api_key(api_key, KEY_VAULT_CLIENT, background_tasks, request)  # we don't actually need the creds, we just want to make sure the API key is valid
@@ -110,7 +237,17 @@ async def get_wmts_tile(api_key: str, client_id: str, client_secret: str, matrix
 @app.get("/v2/wmts/{api_key}/1.0.0/HxGN_Imagery/default/WebMercator/{matrix}/{row}/{col}.{ext}")
 async def get_wmts_tile_v2(api_key: str, matrix: int, row: int, col: int, ext: str, request: Request, background_tasks: BackgroundTasks):
     credentials = await API_KEY_MANAGER.get_credentials_for_api_key(api_key, KEY_VAULT_CLIENT, background_tasks, request)
-    return await get_wmts_tile_response("v2", credentials['client_id'], credentials['client_secret'], col, ext, matrix, request, row)
+    try:
+        with ExitStack() as tracking:
+            record_status = tracking.enter_context(API_KEY_MANAGER.scheduler.track(credentials))  # lets the scheduler steer away from busy or throttled credential sets
+            response = await get_wmts_tile_response("v2", credentials['client_id'], credentials['client_secret'], col, ext, matrix, request, row,
+                                                    limit=(api_key, API_KEY_MANAGER.org_for_api_key(api_key)))
+            record_response(record_status, response)
+            if isinstance(response, ReleasingStreamingResponse):  # the credential set stays in use until the tile has been sent
+                response.add_release(tracking.pop_all().close)
+            return response
+    except RateLimited as e:
+        return get_rate_limited_response(e)
 
 @app.get("/v2/nokeycache/wmts/{api_key}/1.0.0/HxGN_Imagery/default/WebMercator/{matrix}/{row}/{col}.{ext}")
 async def get_wmts_tile_v2_nokeycache(api_key: str, matrix: int, row: int, col: int, ext: str, request: Request, background_tasks: BackgroundTasks):
@@ -122,31 +259,468 @@ async def get_wmts_tile_v2_nokeycache(api_key: str, matrix: int, row: int, col:
     return await get_wmts_tile_v2(api_key, matrix, row, col, ext, request, background_tasks)
 
 
-async def get_wmts_tile_response(api_version, client_id, client_secret, col, ext, matrix, request, row):
+async def get_wmts_tile_response(api_version, client_id, client_secret, col, ext, matrix, request, row, limit=None):
+    """
+        limit is the (api_key, org) whose REQUEST_LIMITS a tile fetched from Hexagon counts against. Tiles answered
+        locally and redirects don't count, since they don't use any upstream capacity.
+    """
     if ext not in HEXAGON_TILE_EXTENSIONS:
         return Response(status_code=404, content=f"File extension {ext} not supported")
+    if TILE_BOUNDS.contains(matrix, row, col) is False:
+        metrics.TILE_RESPONSES.inc("out_of_bounds")
+        return Response(status_code=404, content="Tile is outside the tile matrix")
     try:
         client = get_client(client_id, client_secret, api_version=api_version)
     except PermissionError:
         return Response(status_code=403,
                         content="Invalid credentials or inability to communicate with credential server")
+    empty_tile = EMPTY_TILES.get(TILE_CACHE.key(matrix, row, col, ext))
+    if empty_tile is not None:  # known to be blank - answered locally for every kind of client, with no token or upstream call
+        return get_local_tile_response(empty_tile, request.headers, mode="empty")
     if "Origin" in request.headers and ("ca.gov" in request.headers["Origin"] or "arcgis.com" in request.headers[
         "Origin"]):  # trying to catch if this is in a web browser rather than a desktop client  # and "arcgis.com" in request.headers["Origin"]:  # this likely applies if *any* Origin is included since it's a CORS issue that causes us to need to stream it
         # we may still want to open this check up, but trying to limit it so we don't pay out tiles for random people's web maps if they happen to capture a URL.
         # when invoked via a request from a browser, we get CORS issues unless we proxy the tile data too, but it's slower and costs more, so we want to avoid it when possible
         try:
-            response = client.get_tile(matrix=matrix, row=row, col=col, stream=True, url_only=False)
+            response = await get_proxied_tile_response(client, matrix, row, col, ext, request.headers, limit)
+        except PermissionError:
+            return Response(status_code=403,
+                            content="Invalid credentials or inability to communicate with credential server")
+        except UPSTREAM_ERRORS as e:
+            return get_upstream_error_response(e)
+        refresh_tile_bounds(client)
+        return response
+    else:
+        try:
+            url = await client.get_tile(matrix=matrix, row=row, col=col, url_only=True, extension=ext)
         except PermissionError:
             return Response(status_code=403,
                             content="Invalid credentials or inability to communicate with credential server")
+        except UPSTREAM_ERRORS as e:
+            return get_upstream_error_response(e)
+        refresh_tile_bounds(client)
+        metrics.TILE_RESPONSES.inc("redirect")
+        return RedirectResponse(url=url, headers={"Cache-Control": redirect_cache_control(client.token_seconds_remaining)})
+
+
+UPSTREAM_ERRORS = (HexagonStatusError, CircuitOpenError, httpx.TransportError)
+
+
+def get_upstream_error_response(error):
+    """
+        Translates a failed upstream call into a response for the client, passing on throttling and telling clients
+        when to come back rather than turning everything into a 500
+    """
+    if isinstance(error, HexagonStatusError):
+        if error.status_code in (404, 429):
+            headers = {"Retry-After": str(int(error.retry_after))} if error.retry_after is not None else None
+            return Response(status_code=error.status_code, headers=headers, content=f"Upstream server returned status code {error.status_code}")
+        return Response(status_code=502, content=f"Upstream server returned status code {error.status_code}")
+    if isinstance(error, CircuitOpenError):
+        return Response(status_code=503, headers={"Retry-After": str(int(error.retry_after))}, content="Upstream server is unavailable")
+    if isinstance(error, httpx.TimeoutException):
+        return Response(status_code=504, content="Timed out waiting for upstream server")
+    return Response(status_code=502, content="Unable to reach upstream server")
+
+
+def record_response(record_status, response):
+    """
+        Tells the credential scheduler how a request went, with Hexagon's Retry-After so a throttled set sits out as
+        long as Hexagon asked
+    """
+    record_status(response.status_code, parse_retry_after(response.headers.get("retry-after")))
+
+
+def get_rate_limited_response(error):
+    """
+        For requests that waited too long behind their API key's or org's other requests - see hexprox/fair_limiter.py
+    """
+    return Response(status_code=429, headers={"Retry-After": str(error.retry_after)},
+                    content=f"Too many requests for this {'API key' if error.scope == 'key' else error.scope} - please slow down")
+
+
+async def get_proxied_tile_response(client, matrix, row, col, ext, request_headers=None, limit=None):
+    """
+        Returns the tile data itself, for browser clients. Served from the local caches when we have the tile (or a 304
+        if the client's copy is still current), from an identical upstream fetch that's already in flight if there is
+        one, and otherwise streamed from Hexagon. Tiles that aren't held locally wait for a slot in REQUEST_LIMITS for
+        limit (api_key, org), if given, which is held until the tile has been sent.
+    """
+    await client.get_token()  # the caches and in-flight fetches are shared across credential sets, so make sure these credentials are valid before using them. This is a no-op while the token is current
+    cache_key = TILE_CACHE.key(matrix, row, col, ext)
+    cached_tile = await get_local_tile(cache_key)
+    if cached_tile is not None:
+        return get_local_tile_response(cached_tile, request_headers, mode="cache")
+
+    limits = ExitStack()
+    if limit is not None:
+        limits.callback(REQUEST_LIMITS.release, await REQUEST_LIMITS.acquire(*limit))
+    try:
+        response = await fetch_proxied_tile(client, cache_key, matrix, row, col, ext, release=limits.close)
+    except UPSTREAM_ERRORS:
+        limits.close()
+        stale_tile = await get_local_tile(cache_key, allow_stale=True) if config.SERVE_STALE_ON_ERROR else None
+        if stale_tile is None:
+            raise
+        metrics.TILE_RESPONSES.inc("stale")
+        return get_cached_tile_response(stale_tile, config.STALE_TILE_CACHE_CONTROL, {"Warning": '110 - "Response is Stale"'})
+    except BaseException:
+        limits.close()
+        raise
+    if not isinstance(response, StreamingResponse):  # answered by another request's fetch - nothing left to send
+        limits.close()
+    return response
+
+
+def get_local_tile_response(tile, request_headers=None, mode="cache"):
+    """
+        Returns the tile we hold locally, or a 304 if the client's copy of it is still current. mode is how the tile
+        response is counted in the metrics.
+    """
+    if request_headers is not None and is_not_modified(request_headers, tile.etag, tile.fetched_at):
+        metrics.TILE_RESPONSES.inc("not_modified")
+        return Response(status_code=304, headers=validator_headers(config.TILE_CACHE_CONTROL, tile.etag, tile.fetched_at))
+    metrics.TILE_RESPONSES.inc(mode)
+    return get_cached_tile_response(tile)
+
+
+def get_cached_tile_response(tile, cache_control=None, extra_headers=None):
+    headers = validator_headers(cache_control if cache_control is not None else config.TILE_CACHE_CONTROL, tile.etag, tile.fetched_at)
+    if extra_headers is not None:
+        headers.update(extra_headers)
+    return Response(content=tile.content, status_code=200, media_type=tile.media_type, headers=headers)
+
 
-        data = response.content
-        print("Returning fully proxied data response")
-        return Response(content=data,
-                        status_code=200,
-                        media_type="image/png")
+async def fetch_proxied_tile(client, cache_key, matrix, row, col, ext, release=None):
+    fetch = None
+    while (in_flight := TILE_FETCHES.join(cache_key)) is not None:
+        try:
+            tile = await asyncio.wait_for(asyncio.shield(in_flight), timeout=config.UPSTREAM_TIMEOUT_SECONDS)
+            metrics.TILE_RESPONSES.inc("coalesced")
+            return get_cached_tile_response(tile)
+        except FetchAbandoned:  # the request fetching it went away - fetch it ourselves, or join whoever took over
+            continue
+        except asyncio.TimeoutError:  # it's taking too long - fetch it ourselves, but leave the slow fetch to whoever's still waiting on it
+            break
     else:
-        return RedirectResponse(url=client.get_tile(matrix=matrix, row=row, col=col, url_only=True))
+        fetch = TILE_FETCHES.lead(cache_key)
+
+    try:
+        response = await client.get_tile(matrix=matrix, row=row, col=col, stream=True, url_only=False, extension=ext)
+    except BaseException as e:
+        if fetch is not None:
+            TILE_FETCHES.fail(cache_key, fetch, e if isinstance(e, Exception) else None)
+        raise
+
+    metrics.TILE_RESPONSES.inc("proxy")
+    return get_streaming_tile_response(response, ext, cache_key=cache_key, fetch=fetch, release=release)
+
+
+def get_tile_media_type(ext, upstream_headers=None):
+    if upstream_headers is not None and "content-type" in upstream_headers:
+        return upstream_headers["content-type"]
+    return mimetypes.guess_type(f"tile.{ext}")[0] or "application/octet-stream"
+
+
+async def get_local_tile(cache_key, allow_stale=False):
+    """
+        Looks for the tile in the in-memory cache, then in the persistent tile store, promoting tiles found in the
+        store into the memory cache. Returns None if neither has a current copy - or any copy at all, with allow_stale.
+    """
+    cached_tile = TILE_CACHE.get(cache_key, allow_stale=allow_stale) if TILE_CACHE.enabled else None
+    if cached_tile is not None or TILE_STORE is None:
+        return cached_tile
+    if allow_stale:
+        return await asyncio.to_thread(TILE_STORE.get, cache_key, True)
+    if TILE_STORE.contains(cache_key):  # contains is an in-memory check, so misses don't cost a thread hop
+        cached_tile = await asyncio.to_thread(TILE_STORE.get, cache_key)
+        if cached_tile is not None and TILE_CACHE.enabled:
+            TILE_CACHE.put(cache_key, cached_tile.content, cached_tile.media_type)
+    return cached_tile
+
+
+async def cache_streamed_tile(chunks, cache_key, media_type, fetch=None):
+    """
+        Passes the chunks through unchanged. Once the whole body has been sent, hands the assembled tile to any requests
+        waiting on this fetch (the future from TILE_FETCHES.lead, if we're the leader) and stores it in TILE_CACHE (and
+        TILE_STORE if enabled). If the client disconnects partway through, nothing is cached and the waiting requests
+        fetch the tile themselves.
+    """
+    parts = []
+    try:
+        async for chunk in chunks:
+            parts.append(chunk)
+            yield chunk
+    except BaseException:
+        if fetch is not None:
+            TILE_FETCHES.fail(cache_key, fetch)
+        raise
+    content = b"".join(parts)
+    if fetch is not None:
+        TILE_FETCHES.finish(cache_key, fetch, CachedTile(content, media_type, None))
+    EMPTY_TILES.observe(cache_key, content, media_type)
+    if TILE_CACHE.enabled:
+        TILE_CACHE.put(cache_key, content, media_type)
+    if TILE_STORE is not None:
+        await asyncio.to_thread(TILE_STORE.put, cache_key, content, media_type)
+
+
+async def close_streamed_tile(response, cache_key, fetch=None):
+    await response.aclose()
+    if fetch is not None:
+        TILE_FETCHES.fail(cache_key, fetch)  # no-op if the tile finished streaming - otherwise, don't leave waiting requests hanging
+
+
+class ReleasingStreamingResponse(StreamingResponse):
+    """
+        A StreamingResponse that calls release() once it's finished however it ended - including when the client went
+        away before the body started, in which case the body generator (and its finally) never runs at all
+    """
+    def __init__(self, content, release=None, **kwargs):
+        super().__init__(content, **kwargs)
+        self.release = release
+
+    def add_release(self, release):
+        """
+            Also calls release once the response has finished, after the release it already had
+        """
+        releases = ExitStack()
+        releases.callback(release)
+        if self.release is not None:
+            releases.callback(self.release)  # callbacks run last in, first out
+        self.release = releases.close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if self.release is not None:
+                self.release()
+
+
+def get_streaming_tile_response(response, ext, cache_key=None, fetch=None, release=None):
+    """
+        Pipes an open (unread) upstream tile response through to the client in STREAM_CHUNK_SIZE chunks rather than
+        reading it into memory first. The upstream connection is released once the body has been sent, and release()
+        called if given. If a cache_key is provided, the tile is also cached as it streams through, and shared with the
+        requests waiting on fetch (our future from TILE_FETCHES.lead) if given.
+    """
+    headers = validator_headers(config.TILE_CACHE_CONTROL, last_modified=time.time())  # no ETag - we don't know the content hash until it's all been sent
+    if "content-length" in response.headers and "content-encoding" not in response.headers:  # aiter_bytes decodes any content-encoding, so the upstream length only holds for unencoded bodies
+        headers["Content-Length"] = response.headers["content-length"]
+
+    media_type = get_tile_media_type(ext, response.headers)
+    chunks = response.aiter_bytes(STREAM_CHUNK_SIZE)
+    if cache_key is not None:
+        chunks = cache_streamed_tile(chunks, cache_key, media_type, fetch)
+
+    return ReleasingStreamingResponse(chunks,
+                                      release=release,
+                                      status_code=200,
+                                      headers=headers,
+                                      media_type=media_type,
+                                      background=BackgroundTask(close_streamed_tile, response, cache_key, fetch))
+
+
+@app.get("/v1/wms/{api_key}/{client_id}/{client_secret}")
+async def get_wms(api_key: str, client_id: str, client_secret: str, request: Request) -> Response:
+    return await get_wms_map_response("v1", client_id, client_secret, request)
+
+@app.get("/v2/wms/{api_key}")
+async def get_wms_v2(api_key: str, request: Request, background_tasks: BackgroundTasks) -> Response:
+    parsed = parse_wms_request(request)
+    if isinstance(parsed, Response):
+        return parsed
+    map_request, plan = parsed
+
+    credentials = await API_KEY_MANAGER.get_credentials_for_api_key(api_key, KEY_VAULT_CLIENT, background_tasks, request)
+    try:
+        async with REQUEST_LIMITS.slot(api_key, API_KEY_MANAGER.org_for_api_key(api_key), cost=len(plan.tiles)):  # charged for the tiles the map needs
+            with API_KEY_MANAGER.scheduler.track(credentials) as record_status:
+                response = await get_wms_map_response("v2", credentials['client_id'], credentials['client_secret'], request, parsed)
+                record_response(record_status, response)
+                return response
+    except RateLimited as e:
+        return get_rate_limited_response(e)
+
+
+def parse_wms_request(request):
+    """
+        Returns the GetMap request and its tile plan, or a 400 response with a WMS service exception
+    """
+    from hexprox import wms  # numpy and Pillow take a while to import, so only load them once a WMS request comes in
+
+    try:
+        map_request = wms.GetMapRequest.from_params(request.query_params)
+        return map_request, wms.TilePlan.for_request(map_request)
+    except wms.WMSError as e:
+        return Response(status_code=400, media_type="application/vnd.ogc.se_xml", content=wms.service_exception(e))
+
+
+async def get_wms_map_response(api_version, client_id, client_secret, request, parsed=None):
+    """
+        Answers a WMS GetMap request by fetching the WMTS tiles covering the bbox concurrently (through the same caches
+        and shared fetches as proxied tiles) and mosaicking them into the requested image. parsed is the request's
+        (GetMapRequest, TilePlan), if parse_wms_request has already been called for it.
+    """
+    from hexprox import wms
+
+    if parsed is None:
+        parsed = parse_wms_request(request)
+        if isinstance(parsed, Response):
+            return parsed
+    map_request, plan = parsed
+
+    try:
+        client = get_client(client_id, client_secret, api_version=api_version)
+        await client.get_token()  # fail once here rather than once per tile if the credentials are bad
+        refresh_tile_bounds(client)
+        tiles = await get_wms_tiles(client, plan.tiles, map_request.tile_extension)
+    except PermissionError:
+        return Response(status_code=403,
+                        content="Invalid credentials or inability to communicate with credential server")
+    except UPSTREAM_ERRORS as e:
+        return get_upstream_error_response(e)
+
+    content = await asyncio.to_thread(wms.render, map_request, plan, tiles)  # decoding, resampling and encoding are CPU bound - keep them off the event loop
+    etag = entity_tag(content)
+    headers = validator_headers(config.TILE_CACHE_CONTROL, etag)
+    if is_not_modified(request.headers, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=content, status_code=200, media_type=map_request.media_type, headers=headers)
+
+
+async def get_wms_tiles(client, tiles, ext):
+    """
+        Fetches the (zoom, row, col) tiles, at most WMS_TILE_CONCURRENCY at a time. Returns {(zoom, row, col): bytes},
+        with None for tiles Hexagon doesn't have.
+    """
+    semaphore = asyncio.Semaphore(config.WMS_TILE_CONCURRENCY)
+
+    async def fetch(tile):
+        async with semaphore:
+            cached_tile = await get_tile(client, *tile, ext)
+            return cached_tile.content if cached_tile is not None else None
+
+    contents = await asyncio.gather(*(fetch(tile) for tile in tiles))
+    return dict(zip(tiles, contents))
+
+
+async def get_tile(client, matrix, row, col, ext):
+    """
+        Returns the tile as a CachedTile for use within the proxy - from the local caches, an identical fetch already in
+        flight, or Hexagon - or None if Hexagon has no tile there. Falls back to a stale copy if Hexagon can't be reached.
+    """
+    if TILE_BOUNDS.contains(matrix, row, col) is False:
+        return None
+    cache_key = TILE_CACHE.key(matrix, row, col, ext)
+    tile = EMPTY_TILES.get(cache_key) or await get_local_tile(cache_key)
+    if tile is not None:
+        return tile
+
+    try:
+        tile = await TILE_FETCHES.run(cache_key, lambda: fetch_tile_content(client, cache_key, matrix, row, col, ext))
+    except UPSTREAM_ERRORS as e:
+        if isinstance(e, HexagonStatusError) and e.status_code == 404:
+            return None
+        tile = await get_local_tile(cache_key, allow_stale=True) if config.SERVE_STALE_ON_ERROR else None
+        if tile is None:
+            raise
+    return tile
+
+
+async def fetch_tile_content(client, cache_key, matrix, row, col, ext):
+    content, media_type = await client.get_tile_content(matrix=matrix, row=row, col=col, extension=ext)
+    media_type = media_type or get_tile_media_type(ext)
+    EMPTY_TILES.observe(cache_key, content, media_type)
+    if TILE_CACHE.enabled:
+        TILE_CACHE.put(cache_key, content, media_type)
+    if TILE_STORE is not None:
+        await asyncio.to_thread(TILE_STORE.put, cache_key, content, media_type)
+    return CachedTile(content, media_type, None)
+
+
+@app.get("/v2/wmts/{api_key}/batch")
+async def get_wmts_batch_v2(api_key: str, request: Request, background_tasks: BackgroundTasks) -> Response:
+    """
+        Many tiles in one request - see hexprox/batch.py. The tiles are fetched concurrently through the same caches and
+        shared fetches as proxied tiles, and each is streamed back as soon as it's ready, with its own status.
+    """
+    try:
+        tiles, ext = batch.parse_batch_params(request.query_params)
+    except batch.BatchRequestError as e:
+        return Response(status_code=400, content=str(e))
+
+    credentials = await API_KEY_MANAGER.get_credentials_for_api_key(api_key, KEY_VAULT_CLIENT, background_tasks, request)
+    try:
+        ticket = await REQUEST_LIMITS.acquire(api_key, API_KEY_MANAGER.org_for_api_key(api_key), cost=len(tiles))
+    except RateLimited as e:
+        return get_rate_limited_response(e)
+    tracking = ExitStack()  # the request limit and credential set stay in use until the last tile is sent, not just until the response starts
+    tracking.callback(REQUEST_LIMITS.release, ticket)
+    record_status = tracking.enter_context(API_KEY_MANAGER.scheduler.track(credentials))
+    try:
+        client = get_client(credentials['client_id'], credentials['client_secret'], api_version="v2")
+        await client.get_token()  # fail the whole batch here rather than every tile in it if the credentials are bad
+    except PermissionError:
+        record_status(403)
+        tracking.close()
+        return Response(status_code=403,
+                        content="Invalid credentials or inability to communicate with credential server")
+    except UPSTREAM_ERRORS as e:
+        response = get_upstream_error_response(e)
+        record_response(record_status, response)
+        tracking.close()
+        return response
+    refresh_tile_bounds(client)
+
+    boundary = uuid.uuid4().hex
+    return ReleasingStreamingResponse(stream_batch_tiles(client, tiles, ext, boundary, record_status, tracking),
+                                      release=tracking.close,
+                                      media_type=f"multipart/mixed; boundary={boundary}",
+                                      headers={"Cache-Control": "no-store", "X-Tile-Count": str(len(tiles))})
+
+
+async def stream_batch_tiles(client, tiles, ext, boundary, record_status, tracking):
+    """
+        Yields one multipart part per tile, in the order they finish, fetching at most BATCH_TILE_CONCURRENCY at a time.
+        If the client goes away part way, the tiles still to come are cancelled.
+    """
+    semaphore = asyncio.Semaphore(config.BATCH_TILE_CONCURRENCY)
+
+    async def fetch(tile):
+        async with semaphore:
+            return tile, await get_batch_tile(client, *tile, ext)
+
+    tasks = [asyncio.ensure_future(fetch(tile)) for tile in tiles]
+    try:
+        for next_tile in asyncio.as_completed(tasks):
+            tile, (status_code, media_type, content, retry_after) = await next_tile
+            record_status(status_code, retry_after)
+            yield batch.multipart_part(boundary, tile, ext, status_code, media_type, content)
+        yield batch.multipart_end(boundary)
+    finally:
+        for task in tasks:
+            task.cancel()
+        tracking.close()
+
+
+async def get_batch_tile(client, matrix, row, col, ext):
+    """
+        Returns (status_code, media_type, content, retry_after) for one tile of a batch. Failures become that tile's
+        status rather than failing the batch.
+    """
+    try:
+        tile = await get_tile(client, matrix, row, col, ext)
+    except PermissionError:
+        return 403, "text/plain", b"Invalid credentials or inability to communicate with credential server", None
+    except UPSTREAM_ERRORS as e:
+        response = get_upstream_error_response(e)
+        return response.status_code, "text/plain", response.body, parse_retry_after(response.headers.get("retry-after"))
+    if tile is None:
+        return 404, "text/plain", b"No tile here", None
+    metrics.TILE_RESPONSES.inc("batch")
+    return 200, tile.media_type, tile.content, None
 
 
 @app.get("/v1/wmts/{api_key}/{client_id}/{client_secret}/{rest_of_path:path}")
@@ -156,18 +730,31 @@ async def get_wmts_general(api_key: str, client_id: str, client_secret: str, res
 @app.get("/v2/wmts/{api_key}/{rest_of_path:path}")
 async def get_wmts_general_v2(api_key: str, rest_of_path: str, request: Request, background_tasks: BackgroundTasks) -> Response:
     credentials = await API_KEY_MANAGER.get_credentials_for_api_key(api_key, KEY_VAULT_CLIENT, background_tasks, request)
-    return await credentialed_wmts_service_response(api_key, "v2", credentials['client_id'], credentials['client_secret'], request,
-                                                   rest_of_path)
-
-async def credentialed_wmts_service_response(api_key, api_version, client_id, client_secret, request, rest_of_path, base_url=BASE_URL):
+    try:
+        with ExitStack() as tracking:
+            record_status = tracking.enter_context(API_KEY_MANAGER.scheduler.track(credentials))
+            response = await credentialed_wmts_service_response(api_key, "v2", credentials['client_id'], credentials['client_secret'], request,
+                                                                rest_of_path, limit=(api_key, API_KEY_MANAGER.org_for_api_key(api_key)))
+            record_response(record_status, response)
+            if isinstance(response, ReleasingStreamingResponse):  # passed through from upstream - still in use until it's been sent
+                response.add_release(tracking.pop_all().close)
+            return response
+    except RateLimited as e:
+        return get_rate_limited_response(e)
+
+async def credentialed_wmts_service_response(api_key, api_version, client_id, client_secret, request, rest_of_path, base_url=BASE_URL, limit=None):
+    """
+        limit is the (api_key, org) whose REQUEST_LIMITS a document fetched from Hexagon counts against - documents
+        served from CAPABILITIES_CACHE don't count
+    """
     try:
         client = get_client(client_id, client_secret, api_version=api_version)
-        response = client.get_general_response(rest_of_path, params=request.query_params)
+        document = await get_service_document(client, rest_of_path, request.query_params, limit)
     except PermissionError:  # this is still too coarse - we should raise better errors in Hexagon.py to differentiate here.
         return Response(status_code=403,
                         content="Invalid credentials or inability to communicate with credential server")
-    if "content-encoding" in response.headers:
-        del response.headers["content-encoding"]
+    except UPSTREAM_ERRORS as e:
+        return get_upstream_error_response(e)
 
     if api_version == "v1":
         current_base_url = f"{request.base_url}{api_version}/wmts/{api_key}/{client_id}/{client_secret}/"
@@ -176,9 +763,153 @@ async def credentialed_wmts_service_response(api_key, api_version, client_id, cl
             base_url = request.base_url
         current_base_url = f"{base_url}{api_version}/wmts/{api_key}/"
 
-    rewritten_content = response.content.decode("utf-8").replace("https://services.hxgncontent.com/streaming/wmts?/",
-                                                                 current_base_url)
-    return Response(status_code=response.status_code,
-                    # headers=response.headers,  # we may still want to translate *some* of these over
-                    media_type="application/xml",
-                    content=rewritten_content)
+    if isinstance(document, UncachedResponse):
+        return get_uncached_document_response(document, current_base_url)
+    if document.status_code != 200:
+        return get_service_document_response(document, current_base_url, {})
+
+    etag = document.entity_tag(current_base_url)
+    last_modified = parse_http_date(document.last_modified)
+    headers = validator_headers(config.CAPABILITIES_CACHE_CONTROL, etag, last_modified)
+    if is_not_modified(request.headers, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+    return get_service_document_response(document, current_base_url, headers)
+
+
+def get_service_document_response(document, base_url, headers):
+    """
+        Sends a service document rewritten for base_url. Every request served from the same document - from the cache
+        or coalesced onto the same fetch - sends its stored segments, rather than each rendering its own copy.
+    """
+    media_type = document.media_type or "application/xml"
+    if len(document.segments) == 1:  # nothing to rewrite - send the stored body as it is
+        return Response(status_code=document.status_code, headers=headers, media_type=media_type, content=document.segments[0])
+    headers["Content-Length"] = str(document.rendered_length(base_url))
+    return StreamingResponse(document.aiter_render(base_url), status_code=document.status_code, headers=headers, media_type=media_type)  # the stored segments go out between copies of the base URL, without being joined
+
+
+def get_uncached_document_response(uncached, base_url):
+    """
+        Streams an upstream response we aren't caching straight to the client - untouched if it's binary, or with the
+        Hexagon base URL rewritten as it arrives - and closes it once it's been sent
+    """
+    response = uncached.response
+    headers = {}
+    chunks = response.aiter_bytes(STREAM_CHUNK_SIZE)
+    if uncached.rewrite:
+        chunks = aiter_rewritten(chunks, hexagon.STREAMING_WMTS_URL.encode("utf-8"), base_url.encode("utf-8"))
+    elif "content-length" in response.headers and "content-encoding" not in response.headers:  # aiter_bytes decodes any content-encoding, so the upstream length only holds for unencoded bodies
+        headers["Content-Length"] = response.headers["content-length"]
+    return ReleasingStreamingResponse(chunks,
+                                      release=uncached.release,
+                                      status_code=response.status_code,
+                                      headers=headers,
+                                      media_type=response.headers.get("content-type"),
+                                      background=BackgroundTask(response.aclose))
+
+
+async def get_service_document(client, path, params, limit=None):
+    """
+        Returns the service document from CAPABILITIES_CACHE if we have a fresh copy. Otherwise fetches it (once, for
+        all concurrent requests for it), revalidating the stale copy if we have one. Fetches wait for a slot in
+        REQUEST_LIMITS for limit (api_key, org), if given.
+
+        Responses we don't cache come back as an UncachedResponse that only this caller can send, holding the slot
+        until it has been sent. Requests that were waiting on that fetch make their own.
+    """
+    await client.get_token()  # documents are shared across credential sets, so only hand them - cached, coalesced or fetched - to valid credentials. This is a no-op while the token is current
+    key = CAPABILITIES_CACHE.key(path, params)
+    document = CAPABILITIES_CACHE.get_fresh(key)
+    if document is not None:
+        return document
+
+    limits = ExitStack()
+    if limit is not None:
+        limits.callback(REQUEST_LIMITS.release, await REQUEST_LIMITS.acquire(*limit))
+    with limits:
+        fetch = None
+        while (in_flight := CAPABILITIES_FETCHES.join(key)) is not None:
+            try:
+                return await asyncio.shield(in_flight)
+            except FetchAbandoned:  # it was passed through rather than cached, or its request went away - fetch it ourselves
+                break
+        else:
+            fetch = CAPABILITIES_FETCHES.lead(key)
+
+        try:
+            document = await fetch_service_document(client, key, path, params)
+        except BaseException as e:
+            if fetch is not None:
+                CAPABILITIES_FETCHES.fail(key, fetch, e if isinstance(e, Exception) else None)
+            raise
+        if isinstance(document, UncachedResponse):
+            if fetch is not None:
+                CAPABILITIES_FETCHES.fail(key, fetch)
+            document.release = limits.pop_all().close  # the slot is held until the body has been sent
+        elif fetch is not None:
+            CAPABILITIES_FETCHES.finish(key, fetch, document)
+        return document
+
+
+async def fetch_service_document(client, key, path, params):
+    stale_document = CAPABILITIES_CACHE.get(key)
+    try:
+        response = await client.get_general_response(path, params=params, headers=CAPABILITIES_CACHE.revalidation_headers(stale_document), stream=True)
+    except UPSTREAM_ERRORS:
+        if stale_document is not None and config.SERVE_STALE_ON_ERROR:
+            return stale_document
+        raise
+    if response.status_code == 304 and stale_document is not None:
+        await response.aclose()
+        return CAPABILITIES_CACHE.revalidated(key, stale_document)
+    if (response.status_code >= 500 or response.status_code == 429) and stale_document is not None and config.SERVE_STALE_ON_ERROR:
+        await response.aclose()
+        return stale_document  # keep serving what we have while upstream is struggling - it'll be revalidated on the next request
+    if not CAPABILITIES_CACHE.is_cacheable(response):  # binary, or too large to keep - sent on as it arrives rather than read whole first
+        return UncachedResponse(response, rewrite=needs_rewriting(response.headers.get("content-type")))
+    try:
+        document = await CAPABILITIES_CACHE.store_streamed(key, response)  # split on the Hexagon URL as it arrives, rather than read whole and then searched
+    except httpx.TransportError:
+        if stale_document is not None and config.SERVE_STALE_ON_ERROR:
+            return stale_document
+        raise
+    if document.status_code == 200 and is_capabilities_document(path, params):
+        run_in_background(asyncio.to_thread(TILE_BOUNDS.update, document.render(hexagon.STREAMING_WMTS_URL)))
+    return document
+
+
+def is_capabilities_document(path, params):
+    return path.endswith("WMTSCapabilities.xml") or any(name.lower() == "request" and value.lower() == "getcapabilities" for name, value in params.items())
+
+
+def refresh_tile_bounds(client):
+    """
+        Starts rebuilding TILE_BOUNDS from the capabilities document in the background, if it's due. Only call this once
+        the client's credentials have proven good - otherwise anyone with made-up credentials could take the refresh and
+        fail it, holding off the next attempt for TILE_BOUNDS_RETRY_SECONDS.
+    """
+    if client.token_seconds_remaining > 0 and TILE_BOUNDS.start_refresh():
+        run_in_background(update_tile_bounds(client))
+
+
+async def update_tile_bounds(client):
+    succeeded = False
+    try:
+        document = await get_service_document(client, config.TILE_BOUNDS_CAPABILITIES_PATH, {})
+        if isinstance(document, UncachedResponse):  # not a document we can read the bounds from
+            await document.response.aclose()
+            if document.release is not None:
+                document.release()
+        elif document.status_code == 200:
+            succeeded = await asyncio.to_thread(TILE_BOUNDS.update, document.render(hexagon.STREAMING_WMTS_URL))
+    except (PermissionError, *UPSTREAM_ERRORS):
+        pass  # tiles are still allowed through - we'll try again after TILE_BOUNDS_RETRY_SECONDS
+    finally:
+        TILE_BOUNDS.finish_refresh(succeeded)
+
+
+def run_in_background(awaitable):
+    task = asyncio.ensure_future(awaitable)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
@@ -0,0 +1,23 @@
+from benchmarks.run import parse_args, run_scenario, make_requests, percentile
+
+
+def test_requests_are_reproducible():
+    import random
+    options = vars(parse_args(["--distinct-tiles", "4"]))
+    first = make_requests("proxy", 20, options, random.Random(1))
+    second = make_requests("proxy", 20, options, random.Random(1))
+
+    assert first == second
+    assert len(set(path for path, headers in first)) <= 4
+    assert percentile([1, 2, 3, 4], 0.5) == 2
+    assert percentile([1, 2, 3, 4], 0.99) == 4
+
+
+def test_proxy_scenario_runs_against_fake_hexagon():
+    options = vars(parse_args(["--requests", "20", "--warmup", "0", "--concurrency", "4", "--tile-latency", "0", "--distinct-tiles", "5"]))
+    result = run_scenario("proxy", options)
+
+    assert result["statuses"] == {"200": 20}
+    assert result["upstream"]["token_requests"] == 1
+    assert 1 <= result["upstream"]["tile_requests"] <= 5  # the rest come from the proxy's tile cache
+    assert result["requests_per_second"] > 0
@@ -0,0 +1,66 @@
+import os
+import threading
+
+from hexprox.client_registry import ClientRegistry
+from hexprox.hexagon import HexagonManager
+
+
+class FakeClient:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_least_recently_used_client_is_evicted_and_closed():
+    registry = ClientRegistry(max_clients=2, idle_seconds=60)
+    first = registry.get_or_create("first", FakeClient)
+    registry.get_or_create("second", FakeClient)
+    registry.get_or_create("first", FakeClient)
+    registry.get_or_create("third", FakeClient)
+
+    assert "second" not in registry
+    assert registry.get_or_create("first", FakeClient) is first
+    assert not first.closed
+    assert registry.stats()["evictions"] == 1
+
+
+def test_idle_clients_are_dropped():
+    registry = ClientRegistry(max_clients=10, idle_seconds=-1)
+    idle = registry.get_or_create("idle", FakeClient)
+    registry.get_or_create("other", FakeClient)
+
+    assert idle.closed
+    assert "idle" not in registry
+
+
+def test_idle_clients_are_dropped_without_new_lookups():
+    registry = ClientRegistry(max_clients=10, idle_seconds=-1)
+    idle = registry.get_or_create("idle", FakeClient)
+
+    assert registry.remove_idle() == 1
+    assert idle.closed
+    assert len(registry) == 0
+
+
+def test_concurrent_creation_makes_one_client():
+    registry = ClientRegistry(max_clients=10, idle_seconds=60)
+    clients = []
+    threads = [threading.Thread(target=lambda: clients.append(registry.get_or_create("shared", FakeClient))) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len({id(client) for client in clients}) == 1
+    assert registry.created == 1
+
+
+def test_closing_a_manager_removes_its_temp_folder():
+    manager = HexagonManager("test_id", "test_secret")
+    folder = manager.default_folder
+    assert os.path.isdir(folder)
+
+    manager.close()
+    assert not os.path.exists(folder)
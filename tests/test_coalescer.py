@@ -0,0 +1,66 @@
+import asyncio
+
+from hexprox.coalescer import RequestCoalescer
+
+
+def test_concurrent_runs_share_one_fetch():
+    coalescer = RequestCoalescer()
+    fetches = []
+
+    async def fetch():
+        fetches.append(1)
+        await asyncio.sleep(0.01)
+        return b"tile"
+
+    async def run():
+        return await asyncio.gather(*[coalescer.run((10, 1, 2, "png"), fetch) for _ in range(10)])
+
+    assert asyncio.run(run()) == [b"tile"] * 10
+    assert len(fetches) == 1
+    assert coalescer.stats() == {"in_flight": 0, "upstream_calls": 1, "coalesced_calls": 9}
+
+
+def test_waiters_get_the_leaders_error():
+    coalescer = RequestCoalescer()
+
+    async def fetch():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("Server returned alternative status code: 500")
+
+    async def run():
+        return await asyncio.gather(*[coalescer.run("key", fetch) for _ in range(3)], return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert coalescer.upstream_calls == 1
+
+
+def test_abandoned_fetch_lets_waiters_fetch_themselves():
+    coalescer = RequestCoalescer()
+
+    async def fetch():
+        return b"tile"
+
+    async def run():
+        future = coalescer.lead("key")
+        waiter = asyncio.ensure_future(coalescer.run("key", fetch))
+        await asyncio.sleep(0)
+        coalescer.fail("key", future)
+        return await waiter
+
+    assert asyncio.run(run()) == b"tile"
+    assert coalescer.upstream_calls == 2
+
+
+def test_late_leader_does_not_touch_a_newer_fetch():
+    async def run():
+        coalescer = RequestCoalescer()
+        old = coalescer.lead("key")
+        coalescer.finish("key", old, b"old tile")
+        new = coalescer.lead("key")
+        coalescer.fail("key", old)  # e.g. the old leader's response closing after it finished streaming
+        assert coalescer.join("key") is new and not new.done()
+        coalescer.finish("key", new, b"new tile")
+        return len(coalescer), new.result()
+
+    assert asyncio.run(run()) == (0, b"new tile")
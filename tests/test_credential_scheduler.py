@@ -0,0 +1,46 @@
+import pytest
+
+from hexprox.credential_scheduler import CredentialScheduler
+from hexprox.hexagon import HexagonStatusError
+
+SETS = [{"client_id": f"id{index}", "client_secret": "secret"} for index in range(3)]
+
+
+def test_picks_least_loaded_set():
+    scheduler = CredentialScheduler()
+    with scheduler.track(SETS[0]), scheduler.track(SETS[1]):
+        assert scheduler.choose(SETS) == 2
+
+
+def test_spreads_idle_load_across_sets():
+    scheduler = CredentialScheduler()
+    assert {scheduler.choose(SETS) for _ in range(3)} == {0, 1, 2}
+
+
+def test_throttled_set_is_benched():
+    scheduler = CredentialScheduler()
+    with pytest.raises(HexagonStatusError):
+        with scheduler.track(SETS[1]):
+            raise HexagonStatusError(429, b"slow down", {"retry-after": "120"})
+
+    assert 1 not in {scheduler.choose(SETS) for _ in range(10)}
+    assert scheduler.stats()["benched"] == 1
+
+
+def test_token_failure_benches_set():
+    scheduler = CredentialScheduler()
+    with scheduler.track(SETS[0]) as record_status:
+        record_status(403)
+    with scheduler.track(SETS[2]) as record_status:
+        record_status(429)
+
+    assert {scheduler.choose(SETS) for _ in range(10)} == {1}
+
+
+def test_all_benched_uses_first_back():
+    scheduler = CredentialScheduler()
+    scheduler.throttled(SETS[0], retry_after=300)
+    scheduler.throttled(SETS[1], retry_after=10)
+    scheduler.throttled(SETS[2], retry_after=200)
+
+    assert scheduler.choose(SETS) == 1
@@ -0,0 +1,34 @@
+from hexprox.empty_tiles import EmptyTileIndex, RangeSet
+
+
+def test_range_set_merges_neighbours():
+    columns = RangeSet()
+    for col in (5, 7, 3, 6, 4, 20):
+        columns.add(col)
+
+    assert columns.range_count == 2
+    assert len(columns) == 6
+    assert 4 in columns and 7 in columns and 20 in columns
+    assert 2 not in columns and 8 not in columns and 19 not in columns
+
+
+def test_small_payload_becomes_blank_tile_after_repeats():
+    index = EmptyTileIndex(max_bytes=100, min_repeats=3, ttl_seconds=60)
+    index.observe((5, 1, 1, "jpg"), b"blank", "image/jpeg")
+    index.observe((5, 1, 2, "jpg"), b"blank", "image/jpeg")
+    index.observe((5, 1, 3, "jpg"), b"x" * 500, "image/jpeg")  # real imagery is never indexed
+    assert index.get((5, 1, 1, "jpg")) is None
+
+    index.observe((5, 2, 1, "jpg"), b"blank", "image/jpeg")
+    index.observe((5, 2, 2, "jpg"), b"other", "image/jpeg")  # small, but not the blank tile
+    assert index.get((5, 1, 1, "jpg")).content == b"blank"
+    assert index.get((5, 2, 1, "jpg")) is index.get((5, 1, 2, "jpg"))  # one shared copy
+    assert index.get((5, 2, 2, "jpg")) is None
+    assert index.get((5, 1, 1, "png")) is None  # no blank png yet
+    assert index.stats()["empty_tiles"] == 3
+
+
+def test_index_resets_after_ttl():
+    index = EmptyTileIndex(max_bytes=100, min_repeats=1, ttl_seconds=0)
+    index.observe((5, 1, 1, "jpg"), b"blank", "image/jpeg")
+    assert index.get((5, 1, 1, "jpg")) is None
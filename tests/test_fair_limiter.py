@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+from hexprox.fair_limiter import FairLimiter, RateLimited
+
+
+def test_queued_requests_are_admitted_round_robin_across_orgs():
+    limiter = FairLimiter(key_concurrency=None, org_concurrency=None, instance_concurrency=1, key_rate=None, org_rate=None, max_wait_seconds=5)
+    admitted = []
+
+    async def request(api_key, org):
+        ticket = await limiter.acquire(api_key, org)
+        admitted.append(api_key)
+        await asyncio.sleep(0.01)
+        limiter.release(ticket)
+
+    async def run():
+        # the seeding org queues three requests before the interactive one arrives
+        await asyncio.gather(request("seed", "Org A"), request("seed", "Org A"), request("seed", "Org A"), request("web", "Org B"))
+
+    asyncio.run(run())
+    assert admitted == ["seed", "seed", "web", "seed"]
+    assert limiter.stats()["in_flight"] == 0
+    assert limiter.stats()["queued"] == 3
+
+
+def test_rate_limited_bursts_wait_then_get_rejected():
+    async def run(max_wait_seconds):
+        limiter = FairLimiter(key_rate=20, key_burst=1, max_wait_seconds=max_wait_seconds)
+        async with limiter.slot("key", "org"):
+            pass
+        async with limiter.slot("key", "org"):  # waits about 0.05 seconds for a token
+            pass
+        return limiter.stats()
+
+    assert asyncio.run(run(1))["admitted"] == 2
+    with pytest.raises(RateLimited) as error:
+        asyncio.run(run(0.01))
+    assert error.value.scope == "key" and error.value.retry_after == 1
+
+
+def test_one_keys_limit_doesnt_hold_up_other_keys():
+    async def run():
+        limiter = FairLimiter(key_concurrency=1, max_wait_seconds=0.05)
+        await limiter.acquire("busy", "Org A")
+        with pytest.raises(RateLimited):
+            await limiter.acquire("busy", "Org A")
+        await limiter.acquire("other", "Org A")
+        return limiter.stats()
+
+    assert asyncio.run(run())["in_flight"] == 2
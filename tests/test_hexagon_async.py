@@ -0,0 +1,116 @@
+import asyncio
+import os
+
+import httpx
+import pytest
+
+from hexprox.hexagon import AsyncHexagonManager, STREAMING_WMTS_URL, PARAMS
+from hexprox.tile_store import SQLiteTileStore
+
+
+def make_transport(calls, tile_status=200):
+    def handler(request: httpx.Request):
+        calls.append(str(request.url))
+        if "oauth/token" in str(request.url):
+            return httpx.Response(200, json={"access_token": "fake-token", "expires_in": 3600})
+        if str(request.url).startswith(STREAMING_WMTS_URL.rstrip("?/")):
+            return httpx.Response(tile_status, content=b"tile-bytes", headers={"Content-Type": "image/jpeg"})
+        return httpx.Response(404)
+    return httpx.MockTransport(handler)
+
+
+def make_manager(calls, tile_store=None, **kwargs):
+    http_client = httpx.AsyncClient(transport=make_transport(calls, **kwargs))
+    return AsyncHexagonManager("test_id", "test_secret", wmts_url=STREAMING_WMTS_URL, tile_store=tile_store, http_client=http_client)
+
+
+def test_async_token_is_reused():
+    calls = []
+    manager = make_manager(calls)
+
+    async def run():
+        return [await manager.get_token() for _ in range(3)]
+
+    assert asyncio.run(run()) == ["fake-token"] * 3
+    assert len([c for c in calls if "oauth/token" in c]) == 1
+
+
+def test_async_get_tile_url_only_and_stream():
+    calls = []
+    manager = make_manager(calls)
+
+    async def run():
+        url = await manager.get_tile(matrix=10, row=1, col=2, url_only=True, extension="jpg")
+        response = await manager.get_tile(matrix=10, row=1, col=2, stream=True, extension="jpg")
+        return url, response
+
+    url, response = asyncio.run(run())
+    assert url == f"{STREAMING_WMTS_URL}{PARAMS}10/1/2.jpg&access_token=fake-token"
+    assert response.content == b"tile-bytes"
+
+
+def test_async_get_tile_error_status():
+    calls = []
+    manager = make_manager(calls, tile_status=500)
+
+    async def run():
+        await manager.get_tile(matrix=10, row=1, col=2, stream=True)
+
+    with pytest.raises(RuntimeError, match="500"):
+        asyncio.run(run())
+
+
+def test_async_download_reads_tile_store_first(tmp_path):
+    calls = []
+    store = SQLiteTileStore(path=os.path.join(tmp_path, "tiles.mbtiles"), ttl_seconds=60, max_bytes=1024)
+    manager = make_manager(calls, tile_store=store)
+
+    async def run():
+        first = await manager.get_tile(matrix=10, row=1, col=2, path=os.path.join(tmp_path, "first.png"))
+        second = await manager.get_tile(matrix=10, row=1, col=2, path=os.path.join(tmp_path, "second.png"))
+        return first, second
+
+    first, second = asyncio.run(run())
+    with open(second, "rb") as tile:
+        assert tile.read() == b"tile-bytes"
+    assert len([c for c in calls if "oauth/token" not in c]) == 1
+
+
+def test_concurrent_token_requests_share_one_refresh():
+    calls = []
+    manager = make_manager(calls)
+
+    async def run():
+        tokens = await asyncio.gather(*[manager.get_token() for _ in range(20)])
+        manager.close()
+        return tokens
+
+    assert asyncio.run(run()) == ["fake-token"] * 20
+    assert len([c for c in calls if "oauth/token" in c]) == 1
+    assert manager.token_manager.shared_waits == 19
+
+
+def test_token_is_renewed_in_the_background():
+    calls = []
+    manager = make_manager(calls)
+    manager.token_manager.refresh_fraction = 0.00001  # renew after ~36ms of a 3600s token
+
+    async def run():
+        await manager.get_token()
+        await asyncio.sleep(0.2)
+        manager.close()
+
+    asyncio.run(run())
+    assert manager.token_manager.background_refreshes >= 1
+    assert len([c for c in calls if "oauth/token" in c]) >= 2
+
+
+def test_async_general_response_keeps_path_in_query():
+    calls = []
+    manager = make_manager(calls)
+
+    async def run():
+        await manager.get_general_response("1.0.0/WMTSCapabilities.xml", params={"service": "WMTS"})
+
+    asyncio.run(run())
+    assert calls[-1] == f"{STREAMING_WMTS_URL}1.0.0/WMTSCapabilities.xml&access_token=fake-token&service=WMTS"
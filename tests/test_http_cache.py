@@ -0,0 +1,23 @@
+from hexprox import config
+from hexprox.http_cache import entity_tag, http_date, is_not_modified, redirect_cache_control
+
+
+def test_if_none_match_takes_precedence_and_uses_weak_comparison():
+    etag = entity_tag(b"tile")
+    assert is_not_modified({"if-none-match": etag}, etag, 1000)
+    assert is_not_modified({"if-none-match": f'"other", W/{etag}'}, etag, 1000)
+    assert not is_not_modified({"if-none-match": '"other"', "if-modified-since": http_date(2000)}, etag, 1000)
+
+
+def test_if_modified_since():
+    assert is_not_modified({"if-modified-since": http_date(1000)}, None, 1000.5)
+    assert not is_not_modified({"if-modified-since": http_date(999)}, None, 1000)
+    assert not is_not_modified({"if-modified-since": "not a date"}, None, 1000)
+    assert not is_not_modified({}, entity_tag(b"tile"), 1000)
+
+
+def test_redirects_are_not_cached_past_their_token():
+    assert redirect_cache_control(config.REDIRECT_MAX_AGE_SECONDS * 10).startswith("private")  # the URL holds a token - keep it out of shared caches
+    assert redirect_cache_control(config.REDIRECT_MAX_AGE_SECONDS * 10).endswith(f"max-age={config.REDIRECT_MAX_AGE_SECONDS}")
+    assert redirect_cache_control(config.REDIRECT_TOKEN_MARGIN_SECONDS + 120).endswith("max-age=120")
+    assert redirect_cache_control(config.REDIRECT_TOKEN_MARGIN_SECONDS) == "no-store"
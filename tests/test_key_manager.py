@@ -0,0 +1,91 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+from azure.core import exceptions as azure_exceptions
+from fastapi import BackgroundTasks, HTTPException
+
+from hexprox.key_manager import APIKeyManager
+
+
+class FakeSecret:
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeSecretClient:
+    """Blocking stand-in for azure.keyvault.secrets.SecretClient"""
+    def __init__(self, secrets):
+        self.secrets = secrets
+        self.calls = 0
+        self.threads = set()
+
+    def get_secret(self, name):
+        self.calls += 1
+        self.threads.add(threading.get_ident())
+        time.sleep(0.02)
+        if name not in self.secrets:
+            raise azure_exceptions.ResourceNotFoundError("Secret not found")
+        return FakeSecret(self.secrets[name])
+
+
+CREDENTIAL_SET = json.dumps({"count": 1, "sets": [{"client_id": "id", "client_secret": "secret"}], "org": "Test Org"})
+
+
+def test_concurrent_first_lookups_share_one_key_vault_call():
+    key_vault = FakeSecretClient({"credential-set-goodkey": CREDENTIAL_SET})
+    manager = APIKeyManager()
+
+    async def run():
+        return await asyncio.gather(*[manager.get_credentials_for_api_key("goodkey", key_vault, BackgroundTasks(), None) for _ in range(10)])
+
+    results = asyncio.run(run())
+    assert all(result == {"client_id": "id", "client_secret": "secret"} for result in results)
+    assert key_vault.calls == 1
+    assert threading.get_ident() not in key_vault.threads  # the blocking call ran off the event loop thread
+    assert manager.stats()["coalesced_lookups"] == 9
+
+
+def test_invalid_keys_are_negatively_cached():
+    key_vault = FakeSecretClient({})
+    manager = APIKeyManager(invalid_key_seconds=60)
+
+    async def lookup():
+        with pytest.raises(HTTPException) as error:
+            await manager.get_credentials_for_api_key("badkey", key_vault, BackgroundTasks(), None)
+        assert error.value.status_code == 403
+
+    for _ in range(5):
+        asyncio.run(lookup())
+
+    assert key_vault.calls == 1
+    assert manager.stats()["invalid_key_cache_hits"] == 4
+
+
+def test_negative_cache_entries_expire():
+    key_vault = FakeSecretClient({})
+    manager = APIKeyManager(invalid_key_seconds=-1)
+
+    async def lookup():
+        with pytest.raises(HTTPException):
+            await manager.get_credentials_for_api_key("badkey", key_vault, BackgroundTasks(), None)
+
+    asyncio.run(lookup())
+    asyncio.run(lookup())
+    assert key_vault.calls == 2
+
+
+def test_preload_loads_valid_keys_and_skips_missing_ones():
+    key_vault = FakeSecretClient({"credential-set-goodkey": CREDENTIAL_SET})
+    manager = APIKeyManager()
+
+    async def run():
+        return await manager.preload("goodkey", key_vault), await manager.preload("badkey", key_vault), await manager.preload("goodkey", key_vault)
+
+    loaded, missing, again = asyncio.run(run())
+    assert loaded["org"] == "Test Org"
+    assert missing is None
+    assert again is loaded
+    assert key_vault.calls == 2
@@ -0,0 +1,413 @@
+import asyncio
+import base64
+import json
+import time
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from hexprox import hexagon, resilience
+from hexprox.capabilities_cache import CapabilitiesCache
+from hexprox.client_registry import ClientRegistry
+from hexprox.coalescer import RequestCoalescer
+from hexprox.empty_tiles import EmptyTileIndex
+from hexprox.fair_limiter import FairLimiter
+from hexprox.tile_bounds import TileBoundsIndex
+from hexprox.key_manager import APIKeyManager
+from hexprox.tile_cache import TileCache
+from tests.test_key_manager import FakeSecretClient
+from tests.test_tile_bounds import CAPABILITIES_WITH_LIMITS
+
+CLIENT_ID = base64.b64encode(b"test_id").decode()
+CLIENT_SECRET = base64.b64encode(b"test_secret").decode()
+TILE_PATH = f"/v1/wmts/fakekey/{CLIENT_ID}/{CLIENT_SECRET}/1.0.0/HxGN_Imagery/default/WebMercator"
+BROWSER_HEADERS = {"Origin": "https://gis.conservation.ca.gov"}
+
+
+class FakeHexagon:
+    """Stands in for Hexagon's token and tile endpoints via an httpx MockTransport"""
+    def __init__(self):
+        self.tile_calls = 0
+        self.token_calls = 0
+        self.token_status = 200
+        self.tile_body = b"\xff\xd8" + b"j" * 4000
+        self.capabilities_calls = 0
+        self.tile_status = 200
+        self.tile_error_headers = {}
+        self.missing_tiles = set()  # tile paths ("10/1/2.jpg") that return a 404
+        self.capabilities_body = f'<Capabilities><ResourceURL template="{hexagon.STREAMING_WMTS_URL}1.0.0/{{TileMatrix}}"/></Capabilities>'.encode()
+
+    def handler(self, request: httpx.Request):
+        if "oauth/token" in str(request.url):
+            self.token_calls += 1
+            if self.token_status != 200:
+                return httpx.Response(self.token_status, json={"error": "invalid_client"})
+            return httpx.Response(200, json={"access_token": "fake-token", "expires_in": 3600})
+        if "WMTSCapabilities" in str(request.url):
+            self.capabilities_calls += 1
+            if request.headers.get("If-None-Match") == '"v1"':
+                return httpx.Response(304)
+            return httpx.Response(200, content=self.capabilities_body, headers={"Content-Type": "application/xml", "ETag": '"v1"'})
+        self.tile_calls += 1
+        if any(f"/{path}&" in str(request.url) for path in self.missing_tiles):
+            return httpx.Response(404)
+        if self.tile_status != 200:
+            return httpx.Response(self.tile_status, headers=self.tile_error_headers)
+        return httpx.Response(200, content=self.tile_body, headers={"Content-Type": "image/jpeg"})
+
+
+@pytest.fixture
+def fake_hexagon(monkeypatch):
+    fake = FakeHexagon()
+    monkeypatch.setattr(hexagon, "_ASYNC_HTTP_CLIENT", httpx.AsyncClient(transport=httpx.MockTransport(fake.handler)))
+    monkeypatch.setattr(main, "CLIENTS", ClientRegistry())
+    monkeypatch.setattr(main, "TILE_CACHE", TileCache(max_bytes=1024 * 1024, ttl_seconds=60))
+    monkeypatch.setattr(main, "TILE_FETCHES", RequestCoalescer())
+    monkeypatch.setattr(main, "REQUEST_LIMITS", FairLimiter())
+    monkeypatch.setattr(main, "EMPTY_TILES", EmptyTileIndex())
+    monkeypatch.setattr(main, "TILE_BOUNDS", TileBoundsIndex(refresh_seconds=0))
+    monkeypatch.setattr(main, "CAPABILITIES_CACHE", CapabilitiesCache(ttl_seconds=60))
+    monkeypatch.setattr(main, "CAPABILITIES_FETCHES", RequestCoalescer())
+    monkeypatch.setattr(resilience, "_BREAKERS", {})
+    return fake
+
+
+def test_browser_tile_is_streamed_with_upstream_headers(fake_hexagon):
+    client = TestClient(main.app)
+    response = client.get(f"{TILE_PATH}/10/1/2.jpg", headers=BROWSER_HEADERS)
+
+    assert response.status_code == 200
+    assert response.content == fake_hexagon.tile_body
+    assert response.headers["content-type"] == "image/jpeg"
+    assert response.headers["content-length"] == str(len(fake_hexagon.tile_body))
+
+
+def test_desktop_tile_is_redirected(fake_hexagon):
+    client = TestClient(main.app)
+    response = client.get(f"{TILE_PATH}/10/1/2.jpg", follow_redirects=False)
+
+    assert response.status_code == 307
+    assert response.headers["location"].endswith("10/1/2.jpg&access_token=fake-token")
+    assert fake_hexagon.tile_calls == 0
+
+
+def test_browser_tile_is_served_from_cache_on_repeat(fake_hexagon):
+    client = TestClient(main.app)
+    first = client.get(f"{TILE_PATH}/10/1/2.jpg", headers=BROWSER_HEADERS)
+    second = client.get(f"{TILE_PATH}/10/1/2.jpg", headers=BROWSER_HEADERS)
+
+    assert first.content == second.content == fake_hexagon.tile_body
+    assert second.headers["content-type"] == "image/jpeg"
+    assert fake_hexagon.tile_calls == 1
+    assert main.TILE_CACHE.hits == 1
+
+
+def test_capabilities_are_cached_and_rewritten_per_key(fake_hexagon):
+    client = TestClient(main.app)
+    first = client.get(f"/v1/wmts/firstkey/{CLIENT_ID}/{CLIENT_SECRET}/1.0.0/WMTSCapabilities.xml?service=WMTS")
+    second = client.get(f"/v1/wmts/secondkey/{CLIENT_ID}/{CLIENT_SECRET}/1.0.0/WMTSCapabilities.xml?SERVICE=WMTS")
+
+    assert first.status_code == second.status_code == 200
+    assert f"/v1/wmts/firstkey/{CLIENT_ID}/{CLIENT_SECRET}/1.0.0/{{TileMatrix}}" in first.text
+    assert f"/v1/wmts/secondkey/{CLIENT_ID}/{CLIENT_SECRET}/1.0.0/{{TileMatrix}}" in second.text
+    assert hexagon.STREAMING_WMTS_URL not in second.text
+    assert second.headers["content-length"] == str(len(second.content))
+    assert fake_hexagon.capabilities_calls == 1
+
+
+def test_binary_responses_on_the_general_path_pass_through_untouched(fake_hexagon):
+    fake_hexagon.tile_body = b"\x89PNG" + hexagon.STREAMING_WMTS_URL.encode() + b"\x00" * 100
+    response = TestClient(main.app).get(f"/v1/wmts/firstkey/{CLIENT_ID}/{CLIENT_SECRET}/legend/image.png")
+
+    assert response.status_code == 200
+    assert response.content == fake_hexagon.tile_body
+    assert response.headers["content-type"] == "image/jpeg"  # as upstream labelled it
+    assert len(main.CAPABILITIES_CACHE) == 0  # only documents with URLs to rewrite are kept
+    assert response.headers["content-length"] == str(len(fake_hexagon.tile_body))
+
+
+def test_documents_too_large_to_cache_are_rewritten_as_they_stream(fake_hexagon, monkeypatch):
+    monkeypatch.setattr(main, "CAPABILITIES_CACHE", CapabilitiesCache(ttl_seconds=60, max_document_bytes=10))
+    client = TestClient(main.app)
+    for _ in range(2):
+        response = client.get(f"/v1/wmts/firstkey/{CLIENT_ID}/{CLIENT_SECRET}/1.0.0/WMTSCapabilities.xml")
+        assert response.status_code == 200
+        assert f"/v1/wmts/firstkey/{CLIENT_ID}/{CLIENT_SECRET}/1.0.0/{{TileMatrix}}" in response.text
+        assert hexagon.STREAMING_WMTS_URL not in response.text
+    assert len(main.CAPABILITIES_CACHE) == 0
+    assert fake_hexagon.capabilities_calls == 2
+
+
+def test_stale_capabilities_are_revalidated(fake_hexagon):
+    main.CAPABILITIES_CACHE.ttl_seconds = -1
+    client = TestClient(main.app)
+    first = client.get(f"/v1/wmts/firstkey/{CLIENT_ID}/{CLIENT_SECRET}/1.0.0/WMTSCapabilities.xml")
+    second = client.get(f"/v1/wmts/firstkey/{CLIENT_ID}/{CLIENT_SECRET}/1.0.0/WMTSCapabilities.xml")
+
+    assert first.text == second.text
+    assert fake_hexagon.capabilities_calls == 2
+    assert main.CAPABILITIES_CACHE.revalidations == 1
+
+
+def test_stale_tile_is_served_when_upstream_fails(fake_hexagon, monkeypatch):
+    monkeypatch.setattr(main, "TILE_CACHE", TileCache(max_bytes=1024 * 1024, ttl_seconds=-1))  # everything is stale as soon as it's cached
+    client = TestClient(main.app)
+    client.get(f"{TILE_PATH}/10/1/2.jpg", headers=BROWSER_HEADERS)
+
+    fake_hexagon.tile_status = 503
+    response = client.get(f"{TILE_PATH}/10/1/2.jpg", headers=BROWSER_HEADERS)
+
+    assert response.status_code == 200
+    assert response.content == fake_hexagon.tile_body
+    assert "stale" in response.headers["warning"].lower()
+    assert main.TILE_CACHE.stale_hits == 1
+
+
+def test_upstream_errors_are_mapped_without_stale_copy(fake_hexagon):
+    client = TestClient(main.app)
+    fake_hexagon.tile_status = 503
+    assert client.get(f"{TILE_PATH}/10/1/2.jpg", headers=BROWSER_HEADERS).status_code == 502
+
+    fake_hexagon.tile_status = 404
+    assert client.get(f"{TILE_PATH}/10/1/3.jpg", headers=BROWSER_HEADERS).status_code == 404
+
+
+def test_metrics_endpoint_reports_routes_and_tiles_without_secrets(fake_hexagon):
+    client = TestClient(main.app)
+    client.get(f"{TILE_PATH}/10/1/2.jpg", headers=BROWSER_HEADERS)
+    client.get(f"{TILE_PATH}/10/1/2.jpg", headers=BROWSER_HEADERS)
+    client.get(f"{TILE_PATH}/10/1/3.jpg", follow_redirects=False)
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert 'hexprox_tile_responses_total{mode="cache"}' in response.text
+    assert 'hexprox_tile_responses_total{mode="redirect"}' in response.text
+    assert 'hexprox_upstream_seconds_count{kind="token"}' in response.text
+    assert 'route="/v1/wmts/{api_key}/{client_id}/{client_secret}/1.0.0/HxGN_Imagery/default/WebMercator/{matrix}/{row}/{col}.{ext}"' in response.text
+    assert "hexprox_tile_cache_hit_ratio" in response.text
+    assert "hexprox_circuit_breakers_rejected 0" in response.text
+    assert "fake-token" not in response.text
+
+
+def test_cached_tile_answers_conditional_requests_without_upstream(fake_hexagon):
+    client = TestClient(main.app)
+    client.get(f"{TILE_PATH}/10/1/2.jpg", headers=BROWSER_HEADERS)
+    cached = client.get(f"{TILE_PATH}/10/1/2.jpg", headers=BROWSER_HEADERS)
+    assert cached.headers["cache-control"] == main.config.TILE_CACHE_CONTROL
+    assert "last-modified" in cached.headers
+
+    revalidated = client.get(f"{TILE_PATH}/10/1/2.jpg", headers={**BROWSER_HEADERS, "If-None-Match": cached.headers["etag"]})
+    assert revalidated.status_code == 304
+    assert revalidated.headers["etag"] == cached.headers["etag"]
+    assert revalidated.content == b""
+    assert fake_hexagon.tile_calls == 1
+
+
+def test_redirect_cache_lifetime_is_bounded_by_token(fake_hexagon):
+    client = TestClient(main.app)
+    response = client.get(f"{TILE_PATH}/10/1/2.jpg", follow_redirects=False)
+
+    max_age = int(response.headers["cache-control"].split("max-age=")[1])
+    assert 0 < max_age <= min(main.config.REDIRECT_MAX_AGE_SECONDS, 3600 - main.config.REDIRECT_TOKEN_MARGIN_SECONDS)
+
+
+def test_capabilities_answer_conditional_requests(fake_hexagon):
+    client = TestClient(main.app)
+    path = f"/v1/wmts/firstkey/{CLIENT_ID}/{CLIENT_SECRET}/1.0.0/WMTSCapabilities.xml"
+    first = client.get(path)
+    second = client.get(path, headers={"If-None-Match": first.headers["etag"]})
+
+    assert second.status_code == 304
+    assert fake_hexagon.capabilities_calls == 1
+
+
+def test_warm_up_preloads_credentials_and_tokens(fake_hexagon, monkeypatch):
+    credential_set = json.dumps({"count": 2, "sets": [{"client_id": "id-a", "client_secret": "secret-a"}, {"client_id": "id-b", "client_secret": "secret-b"}], "org": "Test Org"})
+    key_vault = FakeSecretClient({"credential-set-warmkey": credential_set})
+    monkeypatch.setattr(main, "KEY_VAULT_CLIENT", key_vault)
+    monkeypatch.setattr(main, "API_KEY_MANAGER", APIKeyManager())
+
+    summary = asyncio.run(main.warm_up(["warmkey", "missingkey"]))
+    assert summary["credential_sets"] == 2
+    assert summary["failures"] == 1
+    assert fake_hexagon.token_calls == 2
+
+    response = TestClient(main.app).get("/v2/wmts/warmkey/1.0.0/HxGN_Imagery/default/WebMercator/10/1/2.jpg", follow_redirects=False)
+    assert response.status_code == 307
+    assert key_vault.calls == 2  # one per key during warm-up, none for the request
+    assert fake_hexagon.token_calls == 2
+
+
+def test_known_blank_tiles_are_answered_without_upstream(fake_hexagon, monkeypatch):
+    monkeypatch.setattr(main, "EMPTY_TILES", EmptyTileIndex(max_bytes=1000, min_repeats=2, ttl_seconds=60))
+    fake_hexagon.tile_body = b"\xff\xd8 blank"
+    client = TestClient(main.app)
+    for col in (1, 2):
+        client.get(f"{TILE_PATH}/10/1/{col}.jpg", headers=BROWSER_HEADERS)
+    calls = (fake_hexagon.tile_calls, fake_hexagon.token_calls)
+
+    main.CLIENTS.clear()  # a new client would need a token for anything that went upstream
+    for headers in (BROWSER_HEADERS, {}):
+        response = client.get(f"{TILE_PATH}/10/1/1.jpg", headers=headers, follow_redirects=False)
+        assert response.status_code == 200
+        assert response.content == fake_hexagon.tile_body
+    assert (fake_hexagon.tile_calls, fake_hexagon.token_calls) == calls
+
+
+def test_tiles_outside_the_tile_matrix_are_rejected_locally(fake_hexagon, monkeypatch):
+    monkeypatch.setattr(main, "TILE_BOUNDS", TileBoundsIndex(refresh_seconds=60))
+    fake_hexagon.capabilities_body = CAPABILITIES_WITH_LIMITS
+    with TestClient(main.app) as client:
+        assert client.get(f"{TILE_PATH}/10/1/2.jpg", follow_redirects=False).status_code == 307  # allowed until the limits are known
+        deadline = time.monotonic() + 5
+        while main.BACKGROUND_TASKS and time.monotonic() < deadline:  # the limits are read in the background
+            time.sleep(0.01)
+        assert fake_hexagon.capabilities_calls == 1
+
+        for path in ("10/1/2.jpg", "10/1/3000.jpg", "25/1/2.jpg"):
+            response = client.get(f"{TILE_PATH}/{path}", headers=BROWSER_HEADERS)
+            assert response.status_code == 404
+        assert client.get(f"{TILE_PATH}/10/400/170.jpg", follow_redirects=False).status_code == 307
+    assert fake_hexagon.tile_calls == 0
+
+
+def parse_multipart(response):
+    """Returns {Content-Location: (X-Tile-Status, Content-Type, body)} from a multipart/mixed batch response"""
+    boundary = response.headers["content-type"].split("boundary=")[1].encode()
+    parts = {}
+    for part in response.content.split(b"--" + boundary)[1:-1]:
+        head, body = part[2:].split(b"\r\n\r\n", 1)
+        headers = dict(line.split(": ", 1) for line in head.decode().split("\r\n"))
+        assert len(body) == int(headers["Content-Length"]) + 2  # plus the line break before the next boundary
+        parts[headers["Content-Location"]] = (int(headers["X-Tile-Status"]), headers["Content-Type"], body[:-2])
+    return parts
+
+
+def test_batch_streams_tiles_with_their_own_status(fake_hexagon, monkeypatch):
+    monkeypatch.setattr(main, "KEY_VAULT_CLIENT", FakeSecretClient({"credential-set-batchkey": json.dumps({"count": 1, "sets": [{"client_id": "id", "client_secret": "secret"}], "org": "Test Org"})}))
+    monkeypatch.setattr(main, "API_KEY_MANAGER", APIKeyManager())
+    fake_hexagon.missing_tiles = {"10/1/3.jpg"}
+    client = TestClient(main.app)
+
+    response = client.get("/v2/wmts/batchkey/batch", params={"tiles": "10/1/2,10/1/3,10/1/2"})
+    assert response.status_code == 200
+    parts = parse_multipart(response)
+    assert parts["10/1/2.jpg"] == (200, "image/jpeg", fake_hexagon.tile_body)
+    assert parts["10/1/3.jpg"][0] == 404
+    assert (fake_hexagon.tile_calls, fake_hexagon.token_calls) == (2, 1)  # duplicates fetched once, one token for the batch
+    assert main.API_KEY_MANAGER.scheduler.stats()["in_flight"] == 0
+
+    response = client.get("/v2/wmts/batchkey/batch", params={"bbox": "-122.5,37.7,-122.3,37.9", "zoom": "10", "ext": "jpg"})
+    parts = parse_multipart(response)
+    assert len(parts) == 4 and all(status == 200 for status, _, _ in parts.values())
+
+    for params in ({"tiles": "10/1"}, {"tiles": "10/1/2", "ext": "gif"}, {"bbox": "-180,-85,180,85", "zoom": "12"}, {}):
+        assert client.get("/v2/wmts/batchkey/batch", params=params).status_code == 400
+
+
+def test_requests_over_an_api_keys_rate_get_a_429(fake_hexagon, monkeypatch):
+    monkeypatch.setattr(main, "KEY_VAULT_CLIENT", FakeSecretClient({"credential-set-busykey": json.dumps({"count": 1, "sets": [{"client_id": "id", "client_secret": "secret"}], "org": "Busy Org"})}))
+    monkeypatch.setattr(main, "API_KEY_MANAGER", APIKeyManager())
+    monkeypatch.setattr(main, "REQUEST_LIMITS", FairLimiter(key_rate=1, key_burst=1, max_wait_seconds=0))
+    client = TestClient(main.app)
+
+    path = "/v2/wmts/busykey/1.0.0/HxGN_Imagery/default/WebMercator/10/1"
+    assert client.get(f"{path}/2.jpg", headers=BROWSER_HEADERS).status_code == 200
+    response = client.get(f"{path}/3.jpg", headers=BROWSER_HEADERS)
+    assert response.status_code == 429
+    assert response.headers["retry-after"] == "1"
+    assert main.REQUEST_LIMITS.stats()["in_flight"] == 0
+
+    # tiles we already hold and redirects don't use upstream capacity, so they aren't limited
+    assert client.get(f"{path}/2.jpg", headers=BROWSER_HEADERS).status_code == 200
+    assert client.get(f"{path}/3.jpg", follow_redirects=False).status_code == 307
+    assert main.REQUEST_LIMITS.stats()["admitted"] == 1
+
+    # nor do capabilities documents served from the cache
+    time.sleep(1)  # let the key's token bucket refill for the one fetch
+    for _ in range(2):
+        assert client.get("/v2/wmts/busykey/1.0.0/WMTSCapabilities.xml").status_code == 200
+    assert main.REQUEST_LIMITS.stats()["admitted"] == 2
+
+
+def test_batch_releases_its_limits_when_the_client_leaves_before_the_body(fake_hexagon, monkeypatch):
+    monkeypatch.setattr(main, "KEY_VAULT_CLIENT", FakeSecretClient({"credential-set-batchkey": json.dumps({"count": 1, "sets": [{"client_id": "id", "client_secret": "secret"}], "org": "Test Org"})}))
+    monkeypatch.setattr(main, "API_KEY_MANAGER", APIKeyManager())
+    scope = {"type": "http", "asgi": {"version": "3.0", "spec_version": "2.4"}, "http_version": "1.1", "method": "GET",
+             "scheme": "http", "path": "/v2/wmts/batchkey/batch", "raw_path": b"/v2/wmts/batchkey/batch",
+             "query_string": b"tiles=10/1/2,10/1/3", "root_path": "", "headers": [(b"host", b"testserver")],
+             "client": ("127.0.0.1", 1234), "server": ("testserver", 80)}
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            raise OSError("client disconnected")
+
+    with pytest.raises(Exception):
+        asyncio.run(main.app(scope, receive, send))
+    assert main.REQUEST_LIMITS.stats()["in_flight"] == 0
+    assert main.API_KEY_MANAGER.scheduler.stats()["in_flight"] == 0
+
+
+def test_bad_credentials_cant_hold_up_the_tile_bounds_refresh(fake_hexagon, monkeypatch):
+    monkeypatch.setattr(main, "TILE_BOUNDS", TileBoundsIndex(refresh_seconds=60))
+    fake_hexagon.capabilities_body = CAPABILITIES_WITH_LIMITS
+    fake_hexagon.token_status = 401
+    with TestClient(main.app) as client:
+        assert client.get(f"{TILE_PATH}/10/1/2.jpg", follow_redirects=False).status_code == 403
+        assert main.TILE_BOUNDS.start_refresh()  # still due - the failed request didn't take it
+        main.TILE_BOUNDS.finish_refresh(True)
+    assert fake_hexagon.capabilities_calls == 0
+
+
+def test_coalesced_capabilities_requests_still_check_their_own_credentials(fake_hexagon):
+    fake_hexagon.token_status = 401
+    path = "1.0.0/WMTSCapabilities.xml"
+
+    async def scenario():
+        key = main.CAPABILITIES_CACHE.key(path, {})
+        future = main.CAPABILITIES_FETCHES.lead(key)  # another client's fetch of the same document is in flight
+        asyncio.get_running_loop().call_later(0.1, main.CAPABILITIES_FETCHES.finish, key, future, "document")
+        client = main.get_client(CLIENT_ID, CLIENT_SECRET, api_version="v1")
+        with pytest.raises(PermissionError):
+            await main.get_service_document(client, path, {})
+
+    asyncio.run(scenario())
+
+
+def test_throttled_credential_sets_sit_out_hexagons_retry_after(fake_hexagon, monkeypatch):
+    monkeypatch.setattr(main, "KEY_VAULT_CLIENT", FakeSecretClient({"credential-set-slowkey": json.dumps({"count": 1, "sets": [{"client_id": "id", "client_secret": "secret"}], "org": "Test Org"})}))
+    monkeypatch.setattr(main, "API_KEY_MANAGER", APIKeyManager())
+    fake_hexagon.tile_status = 429
+    fake_hexagon.tile_error_headers = {"Retry-After": "120"}
+
+    response = TestClient(main.app).get("/v2/wmts/slowkey/1.0.0/HxGN_Imagery/default/WebMercator/10/1/2.jpg", headers=BROWSER_HEADERS)
+    assert response.status_code == 429
+    health = main.API_KEY_MANAGER.scheduler.health({"client_id": "id"})
+    assert health.benched_until - time.monotonic() > 100  # as long as Hexagon asked, not CREDENTIAL_THROTTLE_BENCH_SECONDS
+
+
+def test_proxied_tiles_count_against_their_credential_set_until_sent(fake_hexagon, monkeypatch):
+    monkeypatch.setattr(main, "KEY_VAULT_CLIENT", FakeSecretClient({"credential-set-tilekey": json.dumps({"count": 1, "sets": [{"client_id": "id", "client_secret": "secret"}], "org": "Test Org"})}))
+    monkeypatch.setattr(main, "API_KEY_MANAGER", APIKeyManager())
+    path = "/v2/wmts/tilekey/1.0.0/HxGN_Imagery/default/WebMercator/10/1/2.jpg"
+    scope = {"type": "http", "asgi": {"version": "3.0", "spec_version": "2.4"}, "http_version": "1.1", "method": "GET",
+             "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+             "headers": [(b"host", b"testserver"), (b"origin", BROWSER_HEADERS["Origin"].encode())],
+             "client": ("127.0.0.1", 1234), "server": ("testserver", 80)}
+    in_flight_while_sending = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.body":
+            in_flight_while_sending.append(main.API_KEY_MANAGER.scheduler.stats()["in_flight"])
+
+    asyncio.run(main.app(scope, receive, send))
+    assert in_flight_while_sending[0] == 1
+    assert main.API_KEY_MANAGER.scheduler.stats()["in_flight"] == 0
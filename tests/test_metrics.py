@@ -0,0 +1,29 @@
+from hexprox.metrics import MetricsRegistry
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = MetricsRegistry()
+    latency = registry.histogram("test_seconds", "Test latency", ("kind",), buckets=(0.1, 1.0))
+    latency.observe(0.05, "tile")
+    latency.observe(0.5, "tile")
+    latency.observe(5, "tile")
+
+    text = registry.render()
+    assert 'test_seconds_bucket{kind="tile",le="0.1"} 1' in text
+    assert 'test_seconds_bucket{kind="tile",le="1.0"} 2' in text
+    assert 'test_seconds_bucket{kind="tile",le="+Inf"} 3' in text
+    assert 'test_seconds_count{kind="tile"} 3' in text
+    assert "# TYPE test_seconds histogram" in text
+
+
+def test_stats_collector_adds_hit_ratio_and_escapes_labels():
+    registry = MetricsRegistry()
+    registry.collect_stats("test_cache", lambda: {"hits": 3, "misses": 1, "name": "skipped"})
+    requests = registry.counter("test_requests_total", "Requests", ("org",))
+    requests.inc('Dept. of "Things"')
+
+    text = registry.render()
+    assert "test_cache_hits 3" in text
+    assert "test_cache_hit_ratio 0.75" in text
+    assert "test_cache_name" not in text
+    assert 'test_requests_total{org="Dept. of \\"Things\\""} 1' in text
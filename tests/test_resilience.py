@@ -0,0 +1,113 @@
+import asyncio
+
+import httpx
+import pytest
+
+from hexprox.resilience import CircuitBreaker, CircuitOpenError, RetryPolicy, send_with_resilience, parse_retry_after
+
+URL = "https://upstream.example.com/service?/tile"
+FAST_RETRIES = RetryPolicy(max_attempts=3, base_delay=0, max_delay=0, max_retry_after=1)
+
+
+def make_client(statuses, calls):
+    statuses = list(statuses)
+
+    def handler(request: httpx.Request):
+        calls.append(str(request.url))
+        status = statuses.pop(0) if len(statuses) > 1 else statuses[0]
+        if isinstance(status, Exception):
+            raise status
+        headers = {"Retry-After": "0"} if status == 429 else {}
+        return httpx.Response(status, content=b"body", headers=headers)
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def send(client, breaker, policy=FAST_RETRIES):
+    return asyncio.run(send_with_resilience(client, URL, retry_policy=policy, breaker=breaker))
+
+
+def test_retryable_statuses_are_retried_until_success():
+    calls = []
+    response = send(make_client([503, 429, 200], calls), CircuitBreaker("test"))
+
+    assert response.status_code == 200
+    assert len(calls) == 3
+
+
+def test_last_response_is_returned_when_retries_run_out():
+    calls = []
+    response = send(make_client([502], calls), CircuitBreaker("test"))
+
+    assert response.status_code == 502
+    assert len(calls) == FAST_RETRIES.max_attempts
+
+
+def test_long_retry_after_is_not_waited_for():
+    policy = RetryPolicy(max_attempts=3, base_delay=0, max_retry_after=5)
+    assert policy.should_retry(0, retry_after=2)
+    assert not policy.should_retry(0, retry_after=60)
+    assert parse_retry_after("12") == 12
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") is None
+
+
+def test_connection_errors_are_retried_then_raised():
+    calls = []
+    client = make_client([httpx.ConnectError("refused")], calls)
+    with pytest.raises(httpx.ConnectError):
+        send(client, CircuitBreaker("test"))
+    assert len(calls) == FAST_RETRIES.max_attempts
+
+
+def test_breaker_opens_after_failures_and_recovers():
+    calls = []
+    breaker = CircuitBreaker("test", failure_threshold=3, reset_seconds=0.05)
+    send(make_client([500], calls), breaker)  # three failed attempts
+    assert breaker.state == CircuitBreaker.OPEN
+
+    with pytest.raises(CircuitOpenError):
+        send(make_client([200], calls), breaker)
+    assert len(calls) == 3
+    assert breaker.rejected == 1
+
+    asyncio.run(asyncio.sleep(0.06))
+    response = send(make_client([200], calls), breaker)  # the trial request after the reset period
+    assert response.status_code == 200
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_cancelled_trial_does_not_leave_the_breaker_half_open():
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_seconds=0)
+    send(make_client([500], []), breaker, policy=RetryPolicy(max_attempts=1))
+    assert breaker.state == CircuitBreaker.OPEN
+
+    async def slow_handler(request):
+        await asyncio.sleep(10)
+        return httpx.Response(200)
+
+    async def cancel_trial():
+        client = httpx.AsyncClient(transport=httpx.MockTransport(slow_handler))
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(send_with_resilience(client, URL, retry_policy=FAST_RETRIES, breaker=breaker), timeout=0.01)
+
+    asyncio.run(cancel_trial())
+    assert breaker.state == CircuitBreaker.OPEN
+    assert send(make_client([200], []), breaker).status_code == 200  # the next request is the new trial
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_stuck_trial_is_replaced_after_the_reset_period():
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_seconds=0.05)
+    breaker.record_failure()
+    asyncio.run(asyncio.sleep(0.06))
+    breaker.before_request()  # a trial that never reports back
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+    asyncio.run(asyncio.sleep(0.06))
+    breaker.before_request()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+
+def test_throttling_does_not_trip_the_breaker():
+    breaker = CircuitBreaker("test", failure_threshold=2)
+    send(make_client([429], []), breaker)
+    assert breaker.state == CircuitBreaker.CLOSED
@@ -0,0 +1,86 @@
+import asyncio
+import json
+import os
+
+from hexprox.hexagon import HexagonStatusError
+from hexprox.seeding import TileSeeder, lonlat_to_tile, tiles_for_bbox
+from hexprox.tile_store import SQLiteTileStore
+
+
+class FakeClient:
+    """Returns tiles, throttling the first few requests"""
+    def __init__(self, throttle_first=0, fail=()):
+        self.calls = 0
+        self.throttle_first = throttle_first
+        self.fail = set(fail)
+
+    async def get_tile_content(self, matrix, row, col, extension="png"):
+        self.calls += 1
+        if self.calls <= self.throttle_first:
+            raise HexagonStatusError(429, b"slow down", {"retry-after": "0"})
+        if (matrix, row, col) in self.fail:
+            raise HexagonStatusError(500, b"broken")
+        return f"{matrix}/{row}/{col}".encode(), "image/jpeg"
+
+
+def test_tile_enumeration():
+    assert lonlat_to_tile(-122.4194, 37.7749, 10) == (395, 163)
+    assert list(tiles_for_bbox((-180, -85, 180, 85), [0])) == [(0, 0, 0)]
+    assert len(list(tiles_for_bbox((-180, -85, 180, 85), [2]))) == 16
+
+
+def test_seeding_backs_off_on_429_and_fills_the_store(tmp_path):
+    store = SQLiteTileStore(path=os.path.join(tmp_path, "tiles.mbtiles"), ttl_seconds=60, max_bytes=1024 * 1024)
+    seeder = TileSeeder(FakeClient(throttle_first=2), store, max_workers=8)
+    tiles = list(tiles_for_bbox((-180, -85, 180, 85), [0, 1, 2]))
+
+    stats = asyncio.run(seeder.seed(tiles))
+
+    assert stats["fetched"] == len(tiles) == 21
+    assert stats["throttled"] == 2
+    assert seeder.concurrency.limit < 8
+    assert store.get((2, 3, 1, "jpg")).content == b"2/3/1"
+
+
+def test_seeding_resumes_from_checkpoint_and_retries_failures(tmp_path):
+    store = SQLiteTileStore(path=os.path.join(tmp_path, "tiles.mbtiles"), ttl_seconds=60, max_bytes=1024 * 1024)
+    checkpoint = os.path.join(tmp_path, "checkpoint.json")
+    tiles = list(tiles_for_bbox((-180, -85, 180, 85), [0, 1, 2]))
+
+    first = TileSeeder(FakeClient(fail=[(1, 0, 0)]), store, max_workers=4, checkpoint_path=checkpoint, job={"test": 1})
+    asyncio.run(first.seed(tiles))
+    with open(checkpoint) as checkpoint_file:
+        saved = json.load(checkpoint_file)
+    assert saved["completed_through"] == len(tiles)
+    assert saved["failed"] == [[1, 0, 0]]
+
+    retry_client = FakeClient()
+    second = TileSeeder(retry_client, store, max_workers=4, checkpoint_path=checkpoint, job={"test": 1})
+    stats = asyncio.run(second.seed(tiles))
+    assert retry_client.calls == 1  # only the failed tile
+    assert stats["fetched"] == 1
+    assert store.contains((1, 0, 0, "jpg"))
+
+
+def test_interrupted_retries_stay_in_the_checkpoint(tmp_path):
+    store = SQLiteTileStore(path=os.path.join(tmp_path, "tiles.mbtiles"), ttl_seconds=60, max_bytes=1024 * 1024)
+    checkpoint = os.path.join(tmp_path, "checkpoint.json")
+    tiles = list(tiles_for_bbox((-180, -85, 180, 85), [0, 1, 2]))
+    failures = [[2, 0, 0], [2, 0, 1], [2, 0, 2], [2, 0, 3]]
+    with open(checkpoint, "w") as checkpoint_file:
+        json.dump({"job": {"test": 1}, "extension": "jpg", "completed_through": len(tiles), "failed": failures}, checkpoint_file)
+
+    class InterruptedClient(FakeClient):
+        async def get_tile_content(self, matrix, row, col, extension="png"):
+            if self.calls == 1:
+                raise KeyboardInterrupt  # stopped on the second retry
+            return await super().get_tile_content(matrix, row, col, extension)
+
+    seeder = TileSeeder(InterruptedClient(), store, max_workers=1, checkpoint_path=checkpoint, job={"test": 1})
+    try:
+        asyncio.run(seeder.seed(tiles))
+    except KeyboardInterrupt:
+        pass
+    with open(checkpoint) as checkpoint_file:
+        saved = json.load(checkpoint_file)
+    assert saved["failed"] == failures[1:]  # the first retry worked, the others are still to do
@@ -0,0 +1,133 @@
+import asyncio
+import multiprocessing
+import os
+
+import httpx
+from fastapi import BackgroundTasks
+
+from hexprox.hexagon import AsyncHexagonManager, STREAMING_WMTS_URL
+from hexprox.key_manager import APIKeyManager
+from hexprox.shared_state import SharedStateStore, shared_fetch
+from hexprox.standalone import parse_args, prepare_environment
+from hexprox.tile_store import SQLiteTileStore
+from tests.test_hexagon_async import make_transport
+from tests.test_key_manager import CREDENTIAL_SET, FakeSecretClient
+
+
+def make_workers(tmp_path, count=2):
+    """Stores opened separately on one file, as each worker process would"""
+    path = os.path.join(tmp_path, "shared-state.db")
+    return [SharedStateStore(path=path) for _ in range(count)]
+
+
+def test_values_expire_and_leases_are_exclusive(tmp_path):
+    first, second = make_workers(tmp_path)
+    first.put("token", "abc", {"access_token": "t"}, ttl_seconds=60)
+    first.put("token", "old", {"access_token": "o"}, ttl_seconds=-1)
+    assert second.get("token", "abc") == {"access_token": "t"}
+    assert second.get("token", "old") is None
+
+    assert first.acquire_lease("token:abc", seconds=60)
+    assert not second.acquire_lease("token:abc", seconds=60)
+    first.release_lease("token:abc")
+    assert second.acquire_lease("token:abc", seconds=0)
+    assert first.acquire_lease("token:abc", seconds=60)  # the expired lease can be taken over
+
+
+def test_concurrent_workers_fetch_once(tmp_path):
+    workers = make_workers(tmp_path, count=4)
+    fetches = []
+
+    async def fetch():
+        fetches.append(1)
+        await asyncio.sleep(0.1)
+        return {"value": 42}
+
+    async def run():
+        return await asyncio.gather(*(shared_fetch(worker, "test", "name", fetch, ttl_seconds=60) for worker in workers))
+
+    assert asyncio.run(run()) == [{"value": 42}] * 4
+    assert len(fetches) == 1
+
+
+def test_workers_share_tokens(tmp_path):
+    calls = []
+    managers = [AsyncHexagonManager("test_id", "test_secret", wmts_url=STREAMING_WMTS_URL, shared_state=worker,
+                                    http_client=httpx.AsyncClient(transport=make_transport(calls)))
+                for worker in make_workers(tmp_path, count=3)]
+
+    async def run():
+        return await asyncio.gather(*(manager.get_token() for manager in managers))
+
+    assert asyncio.run(run()) == ["fake-token"] * 3
+    assert len([call for call in calls if "oauth/token" in call]) == 1
+    assert all(manager.token_seconds_remaining > 3000 for manager in managers)
+
+
+def test_workers_share_credential_sets(tmp_path):
+    key_vault = FakeSecretClient({"credential-set-goodkey": CREDENTIAL_SET})
+    managers = [APIKeyManager(shared_state=worker) for worker in make_workers(tmp_path, count=3)]
+
+    async def run():
+        return await asyncio.gather(*(manager.get_credentials_for_api_key("goodkey", key_vault, BackgroundTasks(), None) for manager in managers))
+
+    assert [credentials["client_id"] for credentials in asyncio.run(run())] == ["id"] * 3
+    assert key_vault.calls == 1
+
+    asyncio.run(managers[0].force_refresh_credentials("goodkey", key_vault))
+    assert key_vault.calls == 2  # forced refreshes still go to Key Vault
+
+
+def test_tile_store_picks_up_other_workers_tiles(tmp_path):
+    path = os.path.join(tmp_path, "tiles.mbtiles")
+    first = SQLiteTileStore(path=path, ttl_seconds=60, max_bytes=1024)
+    second = SQLiteTileStore(path=path, ttl_seconds=60, max_bytes=1024)
+    first.put((3, 1, 2, "jpg"), b"jpeg-bytes", "image/jpeg")
+    assert not second.contains((3, 1, 2, "jpg"))
+
+    assert second.sync() == 1
+    assert second.get((3, 1, 2, "jpg")).content == b"jpeg-bytes"
+    assert first.sync() == 0  # nothing new from its own writes
+
+
+def store_tiles(path, row, count):
+    """Runs in a separate process - stores count distinct 12 byte tiles in one row"""
+    store = SQLiteTileStore(path=path, ttl_seconds=60, max_bytes=100)
+    for col in range(count):
+        store.put((5, row, col, "png"), bytes([row]) * 10 + col.to_bytes(2, "big"), "image/png")
+
+
+def test_worker_processes_share_one_tile_budget(tmp_path):
+    path = os.path.join(tmp_path, "tiles.mbtiles")
+    store = SQLiteTileStore(path=path, ttl_seconds=60, max_bytes=100)
+    store.put((5, 9, 0, "png"), b"x" * 12, "image/png")
+
+    workers = [multiprocessing.Process(target=store_tiles, args=(path, row, 20)) for row in (1, 2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=60)
+        assert worker.exitcode == 0
+
+    store.sync()
+    connection = store._connection
+    stored_bytes = connection.execute("SELECT COALESCE(SUM(length(tile_data)), 0) FROM images").fetchone()[0]
+    assert stored_bytes <= 100  # the budget covers both workers' tiles, not each one's own
+    assert connection.execute("SELECT value FROM store_state WHERE name='bytes'").fetchone()[0] == stored_bytes
+    assert store.current_bytes == stored_bytes
+
+    stored_keys = {(zoom, (2 ** zoom) - 1 - row, col, ext) for zoom, col, row, ext in
+                   connection.execute("SELECT zoom_level, tile_column, tile_row, tile_format FROM map")}
+    assert set(store._index) == stored_keys
+    assert not store.contains((5, 9, 0, "png"))  # evicted by the other workers - no longer claimed from a stale index
+
+
+def test_standalone_prepares_shared_files(tmp_path, monkeypatch):
+    monkeypatch.setenv("HEXPROX_SHARED_STATE_PATH", "")  # so prepare_environment's changes are undone afterwards
+    monkeypatch.setenv("HEXPROX_TILE_STORE_PATH", "")
+    options = parse_args(["--shared-state", os.path.join(tmp_path, "state", "shared.db"), "--tile-store", os.path.join(tmp_path, "tiles.mbtiles")])
+    environment = prepare_environment(options)
+
+    assert os.environ["HEXPROX_SHARED_STATE_PATH"] == environment["HEXPROX_SHARED_STATE_PATH"]
+    assert os.stat(options.shared_state).st_mode & 0o077 == 0  # holds tokens and client secrets
+    assert os.path.exists(options.tile_store)
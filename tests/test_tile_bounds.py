@@ -0,0 +1,55 @@
+from hexprox.tile_bounds import TileBoundsIndex, parse_tile_limits
+
+# California-ish coverage, zooms 0 and 10, with explicit limits at zoom 10
+CAPABILITIES_WITH_LIMITS = b"""<?xml version="1.0" encoding="UTF-8"?>
+<Capabilities xmlns="http://www.opengis.net/wmts/1.0" xmlns:ows="http://www.opengis.net/ows/1.1" version="1.0.0">
+  <Contents>
+    <Layer>
+      <ows:Identifier>HxGN_Imagery</ows:Identifier>
+      <ows:WGS84BoundingBox><ows:LowerCorner>-125.0 32.0</ows:LowerCorner><ows:UpperCorner>-114.0 42.0</ows:UpperCorner></ows:WGS84BoundingBox>
+      <TileMatrixSetLink>
+        <TileMatrixSet>WebMercator</TileMatrixSet>
+        <TileMatrixSetLimits>
+          <TileMatrixLimits><TileMatrix>10</TileMatrix><MinTileRow>380</MinTileRow><MaxTileRow>420</MaxTileRow><MinTileCol>150</MinTileCol><MaxTileCol>200</MaxTileCol></TileMatrixLimits>
+        </TileMatrixSetLimits>
+      </TileMatrixSetLink>
+    </Layer>
+    <Layer><ows:Identifier>Other</ows:Identifier></Layer>
+    <TileMatrixSet>
+      <ows:Identifier>WebMercator</ows:Identifier>
+      <TileMatrix><ows:Identifier>0</ows:Identifier><MatrixWidth>1</MatrixWidth><MatrixHeight>1</MatrixHeight></TileMatrix>
+      <TileMatrix><ows:Identifier>10</ows:Identifier><MatrixWidth>1024</MatrixWidth><MatrixHeight>1024</MatrixHeight></TileMatrix>
+    </TileMatrixSet>
+  </Contents>
+</Capabilities>
+"""
+
+
+def test_limits_combine_matrix_size_set_limits_and_coverage():
+    limits = parse_tile_limits(CAPABILITIES_WITH_LIMITS)
+    assert limits[0] == (0, 0, 0, 0)
+    assert limits[10] == (380, 415, 156, 187)  # the set limits, narrowed to the bounding box at zoom 10
+
+
+def test_index_allows_everything_until_built_and_ignores_unrelated_documents():
+    index = TileBoundsIndex(refresh_seconds=0)
+    assert index.contains(10, 0, 0) is None
+    assert not index.update(b"<Capabilities/>")
+    assert not index.update(b"not xml")
+    assert index.contains(10, 0, 0) is None
+
+    assert index.update(CAPABILITIES_WITH_LIMITS)
+    assert index.contains(10, 400, 170)
+    assert index.contains(10, 379, 170) is False
+    assert index.contains(11, 800, 340) is False  # zoom level not in the matrix set
+    assert index.stats()["rejected"] == 2
+
+
+def test_refreshes_are_spaced_out():
+    index = TileBoundsIndex(refresh_seconds=60, retry_seconds=0)
+    assert index.start_refresh()
+    assert not index.start_refresh()  # already refreshing
+    index.finish_refresh(False)
+    assert index.start_refresh()  # retried straight away
+    index.finish_refresh(True)
+    assert not index.start_refresh()
@@ -0,0 +1,30 @@
+from hexprox.tile_cache import TileCache
+
+
+def test_lru_eviction_by_bytes():
+    cache = TileCache(max_bytes=10, ttl_seconds=60)
+    cache.put(cache.key(1, 0, 0, "png"), b"aaaa", "image/png")
+    cache.put(cache.key(1, 0, 1, "png"), b"bbbb", "image/png")
+    assert cache.get(cache.key(1, 0, 0, "png")).content == b"aaaa"  # makes (1, 0, 1) the least recently used
+
+    cache.put(cache.key(1, 0, 2, "png"), b"cccc", "image/png")
+
+    assert cache.key(1, 0, 1, "png") not in cache
+    assert cache.key(1, 0, 0, "png") in cache
+    assert cache.current_bytes == 8
+    assert cache.evictions == 1
+
+
+def test_expired_tiles_are_misses():
+    cache = TileCache(max_bytes=100, ttl_seconds=-1)
+    cache.put(cache.key(1, 0, 0, "png"), b"aaaa", "image/png")
+
+    assert cache.get(cache.key(1, 0, 0, "png")) is None
+    assert cache.stats()["expirations"] == 1
+    assert cache.get(cache.key(1, 0, 0, "png"), allow_stale=True).content == b"aaaa"  # kept for serving when upstream fails
+
+
+def test_oversized_tiles_are_skipped():
+    cache = TileCache(max_bytes=3, ttl_seconds=60)
+    assert not cache.put(cache.key(1, 0, 0, "png"), b"aaaa", "image/png")
+    assert len(cache) == 0
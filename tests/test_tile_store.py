@@ -0,0 +1,78 @@
+import os
+import sqlite3
+import time
+
+from hexprox.tile_store import SQLiteTileStore
+
+
+def test_tiles_survive_reopening(tmp_path):
+    path = os.path.join(tmp_path, "tiles.mbtiles")
+    store = SQLiteTileStore(path=path, ttl_seconds=60, max_bytes=1024)
+    store.put((3, 1, 2, "jpg"), b"jpeg-bytes", "image/jpeg")
+    store.close()
+
+    reopened = SQLiteTileStore(path=path, ttl_seconds=60, max_bytes=1024)
+    assert reopened.contains((3, 1, 2, "jpg"))
+    assert not reopened.contains((3, 1, 2, "png"))
+    tile = reopened.get((3, 1, 2, "jpg"))
+    assert tile.content == b"jpeg-bytes"
+    assert tile.media_type == "image/jpeg"
+
+
+def test_size_cap_evicts_least_recently_used(tmp_path):
+    store = SQLiteTileStore(path=os.path.join(tmp_path, "tiles.mbtiles"), ttl_seconds=60, max_bytes=10)
+    store.put((1, 0, 0, "png"), b"aaaa", "image/png")
+    store.put((1, 0, 1, "png"), b"bbbb", "image/png")
+    store.get((1, 0, 0, "png"))
+    store.put((1, 1, 0, "png"), b"cccc", "image/png")
+
+    assert not store.contains((1, 0, 1, "png"))
+    assert store.contains((1, 0, 0, "png"))
+    assert store.current_bytes == 8
+    assert store.evictions == 1
+
+
+def test_expired_tiles_are_purged(tmp_path):
+    store = SQLiteTileStore(path=os.path.join(tmp_path, "tiles.mbtiles"), ttl_seconds=0.01, max_bytes=1024)
+    store.put((1, 0, 0, "png"), b"aaaa", "image/png")
+    time.sleep(0.02)
+
+    assert not store.contains((1, 0, 0, "png"))
+    assert store.purge_expired() == 1
+    assert len(store) == 0
+
+
+def test_identical_tiles_are_stored_once(tmp_path):
+    path = os.path.join(tmp_path, "tiles.mbtiles")
+    store = SQLiteTileStore(path=path, ttl_seconds=60, max_bytes=1024)
+    for col in range(3):
+        store.put((2, 1, col, "jpg"), b"blank", "image/jpeg")
+    store.put((2, 2, 0, "jpg"), b"imagery", "image/jpeg")
+
+    assert store.current_bytes == len(b"blank") + len(b"imagery")
+    assert store._connection.execute("SELECT count(*) FROM images").fetchone()[0] == 2
+    assert store._connection.execute("SELECT count(*) FROM tiles").fetchone()[0] == 4  # the MBTiles view still has every tile
+
+    store.delete((2, 1, 0, "jpg"))
+    store.put((2, 1, 1, "jpg"), b"new imagery", "image/jpeg")
+    assert store.get((2, 1, 2, "jpg")).content == b"blank"
+    store.delete((2, 1, 2, "jpg"))
+    assert store._connection.execute("SELECT count(*) FROM images").fetchone()[0] == 2  # the blank tile went with its last reference
+    assert store.current_bytes == len(b"imagery") + len(b"new imagery")
+
+
+def test_single_table_stores_are_migrated(tmp_path):
+    path = os.path.join(tmp_path, "tiles.mbtiles")
+    connection = sqlite3.connect(path)
+    connection.execute("""CREATE TABLE tiles (zoom_level INTEGER NOT NULL, tile_column INTEGER NOT NULL, tile_row INTEGER NOT NULL,
+                          tile_format TEXT NOT NULL, tile_data BLOB NOT NULL, media_type TEXT, fetched_at REAL NOT NULL,
+                          PRIMARY KEY (zoom_level, tile_column, tile_row, tile_format))""")
+    connection.executemany("INSERT INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           [(3, 2, 6, "jpg", b"blank", "image/jpeg", time.time()), (3, 3, 6, "jpg", b"blank", "image/jpeg", time.time())])
+    connection.commit()
+    connection.close()
+
+    store = SQLiteTileStore(path=path, ttl_seconds=60, max_bytes=1024)
+    assert store.get((3, 1, 2, "jpg")).content == b"blank"  # row 6 in TMS is row 1 in WMTS at zoom 3
+    assert store.contains((3, 1, 3, "jpg"))
+    assert store.stats()["distinct_tiles"] == 1
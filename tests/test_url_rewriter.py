@@ -0,0 +1,74 @@
+import asyncio
+
+import httpx
+
+from hexprox.capabilities_cache import CapabilitiesCache
+from hexprox.hexagon import STREAMING_WMTS_URL
+from hexprox.url_rewriter import StreamingSplitter, aiter_rewritten, needs_rewriting
+
+URL = STREAMING_WMTS_URL.encode()
+DOCUMENT = b"<Capabilities><ResourceURL template=\"" + URL + b"1.0.0/{TileMatrix}\"/>" + URL[:10] + b"<Other href=\"" + URL + b"\"/></Capabilities>"
+
+
+def split(chunks, pattern=URL):
+    splitter = StreamingSplitter(pattern)
+    pieces = [piece for chunk in chunks for piece in splitter.feed(chunk)] + splitter.close()
+    return b"".join(b"|" if piece is None else piece for piece in pieces)
+
+
+def test_occurrences_are_found_across_every_chunk_boundary():
+    expected = DOCUMENT.replace(URL, b"|")
+    for size in (1, 2, 7, 31, len(URL) - 1, len(URL), len(URL) + 1, len(DOCUMENT)):
+        chunks = [DOCUMENT[start:start + size] for start in range(0, len(DOCUMENT), size)]
+        assert split(chunks) == expected, size
+    assert split([b"abab", b"aba"], pattern=b"abac") == b"abababa"  # held back, then released at the end
+    assert split([b"abab", b"ac"], pattern=b"abac") == b"ab|"  # a false start still leaves room for a real one
+
+
+def test_chunks_without_the_url_are_passed_on_without_copying():
+    chunk = b"\xff\xd8" + b"j" * 4000
+    assert StreamingSplitter(URL).feed(chunk)[0] is chunk
+    assert needs_rewriting("application/xml; charset=utf-8") and needs_rewriting(None)
+    assert not needs_rewriting("image/jpeg")
+
+
+def test_streamed_documents_match_whole_ones():
+    async def stream_document(content, media_type):
+        async def body():
+            for start in range(0, len(content), 16):
+                yield content[start:start + 16]
+        response = httpx.Response(200, content=body(), headers={"Content-Type": media_type})
+        return await CapabilitiesCache().store_streamed(("path", ()), response)
+
+    whole = CapabilitiesCache().store(("path", ()), httpx.Response(200, content=DOCUMENT, headers={"Content-Type": "application/xml"}))
+    streamed = asyncio.run(stream_document(DOCUMENT, "application/xml"))
+    assert streamed.segments == whole.segments
+    assert streamed.render(b"https://proxy/") == DOCUMENT.replace(URL, b"https://proxy/")
+    assert streamed.rendered_length(b"https://proxy/") == len(streamed.render(b"https://proxy/"))
+    assert streamed.entity_tag("https://proxy/a/") != streamed.entity_tag("https://proxy/b/")
+
+    binary = asyncio.run(stream_document(URL * 3, "image/png"))
+    assert binary.segments == [URL * 3]  # binary bodies aren't searched
+
+
+def test_only_rewritten_documents_within_the_size_limit_are_cached():
+    cache = CapabilitiesCache(max_document_bytes=len(DOCUMENT))
+    cache.store(("small", ()), httpx.Response(200, content=DOCUMENT, headers={"Content-Type": "application/xml"}))
+    large = cache.store(("large", ()), httpx.Response(200, content=DOCUMENT + b" ", headers={"Content-Type": "application/xml"}))
+    cache.store(("binary", ()), httpx.Response(200, content=b"\x89PNG", headers={"Content-Type": "image/png"}))
+
+    assert cache.get(("small", ())) is not None
+    assert cache.get(("large", ())) is None and cache.get(("binary", ())) is None
+    assert large.render(b"https://proxy/") == (DOCUMENT + b" ").replace(URL, b"https://proxy/")  # still served to its request
+    assert cache.stats()["uncached"] == 2
+
+
+def test_streams_are_rewritten_as_they_arrive():
+    async def rewrite(size):
+        async def chunks():
+            for start in range(0, len(DOCUMENT), size):
+                yield DOCUMENT[start:start + size]
+        return b"".join([piece async for piece in aiter_rewritten(chunks(), URL, b"https://proxy/")])
+
+    for size in (1, 7, len(URL), len(DOCUMENT)):
+        assert asyncio.run(rewrite(size)) == DOCUMENT.replace(URL, b"https://proxy/"), size
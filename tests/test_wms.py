@@ -0,0 +1,125 @@
+import io
+
+import numpy
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+import main
+from hexprox import wms
+from tests.test_main_proxy import CLIENT_ID, CLIENT_SECRET, fake_hexagon  # noqa: F401 - fake_hexagon is a fixture
+
+WMS_PATH = f"/v1/wms/fakekey/{CLIENT_ID}/{CLIENT_SECRET}"
+HALF_WORLD = wms.WORLD_WIDTH / 2
+
+
+def get_map_params(**overrides):
+    params = {"SERVICE": "WMS", "VERSION": "1.3.0", "REQUEST": "GetMap", "LAYERS": "HxGN_Imagery", "STYLES": "",
+              "CRS": "EPSG:3857", "BBOX": f"{-HALF_WORLD},{-HALF_WORLD},{HALF_WORLD},{HALF_WORLD}",
+              "WIDTH": "256", "HEIGHT": "256", "FORMAT": "image/png"}
+    params.update(overrides)
+    return params
+
+
+def test_get_map_params_are_case_insensitive_and_follow_axis_order():
+    request = wms.GetMapRequest.from_params({"request": "getmap", "version": "1.3.0", "crs": "epsg:4326",
+                                             "bbox": "37.6,-122.6,37.9,-122.3", "width": "100", "height": "50"})
+    assert request.bbox == (-122.6, 37.6, -122.3, 37.9)  # 1.3.0 EPSG:4326 bboxes are lat/lon
+    assert request.media_type == "image/jpeg"
+
+    request = wms.GetMapRequest.from_params({"REQUEST": "GetMap", "VERSION": "1.1.1", "SRS": "EPSG:4326",
+                                             "BBOX": "-122.6,37.6,-122.3,37.9", "WIDTH": "100", "HEIGHT": "50",
+                                             "FORMAT": "image/png", "TRANSPARENT": "TRUE", "BGCOLOR": "0x102030"})
+    assert request.bbox == (-122.6, 37.6, -122.3, 37.9)
+    assert request.transparent and request.tile_extension == "png"
+    assert request.background == (0x10, 0x20, 0x30)
+
+
+@pytest.mark.parametrize("overrides, code", [
+    ({"REQUEST": "GetFeatureInfo"}, "OperationNotSupported"),
+    ({"CRS": "EPSG:27700"}, "InvalidCRS"),
+    ({"WIDTH": "lots"}, "MissingParameterValue"),
+    ({"WIDTH": "100000"}, "InvalidParameterValue"),
+    ({"BBOX": "1,1,0,0"}, "InvalidParameterValue"),
+    ({"FORMAT": "image/tiff"}, "InvalidFormat"),
+])
+def test_invalid_get_map_params_are_rejected(overrides, code):
+    with pytest.raises(wms.WMSError) as error:
+        wms.GetMapRequest.from_params(get_map_params(**overrides))
+    assert error.value.code == code
+
+
+def test_plan_picks_the_zoom_matching_the_output_resolution():
+    plan = wms.TilePlan.for_request(wms.GetMapRequest.from_params(get_map_params()))
+    assert plan.tiles == [(0, 0, 0)]
+    assert numpy.allclose(plan.pixel_x, numpy.arange(256) + 0.5)
+
+    plan = wms.TilePlan.for_request(wms.GetMapRequest.from_params(get_map_params(WIDTH="512", HEIGHT="512")))
+    assert plan.zoom == 1 and len(plan.tiles) == 4
+
+    quarter = f"0,0,{HALF_WORLD / 2},{HALF_WORLD / 2}"  # the south west quarter of the north east zoom 1 tile
+    plan = wms.TilePlan.for_request(wms.GetMapRequest.from_params(get_map_params(BBOX=quarter, WIDTH="200", HEIGHT="200")))
+    assert (plan.zoom, list(plan.rows), list(plan.cols)) == (2, [1], [2])
+
+
+def test_plan_falls_back_to_lower_zooms_for_too_many_tiles(monkeypatch):
+    monkeypatch.setattr(wms.config, "WMS_MAX_TILES", 4)
+    plan = wms.TilePlan.for_request(wms.GetMapRequest.from_params(get_map_params(WIDTH="2048", HEIGHT="2048")))
+    assert plan.zoom == 1 and len(plan.tiles) == 4
+
+
+def test_resample_is_exact_at_native_resolution_and_averages_when_halving():
+    mosaic_array = numpy.arange(16, dtype=numpy.uint8).reshape(4, 4, 1) * 10
+    centers = numpy.arange(4) + 0.5
+    plan = wms.TilePlan(0, range(1), range(1), centers, centers)
+    assert (wms.resample(mosaic_array, plan) == mosaic_array).all()
+
+    halved = numpy.array([1.0, 3.0])  # halfway between source pixels 0 and 1, and 2 and 3
+    plan = wms.TilePlan(0, range(1), range(1), halved, halved)
+    assert wms.resample(mosaic_array, plan)[:, :, 0].tolist() == [[25, 45], [105, 125]]
+
+
+def test_get_map_mosaics_tiles(fake_hexagon):
+    tile = Image.new("RGB", (256, 256), (200, 30, 40))
+    tile_bytes = io.BytesIO()
+    tile.save(tile_bytes, format="PNG")
+    fake_hexagon.tile_body = tile_bytes.getvalue()
+
+    client = TestClient(main.app)
+    response = client.get(WMS_PATH, params=get_map_params(WIDTH="300", HEIGHT="200"))
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/png"
+    assert "etag" in response.headers
+    image = Image.open(io.BytesIO(response.content))
+    assert image.size == (300, 200)
+    assert image.getpixel((150, 100)) == (200, 30, 40)
+    assert fake_hexagon.tile_calls == 4  # zoom 1
+
+    client.get(WMS_PATH, params=get_map_params(WIDTH="300", HEIGHT="200"))
+    assert fake_hexagon.tile_calls == 4  # the tiles come from the tile cache the second time
+
+
+def test_get_map_fills_missing_tiles_and_reports_bad_requests(fake_hexagon):
+    fake_hexagon.tile_status = 404
+    client = TestClient(main.app)
+    response = client.get(WMS_PATH, params=get_map_params(FORMAT="image/jpeg", BGCOLOR="0x000000"))
+    assert response.status_code == 200
+    assert Image.open(io.BytesIO(response.content)).getpixel((10, 10)) == (0, 0, 0)
+
+    response = client.get(WMS_PATH, params=get_map_params(CRS="EPSG:2230"))
+    assert response.status_code == 400
+    assert b'code="InvalidCRS"' in response.content
+
+
+def test_get_map_treats_corrupt_tiles_as_missing():
+    tile = Image.new("RGB", (256, 256), (200, 30, 40))
+    tile_bytes = io.BytesIO()
+    tile.save(tile_bytes, format="PNG")
+    map_request = wms.GetMapRequest.from_params(get_map_params(WIDTH="300", HEIGHT="200", BGCOLOR="0x000000"))
+    plan = wms.TilePlan.for_request(map_request)
+    corrupt = [b"<html>Service unavailable</html>", tile_bytes.getvalue()[:200]]  # an error page, and a truncated tile
+    tiles = {tile_key: corrupt[index % 2] for index, tile_key in enumerate(plan.tiles)}
+
+    image = Image.open(io.BytesIO(wms.render(map_request, plan, tiles)))
+    assert image.getpixel((150, 100)) == (0, 0, 0)